@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+from optparse import OptionParser
+import os, re, sys, time, json, socket, shutil, tempfile, threading, subprocess
+import server, journal
+from peafowl import Connection
+
+DEFAULT_PORT = 21133
+DEFAULT_TIMEOUT = 60 # seconds
+START_TIMEOUT = 10 # seconds
+EMPTY_WAIT = 0.001 # seconds
+MODES = ('inprocess', 'subprocess', 'connect')
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+RUSAGE = re.compile(r'^STAT rusage_(?:user|system) ([0-9.]+)\r$', re.M)
+
+def percentile(samples, fraction):
+    """
+    Returns the ``fraction`` percentile of the sorted list ``samples``.
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(samples, count, elapsed):
+    samples.sort()
+    summary = {'ops':count, 'ops_per_sec':elapsed and count / elapsed or 0.0}
+    for name, fraction in PERCENTILES:
+        summary['%s_ms' % name] = percentile(samples, fraction) * 1000
+    return summary
+
+class Benchmark(object):
+    """
+    Drives ``producers`` and ``consumers`` connections against a server
+    started for the run (or an existing one in ``connect`` mode), each
+    sending batches of ``depth`` pipelined commands spread over ``queues``
+    queues, and reports throughput and latency percentiles. Latencies are
+    measured per batch and accounted to each command in it. The CPU time
+    the server spent per command and per byte of payload, which copies of
+    the data add up to, is read from its stats, those of this process in
+    ``inprocess`` mode.
+    """
+    def __init__(self, mode = 'inprocess', host = server.DEFAULT_HOST, port = DEFAULT_PORT, engine = server.DEFAULT_ENGINE,
+                 durability = server.DEFAULT_DURABILITY, workers = 1, producers = 1, consumers = 1, messages = 10000,
+                 size = 64, queues = 1, depth = 1, timeout = DEFAULT_TIMEOUT):
+        self.config = {'mode':mode, 'host':host, 'port':port, 'engine':engine, 'durability':durability, 'workers':workers,
+                       'producers':producers, 'consumers':consumers, 'messages':messages, 'size':size, 'queues':queues,
+                       'depth':depth, 'timeout':timeout}
+        self.lock = threading.Lock()
+        self.consumed = 0
+        self.path = None
+        self.server = None
+        self.process = None
+
+    def run(self):
+        """
+        Runs the benchmark and returns its report.
+        """
+        config = self.config
+        self.start_server()
+        try:
+            self.total = config['producers'] * config['messages']
+            self.deadline = time.time() + config['timeout']
+            producers = [Worker(self._produce, i) for i in range(config['producers'])]
+            consumers = [Worker(self._consume, i) for i in range(config['consumers'])]
+            cpu = self.server_cpu()
+            start = time.time()
+            for worker in producers + consumers:
+                worker.start()
+            for worker in producers:
+                worker.join()
+            produced = time.time() - start
+            for worker in consumers:
+                worker.join()
+            elapsed = time.time() - start
+            cpu = self.server_cpu() - cpu
+        finally:
+            self.stop_server()
+        from __init__ import __version__
+        report = {'version':__version__, 'config':config, 'elapsed':elapsed}
+        if producers:
+            report['set'] = summarize(sum([worker.samples for worker in producers], []),
+                                      sum([worker.count for worker in producers]), produced)
+        if consumers:
+            report['get'] = summarize(sum([worker.samples for worker in consumers], []),
+                                      sum([worker.count for worker in consumers]), elapsed)
+        count = sum([worker.count for worker in producers + consumers])
+        if count:
+            report['cpu'] = {'us_per_op':cpu * 1000000 / count, 'ns_per_byte':cpu * 1000000000 / (count * config['size'])}
+        errors = [worker.error for worker in producers + consumers if worker.error]
+        if errors:
+            report['errors'] = errors
+        return report
+
+    def start_server(self):
+        config = self.config
+        if config['mode'] == 'connect':
+            return
+        self.path = tempfile.mkdtemp(prefix='peafowl-bench-')
+        if config['mode'] == 'inprocess':
+            self.server = server.Server(host=config['host'], port=config['port'], path=self.path, debug=0,
+                                        engine=config['engine'], durability=config['durability'])
+            thread = threading.Thread(target=self.server.run)
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            command = [sys.executable, '-c', 'from peafowl.runner import Runner; Runner.run()', '-q', self.path,
+                       '-P', os.path.join(self.path, 'peafowl.pid'), '-H', config['host'], '-p', str(config['port']),
+                       '-e', config['engine'], '-D', config['durability'], '-w', str(config['workers'])]
+            environment = dict(os.environ)
+            environment['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                                      environment.get('PYTHONPATH')]))
+            devnull = open(os.devnull, 'w')
+            self.process = subprocess.Popen(command, env=environment, stdout=devnull, stderr=devnull)
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection((config['host'], config['port'])).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    self.stop_server()
+                    raise
+                time.sleep(0.05)
+
+    def server_cpu(self):
+        """
+        Returns the seconds of CPU time used by the server so far.
+        """
+        connection = Connection((self.config['host'], self.config['port']))
+        try:
+            response = connection.request(['stats\r\n'])[0]
+        finally:
+            connection.close()
+        return sum(map(float, RUSAGE.findall(response)))
+
+    def stop_server(self):
+        if self.server:
+            self.server.stop()
+            self.server = None
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.path:
+            shutil.rmtree(self.path, True)
+            self.path = None
+
+    def _queue(self, number):
+        return 'bench_%d' % (number % self.config['queues'])
+
+    def _produce(self, worker):
+        config = self.config
+        connection = Connection((config['host'], config['port']))
+        payload = 'x' * config['size']
+        first = worker.number * config['messages']
+        try:
+            for batch in xrange(0, config['messages'], config['depth']):
+                commands = ['set %s 0 0 %d\r\n%s\r\n' % (self._queue(first + i), len(payload), payload)
+                            for i in xrange(batch, min(batch + config['depth'], config['messages']))]
+                start = time.time()
+                responses = connection.request(commands)
+                worker.record(time.time() - start, len(commands))
+                if responses.count('STORED\r\n') != len(responses):
+                    raise ValueError("SET failed: %r" % [r for r in responses if r != 'STORED\r\n'][0])
+        finally:
+            connection.close()
+
+    def _consume(self, worker):
+        config = self.config
+        connection = Connection((config['host'], config['port']))
+        number = worker.number
+        try:
+            while self.consumed < self.total and time.time() < self.deadline:
+                commands = []
+                for i in xrange(config['depth']):
+                    commands.append('get %s\r\n' % self._queue(number))
+                    number += 1
+                start = time.time()
+                responses = connection.request(commands)
+                duration = time.time() - start
+                items = len([response for response in responses if response.startswith('VALUE ')])
+                if not items:
+                    time.sleep(EMPTY_WAIT)
+                    continue
+                worker.record(duration, items)
+                self.lock.acquire()
+                try:
+                    self.consumed += items
+                finally:
+                    self.lock.release()
+        finally:
+            connection.close()
+
+class Worker(threading.Thread):
+    """
+    Load generating thread, collecting the latency of each command it sends.
+    """
+    def __init__(self, target, number):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.target = target
+        self.number = number
+        self.samples = []
+        self.count = 0
+        self.error = None
+
+    def record(self, duration, count):
+        self.samples.extend([duration] * count)
+        self.count += count
+
+    def run(self):
+        try:
+            self.target(self)
+        except Exception, e:
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+
+def parse_options(arguments = None):
+    parser = OptionParser(usage="%prog [options]", description="Runs a load against a Peafowl server and prints a JSON report.")
+    parser.add_option("--mode", action="store", type="choice", dest="mode", choices=MODES, help="run the server in this process, in a subprocess, or connect to a running one: %s" % ", ".join(MODES), default='inprocess')
+    parser.add_option("-H", "--host", action="store", type="string", dest="host", help="interface of the server", default=server.DEFAULT_HOST)
+    parser.add_option("-p", "--port", action="store", type="int", dest="port", help="TCP port of the server", default=DEFAULT_PORT)
+    parser.add_option("-e", "--engine", action="store", type="choice", dest="engine", choices=server.ENGINES, help="connection handling engine: %s" % ", ".join(server.ENGINES), default=server.DEFAULT_ENGINE)
+    parser.add_option("-D", "--durability", action="store", type="choice", dest="durability", choices=journal.DURABILITIES, help="transaction log durability", default=server.DEFAULT_DURABILITY)
+    parser.add_option("-w", "--workers", action="store", type="int", dest="workers", help="number of worker processes, subprocess mode only", default=1)
+    parser.add_option("-P", "--producers", action="store", type="int", dest="producers", help="number of producer connections", default=1)
+    parser.add_option("-C", "--consumers", action="store", type="int", dest="consumers", help="number of consumer connections", default=1)
+    parser.add_option("-n", "--messages", action="store", type="int", dest="messages", help="messages sent by each producer", default=10000)
+    parser.add_option("-s", "--size", action="store", type="int", dest="size", help="payload size in bytes", default=64)
+    parser.add_option("-Q", "--queues", action="store", type="int", dest="queues", help="number of queues", default=1)
+    parser.add_option("-d", "--depth", action="store", type="int", dest="depth", help="commands pipelined in each batch", default=1)
+    parser.add_option("-t", "--timeout", action="store", type="int", dest="timeout", help="seconds after which consumers give up", default=DEFAULT_TIMEOUT)
+    options, args = parser.parse_args(arguments)
+    if options.workers > 1 and options.mode != 'subprocess':
+        parser.error("--workers requires --mode subprocess")
+    if min(options.queues, options.depth, options.messages) < 1:
+        parser.error("--queues, --depth and --messages must be positive")
+    return options
+
+def main(arguments = None):
+    options = parse_options(arguments)
+    report = Benchmark(**vars(options)).run()
+    print json.dumps(report, indent=2, sort_keys=True)
+    return report.has_key('errors') and 1 or 0
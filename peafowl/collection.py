@@ -1,53 +1,354 @@
 # -*- coding: utf-8 -*-
-import os, thread, logging
-from queue import PersistentQueue
+import os, time, thread, threading, logging
+from collections import OrderedDict
+from struct import unpack_from
+from queue import PersistentQueue, MemoryBudget, SOFT_LOG_MAX_SIZE, DEFAULT_COMPACT_RATIO, EXPIRY_PREFIX_SIZE
+from journal import Committer, GROUP, DEFAULT_DURABILITY, DEFAULT_GROUP_INTERVAL, DEFAULT_GROUP_SIZE, DEFAULT_SEGMENT_SIZE
+from utils import Timer, Waiter, Metrics, Counters, timed_acquire
+
+DEFAULT_COMPACT_INTERVAL = 10 # seconds
+DEFAULT_SWEEP_INTERVAL = 1 # seconds
+
+EVICT_IDLE_TIME = 1 # seconds a queue must be unused to be closed
+EVICT_SCAN_SIZE = 32 # least recently used queues looked at per eviction
+QUEUE_LOCK_STRIPES = 64 # locks shared by the queues being opened
+
+# separates the name of a fanout queue from the one of its subscribers
+FANOUT_SEPARATOR = '+'
+
+ITEM_EXPIRY_FMT = "!I" # after the flags of items packed by the Handler
 
 class QueueCollectionError(Exception):
     pass
 
+def item_expiry(data):
+    """
+    Returns the expiry time of an item packed by the Handler, 0 if it
+    never expires.
+    """
+    if len(data) < EXPIRY_PREFIX_SIZE:
+        return 0
+    return unpack_from(ITEM_EXPIRY_FMT, data, 4)[0]
+
+class Compactor(threading.Thread):
+    """
+    Periodically checkpoints the transaction log of every queue, and
+    compacts those of queues that never fully drain, once it is bigger than
+    ``size`` bytes and ``ratio`` times bigger than the items it holds.
+    """
+    def __init__(self, queue_collection, interval = DEFAULT_COMPACT_INTERVAL, size = SOFT_LOG_MAX_SIZE, ratio = DEFAULT_COMPACT_RATIO):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue_collection = queue_collection
+        self.interval = interval
+        self.size = size
+        self.ratio = ratio
+        self.compactions = 0
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            queues = self.queue_collection.get_queues() or {}
+            for name, queue in queues.items():
+                if not queue.transaction_log:
+                    # closed meanwhile
+                    continue
+                try:
+                    if queue.needs_compaction(self.size, self.ratio):
+                        queue.compact()
+                        self.compactions += 1
+                    else:
+                        queue.checkpoint()
+                except Exception, e:
+                    logging.error("Could not compact transaction log for %s: %s" % (name, e))
+
+class Sweeper(threading.Thread):
+    """
+    Periodically reclaims the expired items at the head of every queue.
+    """
+    def __init__(self, queue_collection, interval = DEFAULT_SWEEP_INTERVAL):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue_collection = queue_collection
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            queues = self.queue_collection.get_queues() or {}
+            for name in queues.keys():
+                try:
+                    self.queue_collection.expire(name)
+                except Exception, e:
+                    logging.error("Could not expire items of %s: %s" % (name, e))
+
 class QueueCollection(object):
-    def __init__(self, path):
+    def __init__(self, path, durability = DEFAULT_DURABILITY, group_interval = DEFAULT_GROUP_INTERVAL, group_size = DEFAULT_GROUP_SIZE,
+                 compact_interval = DEFAULT_COMPACT_INTERVAL, compact_size = SOFT_LOG_MAX_SIZE, compact_ratio = DEFAULT_COMPACT_RATIO,
+                 memory_limit = 0, queue_memory_limit = 0, sweep_interval = DEFAULT_SWEEP_INTERVAL, compress_threshold = 0,
+                 compress_queues = None, codec = None, segment_size = DEFAULT_SEGMENT_SIZE, max_open_queues = 0,
+                 chunk_size = 0):
         if not os.path.isdir(path) and not os.access(path, os.W_OK):
             try:
                 os.makedirs(path)
                 logging.info("Creating queue directory : '%s'" % path)
             except OSError:
-                raise QueueCollectionError("Queue path '%s' is inacessible" % path) 
+                # another worker process may have created it meanwhile
+                if not os.path.isdir(path):
+                    raise QueueCollectionError("Queue path '%s' is inacessible" % path) 
         self.shutdown_lock = thread.allocate_lock()
         self.path = path
         self.queues = {}
-        self.queue_locks = {}
-        self.stats = {'current_bytes':0, 'total_items':0, 'get_misses':0, 'get_hits':0}
+        # queues are opened under the lock of their stripe, so that the
+        # locks don't grow with the number of queues ever used
+        self.queue_locks = [thread.allocate_lock() for i in xrange(QUEUE_LOCK_STRIPES)]
+        # each open queue holds its log files open, once more than
+        # max_open_queues are open the least recently used idle ones are
+        # closed, 0 meaning unlimited; last_used is kept from least to most
+        # recently used, under its own lock as stripes update it concurrently
+        self.max_open_queues = max_open_queues
+        self.last_used = OrderedDict()
+        self.last_used_lock = thread.allocate_lock()
+        self.evict_lock = thread.allocate_lock()
+        self.budget = MemoryBudget(memory_limit)
+        self.metrics = Metrics()
+        self.lock_wait = self.metrics.histogram('lock_queue')
+        self.queue_memory_limit = queue_memory_limit
+        # items of compress_threshold bytes or more are compressed, in
+        # every queue unless limited to compress_queues
+        self.compress_threshold = compress_threshold
+        self.compress_queues = compress_queues
+        self.codec = codec
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.timer = Timer()
+        self.timer.start()
+        self.committer = Committer(durability, group_interval, group_size)
+        if durability == GROUP:
+            self.committer.start()
+        self.compactor = Compactor(self, compact_interval, compact_size, compact_ratio)
+        if compact_interval > 0:
+            self.compactor.start()
+        self.sweeper = Sweeper(self, sweep_interval)
+        if sweep_interval > 0:
+            self.sweeper.start()
+        self.stats = Counters(current_bytes=0, total_items=0, get_misses=0, get_hits=0, queue_hits=0, queue_misses=0,
+                              queue_evictions=0)
+        self.replicas = []
+        self.replica_lock = thread.allocate_lock()
+        # the replication primary or follower, a follower's queues only
+        # change through the records it is shipped until it is promoted
+        self.replication = None
+        self.following = False
     
-    def put(self, key, data):
+    def put(self, key, data, wait = True):
         """
-        Puts ``data`` onto the queue named ``key``.
+        Puts ``data`` onto the queue named ``key`` and returns the sequence
+        number of its transaction. Unless ``wait`` is ``False``, returns once
+        ``data`` is durable. Items are put onto fanout queues, not onto
+        their subscribers.
         """
+        if FANOUT_SEPARATOR in key:
+            return None
         queue = self.get_queues(key)
         if not queue:
             return None
-        self.stats['current_bytes'] += len(data)
-        self.stats['total_items'] += 1
-        queue.put(data)
-        return True
+        data = queue.encode(data)
+        self.stats.incr('current_bytes', len(data))
+        self.stats.incr('total_items')
+        return queue.put(data, wait=wait)
     
     def take(self, key):
         """
         Retrieves data from the queue named ``key``.
         """
         queue = self.get_queues(key)
-        if not queue or not queue.qsize():
-            self.stats['get_misses'] += 1
+        if queue:
+            self._expire(queue)
+            if queue.cursors:
+                results = self._read(queue, key, 1)
+                return results and results[0] or None
+        # checking the size first could leave another consumer waiting
+        # forever for the last item, get_many doesn't block
+        results = queue and queue.get_many(1)
+        if not results:
+            self.stats.incr('get_misses')
+            return None
+        self.stats.incr('get_hits')
+        self.stats.decr('current_bytes', len(results[0]))
+        return queue.decode(results[0])
+    
+    def take_many(self, key, count):
+        """
+        Retrieves up to ``count`` items from the queue named ``key`` at once.
+        """
+        queue = self.get_queues(key)
+        if not queue:
+            self.stats.incr('get_misses')
+            return []
+        self._expire(queue)
+        if queue.cursors:
+            return self._read(queue, key, count)
+        results = queue.get_many(count)
+        if results:
+            self.stats.incr('get_hits', len(results))
+            self.stats.decr('current_bytes', sum(map(len, results)))
+        else:
+            self.stats.incr('get_misses')
+        return map(queue.decode, results)
+    
+    def unsubscribe(self, key):
+        """
+        Drops the subscriber named in ``key`` from its fanout queue, so that
+        it doesn't hold items back anymore. Returns ``False`` if it was not
+        subscribed.
+        """
+        name, sep, subscriber = key.partition(FANOUT_SEPARATOR)
+        queue = name and subscriber and self.get_queues(name)
+        if not queue:
+            return False
+        size = queue.unsubscribe(subscriber)
+        if size is None:
+            return False
+        self.stats.decr('current_bytes', size)
+        return True
+    
+    def take_open(self, key):
+        """
+        Retrieves an item from the queue named ``key`` and holds it open
+        until ``close_item`` or ``abort_item`` is called. Returns its
+        transaction id and data, or ``None``. Items of fanout queues can't
+        be held open.
+        """
+        queue = self.get_queues(key)
+        if queue:
+            self._expire(queue)
+        opened = queue and not queue.cursors and queue.open_item()
+        if not opened:
+            self.stats.incr('get_misses')
             return None
+        self.stats.incr('get_hits')
+        xid, data = opened
+        self.stats.decr('current_bytes', len(data))
+        return xid, queue.decode(data)
+    
+    def close_item(self, key, xid):
+        """
+        Removes the open item ``xid`` of the queue named ``key`` for good.
+        """
+        queue = self.get_queues(key)
+        if queue:
+            queue.close_item(xid)
+    
+    def abort_item(self, key, xid):
+        """
+        Puts the open item ``xid`` back at the head of the queue ``key``.
+        """
+        queue = self.get_queues(key)
+        if queue:
+            size = queue.abort_item(xid)
+            if size is not None:
+                self.stats.incr('current_bytes', size)
+    
+    def expire(self, key):
+        """
+        Reclaims the expired items at the head of the queue named ``key``,
+        if it is open.
+        """
+        lock = self._queue_lock(key)
+        lock.acquire()
+        try:
+            queue = self.queues.get(key)
+            if queue:
+                self._expire(queue)
+        finally:
+            lock.release()
+    
+    def replicate(self, replica):
+        """
+        Ships the records of every queue, current and future, to ``replica``
+        as ``PersistentQueue.replicate`` does.
+        """
+        self.replica_lock.acquire()
+        try:
+            self.replicas.append(replica)
+            for queue in self.queues.values():
+                queue.replicate(replica)
+        finally:
+            self.replica_lock.release()
+    
+    def unreplicate(self, replica):
+        self.replica_lock.acquire()
+        try:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+            for queue in self.queues.values():
+                queue.unreplicate(replica)
+        finally:
+            self.replica_lock.release()
+    
+    def apply(self, key, records):
+        """
+        Applies ``records`` shipped by the primary to the queue named ``key``.
+        """
+        queue = self.get_queues(key)
+        if not queue:
+            return
+        pushed, size = queue.apply(records)
+        self.stats.incr('total_items', pushed)
+        self.stats.incr('current_bytes', size)
+    
+    def restore(self, key, records):
+        """
+        Replaces the queue named ``key`` with the one ``records`` rebuild.
+        """
+        queue = self.get_queues(key)
+        if not queue:
+            return
+        self.stats.decr('current_bytes', queue.size())
+        self.queues.pop(key, None)
+        self._forget(key)
+        queue.remove()
+        self.apply(key, records)
+    
+    def promote(self):
+        """
+        Stops following the primary and gives back the items it held open.
+        Returns ``False`` if this is not a follower.
+        """
+        if not self.following:
+            return False
+        self.replication.stop()
+        self.replication = None
+        self.following = False
+        for queue in self.queues.values():
+            self.stats.incr('current_bytes', queue.release_opened())
+        return True
+    
+    def wait(self, key, deadline):
+        """
+        Blocks until an item is put onto the queue named ``key`` or until
+        ``deadline`` is reached. The item may be taken by someone else in
+        the meantime.
+        """
+        queue = self.get_queues(key)
+        if not queue:
+            return
+        waiter = Waiter()
+        queue.add_waiter(waiter.wake)
+        if self._available(queue, key):
+            waiter.wake()
         else:
-            self.stats['get_hits'] += 1
-        result = queue.get()
-        self.stats['current_bytes'] -= len(result)
-        return result
+            self.timer.schedule(deadline, waiter.wake)
+        waiter.wait()
+        queue.remove_waiter(waiter.wake)
     
     def get_queues(self, key = None):
         """
-        Returns all active queues.
+        Returns all active queues, or the one named ``key``, opening it or
+        waiting for another thread opening it. Subscribers
+        are named after their fanout queue, as in ``name+subscriber``, and
+        subscribe to it when first used.
         """
         if self.shutdown_lock.locked():
             return None
@@ -55,23 +356,48 @@ class QueueCollection(object):
         if not key:
             return self.queues
         
-        if self.queues.has_key(key):
-            return self.queues[key]
+        if FANOUT_SEPARATOR in key:
+            name, subscriber = key.split(FANOUT_SEPARATOR, 1)
+            queue = name and self.get_queues(name)
+            if queue and subscriber and not self.following:
+                queue.subscribe(subscriber)
+            return queue
         
-        if not self.queue_locks.has_key(key):
-            self.queue_locks[key] = thread.allocate_lock()
-        
-        if self.queue_locks[key].locked():
-            return None
-        else:
-            try:
-                self.queue_locks[key].acquire()
-                if not self.queues.has_key(key):
-                    self.queues[key] = PersistentQueue(self.path, key)
-                    self.stats['current_bytes'] += self.queues[key].initial_bytes
-            finally:
-                self.queue_locks[key].release()
-        return self.queues[key]
+        # looked up and marked used under the lock evictions take, so that
+        # the queue isn't closed once handed out
+        lock = self._queue_lock(key)
+        timed_acquire(lock, self.lock_wait)
+        opened = False
+        try:
+            queue = self.queues.get(key)
+            if queue:
+                self._touch(key, time.time())
+                self.stats.incr('queue_hits')
+            else:
+                compress_threshold = 0
+                if self.compress_queues is None or key in self.compress_queues:
+                    compress_threshold = self.compress_threshold
+                queue = PersistentQueue(self.path, key, committer=self.committer,
+                                        memory_limit=self.queue_memory_limit, budget=self.budget,
+                                        metrics=self.metrics, expiry=item_expiry,
+                                        compress_threshold=compress_threshold, codec=self.codec,
+                                        segment_size=self.segment_size, chunk_size=self.chunk_size)
+                self.stats.incr('current_bytes', queue.initial_bytes)
+                self.stats.incr('queue_misses')
+                self.replica_lock.acquire()
+                try:
+                    for replica in self.replicas:
+                        queue.replicate(replica)
+                    self.queues[key] = queue
+                    self._touch(key, time.time())
+                finally:
+                    self.replica_lock.release()
+                opened = True
+        finally:
+            lock.release()
+        if opened and self.max_open_queues and len(self.queues) > self.max_open_queues:
+            self._evict(key)
+        return queue
         
     def get_stats(self, name = None):
         """
@@ -79,26 +405,156 @@ class QueueCollection(object):
         Valid statistics are:
             ``get_misses``    Total number of get requests with empty responses
             ``get_hits``      Total number of get requests that returned data
-            ``current_bytes`` Current size in bytes of items in the queues
+            ``current_bytes`` Current size in bytes of items in the queues, as
+                              stored when compressed
             ``current_size``  Current number of items across all queues
             ``total_items``   Total number of items stored in queues.
+            ``memory_bytes``  Current size in bytes of items held in memory
+            ``limit_maxbytes`` Memory limit for items, 0 when unlimited
+            ``open_queues``   Current number of open queues
+            ``queue_hits``    Total number of uses of a queue already open
+            ``queue_misses``  Total number of queues opened from their log
+            ``queue_evictions`` Total number of idle queues closed
         """
         if not name:
             return self.stats
         elif name == 'current_size':
             return self._current_size()
+        elif name == 'memory_bytes':
+            return self.budget.used
+        elif name == 'limit_maxbytes':
+            return self.budget.limit
+        elif name == 'open_queues':
+            return len(self.queues)
         else:
             return self.stats[name]
     
+    def sync(self, key = None, sequence = None):
+        """
+        Makes pending transactions durable, either all of them or those of
+        the queue named ``key`` up to ``sequence``.
+        """
+        if not key:
+            self.committer.sync()
+        else:
+            queue = self.queues.get(key)
+            if queue:
+                queue.sync(sequence)
+    
     def close(self):
         """
         Safely close all queues.
         """
         self.shutdown_lock.acquire()
-        for name, queue in self.queues:
+        for name, queue in self.queues.items():
             queue.close()
             del self.queues[name]
     
+    def _evict(self, opened):
+        """
+        Closes the least recently used queues that are idle, and were not
+        used for ``EVICT_IDLE_TIME``, until at most ``max_open_queues`` are
+        open, but the ``opened`` one. At most ``EVICT_SCAN_SIZE`` queues are
+        looked at, busy ones being moved to the back. They are checkpointed
+        first, to be reopened quickly.
+        """
+        if not self.evict_lock.acquire(False):
+            return
+        try:
+            now = time.time()
+            excess = len(self.queues) - self.max_open_queues
+            for i in xrange(EVICT_SCAN_SIZE):
+                if excess <= 0:
+                    break
+                self.last_used_lock.acquire()
+                try:
+                    key, used = next(self.last_used.iteritems(), (None, now))
+                finally:
+                    self.last_used_lock.release()
+                if now - used < EVICT_IDLE_TIME:
+                    break
+                queue = self.queues.get(key)
+                if not queue:
+                    self._forget(key)
+                    continue
+                if key == opened or not queue.idle():
+                    self._touch(key, now, used)
+                    continue
+                lock = self._queue_lock(key)
+                lock.acquire()
+                try:
+                    if self.last_used.get(key) != used or not queue.idle():
+                        continue
+                    del self.queues[key]
+                    self._forget(key)
+                    try:
+                        queue.checkpoint()
+                    finally:
+                        queue.close()
+                finally:
+                    lock.release()
+                self.stats.incr('queue_evictions')
+                excess -= 1
+        finally:
+            self.evict_lock.release()
+    
+    def _touch(self, key, now, used = None):
+        """
+        Moves ``key`` to the back of ``last_used``, unless it was used since
+        ``used`` when given.
+        """
+        if not self.max_open_queues:
+            return
+        self.last_used_lock.acquire()
+        try:
+            if used is not None and self.last_used.get(key) != used:
+                return
+            self.last_used.pop(key, None)
+            self.last_used[key] = now
+        finally:
+            self.last_used_lock.release()
+    
+    def _forget(self, key):
+        self.last_used_lock.acquire()
+        try:
+            self.last_used.pop(key, None)
+        finally:
+            self.last_used_lock.release()
+    
+    def _queue_lock(self, key):
+        return self.queue_locks[hash(key) % len(self.queue_locks)]
+    
+    def _read(self, queue, key, count):
+        """
+        Reads up to ``count`` items of the fanout queue ``queue`` for the
+        subscriber named in ``key``, if any.
+        """
+        name, sep, subscriber = key.partition(FANOUT_SEPARATOR)
+        results, size = queue.read(subscriber, count)
+        if results:
+            self.stats.incr('get_hits', len(results))
+        else:
+            self.stats.incr('get_misses')
+        self.stats.decr('current_bytes', size)
+        return map(queue.decode, results)
+    
+    def _available(self, queue, key):
+        if not queue.cursors:
+            return queue.qsize()
+        name, sep, subscriber = key.partition(FANOUT_SEPARATOR)
+        return queue.unread(subscriber)
+    
+    def _expire(self, queue):
+        if self.following:
+            # expired items are removed by the primary
+            return
+        now = time.time()
+        while True:
+            count, size = queue.expire(now)
+            if not count:
+                break
+            self.stats.decr('current_bytes', size)
+    
     def _current_size(self):
         size = 0
         for name in self.queues:
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 import re, time, os, logging, socket, errno, threading
-from struct import pack, unpack
+from collections import defaultdict
+from struct import pack, pack_into, unpack_from
 
 from utils import rusage_user, rusage_system
+from worker import Peer
 
-DATA_PACK_FMT = "!II%ss"
+DATA_HEADER_FMT = "!II"
+DATA_HEADER_SIZE = 8
+
+RECV_SIZE = 64 * 1024
+INPUT_BUFFER_SIZE = 16 * 1024 # bytes allocated for the input of a connection once it sends data
+MAX_COMMAND_SIZE = 1024
+MAX_VALUE_SIZE = 32 * 1024**2
 
 # ERROR responses
 ERR_UNKNOWN_COMMAND = "CLIENT_ERROR bad command line format\r\n"
+ERR_TOO_LARGE = "CLIENT_ERROR object too large for cache\r\n"
 
 # GET Responses
 GET_COMMAND = r'^get (.{1,250})\r\n$'
 GET_RESPONSE = "VALUE %s %s %s\r\n%s\r\nEND\r\n"
+GET_RESPONSE_HEADER = "VALUE %s %s %d\r\n"
+DATA_END = "\r\n"
 GET_RESPONSE_EMPTY = "END\r\n"
 
 # SET Responses
@@ -19,9 +30,69 @@ SET_COMMAND = r'^set (.{1,250}) ([0-9]+) ([0-9]+) ([0-9]+)\r\n$'
 SET_RESPONSE_SUCCESS  = "STORED\r\n"
 SET_RESPONSE_FAILURE  = "NOT STORED\r\n"
 SET_CLIENT_DATA_ERROR = "CLIENT_ERROR bad data chunk\r\nERROR\r\n"
+SET_REQUEST = "set %s %s %s %s\r\n%s\r\n"
+
+# Reliable reads
+ERR_ALREADY_OPEN = "CLIENT_ERROR transaction already open\r\n"
+
+# Replication
+PROMOTE_COMMAND = r'^promote\r\n$'
+PROMOTE_RESPONSE = "OK\r\n"
+ERR_FOLLOWER = "SERVER_ERROR read only follower\r\n"
+ERR_NOT_FOLLOWER = "CLIENT_ERROR not a follower\r\n"
+REPLICATION_STATS_RESPONSE = """
+STAT replication_%s %s\r"""
+
+# Forwarded requests
+GET_REQUEST = "get %s\r\n"
+ERR_FORWARD = "SERVER_ERROR could not reach worker %d\r\n"
+
+# Binary protocol, told from the text one by the first byte of a client
+BINARY_REQUEST = 0x80
+BINARY_RESPONSE = 0x81
+# magic, opcode, key length, extras length, data type, vbucket or status,
+# body length, opaque, cas
+BINARY_HEADER_FMT = "!BBHBBHIIQ"
+BINARY_HEADER_SIZE = 24
+BINARY_FLAGS_FMT = "!I"
+OP_GET = 0x00
+OP_SET = 0x01
+OP_GETQ = 0x09
+OP_NOOP = 0x0a
+OP_STAT = 0x10
+BINARY_COMMANDS = {OP_GET:'get', OP_GETQ:'get', OP_SET:'set', OP_NOOP:'noop', OP_STAT:'stats'}
+STATUS_OK = 0x0000
+STATUS_KEY_NOT_FOUND = 0x0001
+STATUS_TOO_LARGE = 0x0003
+STATUS_INVALID_ARGUMENTS = 0x0004
+STATUS_NOT_STORED = 0x0005
+STATUS_UNKNOWN_COMMAND = 0x0081
+STATUS_NOT_SUPPORTED = 0x0083
+STATUS_INTERNAL_ERROR = 0x0084
+# status of each text response, others are internal errors
+BINARY_STATUSES = {SET_RESPONSE_SUCCESS:STATUS_OK, GET_RESPONSE_EMPTY:STATUS_KEY_NOT_FOUND, SET_RESPONSE_FAILURE:STATUS_NOT_STORED,
+                   SET_CLIENT_DATA_ERROR:STATUS_INVALID_ARGUMENTS, ERR_UNKNOWN_COMMAND:STATUS_INVALID_ARGUMENTS, ERR_TOO_LARGE:STATUS_TOO_LARGE,
+                   ERR_ALREADY_OPEN:STATUS_INVALID_ARGUMENTS, ERR_FOLLOWER:STATUS_NOT_SUPPORTED}
+STAT_LINE = re.compile(r'^STAT (\S+) (.*?)\r$', re.M)
 
 # STAT Response
-STATS_COMMAND = r'stats\r\n$'
+STATS_COMMAND = r'stats(?: (latency|detail|items))?\r\n$'
+STATS_REQUEST = "stats%s\r\n"
+STAT_RESPONSE = "STAT %s %s\r\n"
+# stats of a worker process kept as they are when added up with the
+# others', percentiles are not added up but the highest is kept
+LOCAL_STATS = ('pid', 'uptime', 'time', 'version')
+PERCENTILE_STATS = ('_p50_us', '_p99_us', '_p999_us')
+
+GET_PATTERN = re.compile(GET_COMMAND)
+SET_PATTERN = re.compile(SET_COMMAND)
+STATS_PATTERN = re.compile(STATS_COMMAND)
+PROMOTE_PATTERN = re.compile(PROMOTE_COMMAND)
+COMMANDS = (('get ', 'get', GET_PATTERN), ('set ', 'set', SET_PATTERN), ('stats', 'stats', STATS_PATTERN),
+            ('promote', 'promote', PROMOTE_PATTERN))
+# histogram of each command, looked up rather than held by every connection
+COMMAND_METRICS = dict([(name, 'cmd_%s' % name) for prefix, name, pattern in COMMANDS] +
+                       [(name, 'cmd_%s' % name) for name in BINARY_COMMANDS.values()] + [(None, 'cmd_unknown')])
 STATS_RESPONSE = """STAT pid %d\r
 STAT uptime %d\r
 STAT time %d\r
@@ -40,118 +111,569 @@ STAT get_misses %d\r
 STAT bytes_read %d\r
 STAT bytes_written %d\r
 STAT limit_maxbytes %d\r
-%s\nEND\r\n"""
+STAT memory_bytes %d\r
+STAT open_queues %d\r
+STAT limit_open_queues %d\r
+STAT queue_hits %d\r
+STAT queue_misses %d\r
+STAT queue_evictions %d\r%s
+END\r\n"""
 QUEUE_STATS_RESPONSE = """
 STAT queue_%s_items %d\r
 STAT queue_%s_total_items %d\r
 STAT queue_%s_logsize %d\r
-STAT queue_%s_expired_items %d\r"""
+STAT queue_%s_expired_items %d\r
+STAT queue_%s_replay_time %0.6f\r
+STAT queue_%s_memory_bytes %d\r
+STAT queue_%s_spilled_items %d\r
+STAT queue_%s_raw_bytes %d\r
+STAT queue_%s_compressed_bytes %d\r
+STAT queue_%s_memory_per_item %d\r"""
+SUBSCRIBER_STATS_RESPONSE = """
+STAT queue_%s+%s_items %d\r"""
+LATENCY_STATS_RESPONSE = """STAT %s_count %d\r
+STAT %s_total_us %d\r
+STAT %s_p50_us %d\r
+STAT %s_p99_us %d\r
+STAT %s_p999_us %d\r
+"""
+DETAIL_STATS_RESPONSE = "STAT %s_us_le_%d %d\r\n"
+ITEMS_STATS_RESPONSE = "STAT curr_items %d\r\nSTAT total_items %d\r\nSTAT bytes %d\r\nEND\r\n"
 
-class Handler(threading.Thread):
+def parse_key(key):
     """
-    This is an internal class used by Peafowl Server to handle the
-    MemCache protocol and act as an interface between the Server and the
-    QueueCollection.
+    Splits a requested key into the queue name and its options, as in
+    ``work/t=500`` which gives ``('work', {'t': '500'})``.
     """
-    def __init__(self, socket, queue_collection, stats):
-        threading.Thread.__init__(self)
-        self.expiry_stats = {}
+    parts = key.split('/')
+    options = {}
+    for option in parts[1:]:
+        name, sep, value = option.partition('=')
+        options[name] = value
+    return parts[0], options
+
+def parse_items(response):
+    """
+    Returns the flags and data of each value of a GET ``response``.
+    """
+    items = []
+    position = 0
+    while response.startswith('VALUE ', position):
+        end = response.index('\r\n', position)
+        key, flags, length = response[position + 6:end].rsplit(' ', 2)
+        position = end + 2 + int(length)
+        items.append((int(flags), response[end + 2:position]))
+        position += 2
+    return items
+
+def merge_stats(responses):
+    """
+    Returns the stats of every STAT ``responses`` of worker processes,
+    those of the first one leading, with their counters added up.
+    """
+    names = []
+    values = {}
+    for response in responses:
+        for name, value in STAT_LINE.findall(response):
+            if not values.has_key(name):
+                names.append(name)
+                values[name] = value
+            elif name not in LOCAL_STATS:
+                try:
+                    if name.endswith(PERCENTILE_STATS):
+                        values[name] = str(max(int(values[name]), int(value)))
+                    elif '.' in value or '.' in values[name]:
+                        values[name] = '%0.6f' % (float(values[name]) + float(value))
+                    else:
+                        values[name] = str(int(values[name]) + int(value))
+                except ValueError:
+                    # roles and such aren't added up
+                    pass
+    return ''.join([STAT_RESPONSE % (name, values[name]) for name in names]) + GET_RESPONSE_EMPTY
+
+def parse_command(command):
+    """
+    Returns the name of the command line ``command`` and its match, or
+    ``(None, None)`` if it is not understood.
+    """
+    for prefix, name, pattern in COMMANDS:
+        if command.startswith(prefix):
+            m = pattern.match(command)
+            if m:
+                return name, m
+            break
+    return None, None
+
+class Protocol(object):
+    """
+    This is an internal class implementing the MemCache protocol on top of
+    the QueueCollection. Incoming data is received into the reused ``input``
+    buffer and every complete command is processed at once, responses are
+    gathered in the ``output`` buffer. Clients sending a binary request
+    first are spoken the binary protocol, with the same commands and
+    responses translated. Subclasses provide the transport by implementing
+    ``_write``.
+    With a ``router``, requests for queues owned by another worker process
+    are forwarded to it. Requests of connections not ``counted`` were
+    forwarded by another worker, which counted them already.
+    """
+    sync_writes = True
+    
+    def __init__(self, queue_collection, stats, router = None, counted = True):
         self.stats = stats
+        if counted:
+            self.counters = stats.shard()
+        else:
+            self.counters = defaultdict(int)
         self.queue_collection = queue_collection
-        self.socket = socket
-        self.file = self.socket.makefile("rb")
+        self.router = router
+        self.peers = {}
+        self.opened = {}
+        self.input = bytearray() # until data is received
+        self.position = 0 # start of the first unprocessed command
+        self.filled = 0 # end of the received data
+        self.needed = 0 # bytes of the command waiting for its data
+        self.output = bytearray()
+        self.parked = None
+        self.closing = False # once the last response is written
+        self.binary = None # until the first byte is received
+        self.request = None # opcode and opaque of the binary request
+        # histograms are looked up when recorded, so that idle connections
+        # hold as little as possible
+        self.metrics = queue_collection.metrics
 
-    def run(self):
+    def _recv_into(self, socket):
         """
-        Process incoming commands from the attached client.
+        Receives data from ``socket`` after the data of ``input``, making
+        room for the data of a SET command as it arrives. Returns how many
+        bytes were received.
         """
-        self.stats['total_connections'] += 1
-        while True:
-            try:
-                command = self.file.readline()
-                if not command:
-                    break
-                logging.debug("Receiving command : %s" % repr(command))
-                self.stats['bytes_read'] += len(command)
-                self._process(command)
-            except socket.timeout, (value, message):
-                logging.info("Shutdown due to timeout: %s" % message)
-                self.socket.close()
-            except socket.error, (value, message):
-                if value == errno.EMFILE:
-                    # we should do something less stupid
-                    logging.warning("Too many open files or sockets")
-                else:
-                    self.socket.close()
+        room = max(self.needed, self.filled - self.position + 1)
+        if room > len(self.input) - self.position and (self.position or self.filled == len(self.input)):
+            # moves the unprocessed data to the front, or grows the buffer
+            # for a big value, along with the data received rather than at
+            # once to the length announced
+            pending = buffer(self.input, self.position, self.filled - self.position)
+            if room > len(self.input):
+                size = min(room, max(2 * len(self.input), len(pending) + RECV_SIZE))
+                grown = bytearray(max(size, INPUT_BUFFER_SIZE))
+                grown[:len(pending)] = pending
+                self.input = grown
+            else:
+                self.input[:len(pending)] = pending
+            self.position, self.filled = 0, len(pending)
+        received = socket.recv_into(memoryview(self.input)[self.filled:])
+        self.filled += received
+        return received
     
-    def _process(self, command):
-        m = re.match(SET_COMMAND, command)
-        if m:
-            logging.debug("Received a SET command")
-            self.stats['set_requests'] += 1
-            self.set(m.group(1), m.group(2), m.group(3), m.group(4))
-            return
-        m = re.match(GET_COMMAND, command)
-        if m:
+    def _process_input(self):
+        start = time.time()
+        self.needed = 0
+        if self.binary is None and self.filled > self.position:
+            self.binary = self.input[self.position] == BINARY_REQUEST
+        while not self.parked and not self.closing:
+            if self.binary:
+                command = self._parse_binary()
+                process = self._process_binary
+            else:
+                command = self._parse_text()
+                process = self._process
+            if not command:
+                break
+            parsed = time.time()
+            self.metrics.histogram('parse').record(parsed - start)
+            process(*command)
+            start = time.time()
+            self.metrics.histogram(COMMAND_METRICS[command[0]]).record(start - parsed)
+        if self.position == self.filled and self.input:
+            # idle connections hold no buffer
+            self.position = self.filled = 0
+            self.input = bytearray()
+
+    def _parse_text(self):
+        """
+        Returns the name and match of the next complete command line, if
+        any, the data of SET commands included.
+        """
+        end = self.input.find('\r\n', self.position, self.filled)
+        if end < 0:
+            if self.filled - self.position > MAX_COMMAND_SIZE:
+                logging.debug("Command line is too long")
+                self.position = self.filled
+                self._respond(ERR_UNKNOWN_COMMAND)
+            return None
+        command = self._slice(self.position, end + 2)
+        name, m = parse_command(command)
+        if name == 'set' and int(m.group(4)) > MAX_VALUE_SIZE:
+            logging.warning("SET command data is too large")
+            self._refuse(ERR_TOO_LARGE)
+            return None
+        if name == 'set' and self.filled < end + 2 + int(m.group(4)) + 2:
+            self.needed = end + 2 + int(m.group(4)) + 2 - self.position
+            return None
+        logging.debug("Receiving command : %r", command)
+        self.counters['bytes_read'] += len(command)
+        self.position = end + 2
+        return name, m
+    
+    def _parse_binary(self):
+        """
+        Returns the name, opcode, opaque, key, and the offsets of the extras
+        and value of the next complete binary request, if any.
+        """
+        if self.filled - self.position < BINARY_HEADER_SIZE:
+            return None
+        magic, opcode, key_length, extras_length, data_type, vbucket, body_length, opaque, cas = \
+            unpack_from(BINARY_HEADER_FMT, self.input, self.position)
+        if magic != BINARY_REQUEST or key_length + extras_length > body_length:
+            logging.debug("Binary request is invalid")
+            # requests can't be told apart anymore
+            self.position = self.filled
+            self.request = (opcode, opaque)
+            self._respond(ERR_UNKNOWN_COMMAND)
+            return None
+        if body_length - key_length - extras_length > MAX_VALUE_SIZE:
+            logging.warning("Binary request value is too large")
+            self.request = (opcode, opaque)
+            self._refuse(ERR_TOO_LARGE)
+            return None
+        size = BINARY_HEADER_SIZE + body_length
+        if self.filled - self.position < size:
+            self.needed = size
+            return None
+        extras = self.position + BINARY_HEADER_SIZE
+        value = extras + extras_length + key_length
+        self.position += size
+        self.counters['bytes_read'] += size
+        return (BINARY_COMMANDS.get(opcode), opcode, opaque, self._slice(value - key_length, value),
+                extras, extras_length, value, self.position - value)
+    
+    def _process(self, name, m):
+        if name == 'get':
             logging.debug("Received a GET command")
-            self.stats['get_requests'] += 1
+            self.counters['get_requests'] += 1
             self.get(m.group(1))
-            return
-        m = re.match(STATS_COMMAND, command)
-        if m:
+        elif name == 'set':
+            logging.debug("Received a SET command")
+            self.counters['set_requests'] += 1
+            self.set(m.group(1), m.group(2), m.group(3), m.group(4))
+        elif name == 'stats':
             logging.debug("Received a STATS command")
-            self.get_stats()
-            return
-        logging.debug("Received unknow command")
-        self._respond(ERR_UNKNOWN_COMMAND)
+            if m.group(1) == 'items':
+                self.items_stats()
+            elif m.group(1):
+                self.latency_stats(m.group(1) == 'detail')
+            else:
+                self.get_stats()
+        elif name == 'promote':
+            logging.debug("Received a PROMOTE command")
+            if self.queue_collection.promote():
+                logging.info("Promoted to primary")
+                self._respond(PROMOTE_RESPONSE)
+            else:
+                self._respond(ERR_NOT_FOLLOWER)
+        else:
+            logging.debug("Received unknow command")
+            self._respond(ERR_UNKNOWN_COMMAND)
+    
+    def _process_binary(self, name, opcode, opaque, key, extras, extras_length, value, length):
+        self.request = (opcode, opaque)
+        if name == 'get':
+            logging.debug("Received a binary GET command")
+            self.counters['get_requests'] += 1
+            if parse_key(key)[1].has_key('n'):
+                # each request gets one value, drained with quiet gets
+                self._respond(ERR_UNKNOWN_COMMAND)
+            else:
+                self.get(key)
+        elif name == 'set':
+            logging.debug("Received a binary SET command")
+            self.counters['set_requests'] += 1
+            if extras_length != DATA_HEADER_SIZE:
+                self._respond(SET_CLIENT_DATA_ERROR)
+            else:
+                flags, expiry = unpack_from(DATA_HEADER_FMT, self.input, extras)
+                self._store(key, flags, expiry, value, length)
+        elif name == 'noop':
+            logging.debug("Received a binary NOOP command")
+            self._respond_binary()
+        elif name == 'stats':
+            logging.debug("Received a binary STAT command")
+            if not key:
+                self.get_stats()
+            elif key == 'items':
+                self.items_stats()
+            elif key in ('latency', 'detail'):
+                self.latency_stats(key == 'detail')
+            else:
+                self._respond_binary(STATUS_KEY_NOT_FOUND, 'Not found')
+        else:
+            logging.debug("Received unknow binary command")
+            self._respond_binary(STATUS_UNKNOWN_COMMAND, 'Unknown command')
+    
+    def _refuse(self, message):
+        """
+        Responds with ``message`` and drops the input, the connection is
+        closed once it is written.
+        """
+        self._respond(message)
+        self.position = self.filled = self.needed = 0
+        self.input = bytearray()
+        self.closing = True
+    
+    def _slice(self, start, end):
+        return buffer(self.input, start, end - start)[:]
+    
+    def _write(self, response):
+        self.output += response
+    
+    def _defer_sync(self, name, sequence):
+        pass
     
     def _respond(self, message, *args):
-        response = message % args
-        self.stats['bytes_written'] += len(response)
-        logging.debug("Sending response : %s" % repr(response))
-        self.socket.send(response)
+        response = args and message % args or message
+        if self.binary:
+            return self._respond_translated(response)
+        self.counters['bytes_written'] += len(response)
+        logging.debug("Sending response : %r", response)
+        self._write(response)
+    
+    def _respond_binary(self, status = STATUS_OK, value = '', key = '', extras = ''):
+        """
+        Responds to the binary request being processed.
+        """
+        opcode, opaque = self.request
+        size = len(extras) + len(key) + len(value)
+        self._write(pack(BINARY_HEADER_FMT, BINARY_RESPONSE, opcode, len(key), len(extras), 0, status, size, opaque, 0))
+        self._write(extras)
+        self._write(key)
+        self._write(value)
+        self.counters['bytes_written'] += BINARY_HEADER_SIZE + size
+    
+    def _respond_translated(self, response):
+        """
+        Responds to the binary request being processed with the text
+        ``response`` it was given. Misses of quiet gets are not answered.
+        """
+        opcode = self.request[0]
+        if response.startswith('VALUE '):
+            self._respond_items(None, parse_items(response))
+        elif opcode == OP_STAT and response.startswith('STAT '):
+            for name, value in STAT_LINE.findall(response):
+                self._respond_binary(key=name, value=value)
+            self._respond_binary()
+        else:
+            status = BINARY_STATUSES.get(response, STATUS_INTERNAL_ERROR)
+            if status == STATUS_KEY_NOT_FOUND:
+                if opcode != OP_GETQ:
+                    self._respond_binary(status, 'Not found')
+            elif status:
+                self._respond_binary(status, response.split('\r\n', 1)[0])
+            else:
+                self._respond_binary()
     
     def set(self, key, flags, expiry, length):
         length = int(length)
-        data = self.file.read(length)
-        data_end = self.file.read(2)
-        self.stats['bytes_read'] += (length + 2)
-        if data_end == '\r\n' and len(data) == length:
-            internal_data = pack(DATA_PACK_FMT % (length), int(flags), int(expiry), data)
-            if self.queue_collection.put(key, internal_data):
-                logging.debug("SET command is a success")
-                self._respond(SET_RESPONSE_SUCCESS)
-            else:
-                logging.warning("SET command failed")
-                self._respond(SET_RESPONSE_FAILURE)
+        start = self.position
+        self.position = min(self.filled, start + length + 2)
+        self.counters['bytes_read'] += (length + 2)
+        if self._slice(start + length, self.position) == DATA_END:
+            self._store(key, int(flags), int(expiry), start, length)
         else:
             logging.error("SET command failed hard")
             self._respond(SET_CLIENT_DATA_ERROR)
     
+    def _store(self, key, flags, expiry, start, length):
+        """
+        Puts the ``length`` bytes of data at ``start`` in the input buffer
+        onto the queue ``key``.
+        """
+        name, options = parse_key(key)
+        if self.queue_collection.following:
+            self._respond(ERR_FOLLOWER)
+            return
+        if self.router and not self.router.owns(name):
+            self._forward(self.router.owner(name), SET_REQUEST % (key, flags, expiry, length, self._slice(start, start + length)))
+            return
+        # the header is packed over what precedes the data, the end of the
+        # command line or the key, so that the item is copied out of the
+        # input buffer at once
+        pack_into(DATA_HEADER_FMT, self.input, start - DATA_HEADER_SIZE, flags, expiry)
+        internal_data = self._slice(start - DATA_HEADER_SIZE, start + length)
+        sequence = self.queue_collection.put(name, internal_data, self.sync_writes)
+        if sequence:
+            if not self.sync_writes:
+                self._defer_sync(name, sequence)
+            logging.debug("SET command is a success")
+            self._respond(SET_RESPONSE_SUCCESS)
+        else:
+            logging.warning("SET command failed")
+            self._respond(SET_RESPONSE_FAILURE)
+    
     def get(self, key):
+        name, options = parse_key(key)
+        if self.queue_collection.following:
+            self._respond(ERR_FOLLOWER)
+            return
+        if self.router and not self.router.owns(name):
+            self._forward(self.router.owner(name), GET_REQUEST % key)
+            return
+        if options.has_key('unsubscribe'):
+            self.queue_collection.unsubscribe(name)
+            self._respond(GET_RESPONSE_EMPTY)
+            return
+        try:
+            timeout = int(options.get('t', 0))
+            count = int(options.get('n', 1))
+        except ValueError:
+            count = 0
+        reliable = options.has_key('open')
+        if count < 1 or (reliable and count > 1):
+            logging.debug("GET command has invalid options")
+            self._respond(ERR_UNKNOWN_COMMAND)
+            return
+        if options.has_key('close') or options.has_key('abort'):
+            self._finish(name, options.has_key('abort'))
+            if not reliable:
+                self._respond(GET_RESPONSE_EMPTY)
+                return
+        if reliable and self.opened.has_key(name):
+            logging.debug("GET command has an item open already")
+            self._respond(ERR_ALREADY_OPEN)
+            return
+        items = self._take(name, count, reliable)
+        if not items and timeout > 0:
+            logging.debug("GET command is waiting for %d ms" % timeout)
+            self._wait(name, key, count, time.time() + timeout / 1000.0, reliable)
+        else:
+            self._respond_items(key, items)
+    
+    def _take(self, name, count = 1, reliable = False):
         now = time.time()
-        data = None
-        response = self.queue_collection.take(key)
-        while response:
-            flags, expiry, data = unpack(DATA_PACK_FMT % (len(response) - 8), response)
-            if expiry == 0 or expiry >= now:
-                break
-            if self.expiry_stats.has_key(key):
-                self.expiry_stats[key] += 1
+        items = []
+        while not items:
+            opened = None
+            if reliable:
+                opened = self.queue_collection.take_open(name)
+                responses = opened and [opened[1]] or []
+            elif count == 1:
+                responses = filter(None, [self.queue_collection.take(name)])
             else:
-                self.expiry_stats[key] = 1
-            flags, expiry, data = None, None, None
-            response = self.queue_collection.take(key)
-        if data:
-            logging.debug("GET command respond with value")
-            self._respond(GET_RESPONSE, key, flags, len(data), data)
+                responses = self.queue_collection.take_many(name, count)
+            if not responses:
+                break
+            for response in responses:
+                # the data is sliced without a copy, until written out
+                flags, expiry = unpack_from(DATA_HEADER_FMT, response)
+                if isinstance(response, memoryview):
+                    data = response[DATA_HEADER_SIZE:]
+                else:
+                    data = buffer(response, DATA_HEADER_SIZE)
+                if expiry == 0 or expiry >= now:
+                    if data:
+                        items.append((flags, data))
+                else:
+                    self.queue_collection.stats.incr(('expired_items', name))
+            if opened:
+                if items:
+                    self.opened[name] = opened[0]
+                else:
+                    self.queue_collection.close_item(name, opened[0])
+        return items
+    
+    def _finish(self, name, abort = False):
+        xid = self.opened.pop(name, None)
+        if xid is None:
+            return
+        if abort:
+            self.queue_collection.abort_item(name, xid)
+        else:
+            self.queue_collection.close_item(name, xid)
+    
+    def _abort_opened(self):
+        for name in self.opened.keys():
+            self._finish(name, True)
+    
+    def _wait(self, name, key, count, deadline, reliable = False):
+        items = []
+        while not items and time.time() < deadline:
+            self.queue_collection.wait(name, deadline)
+            items = self._take(name, count, reliable)
+        self._respond_items(key, items)
+    
+    def _forward(self, worker, request):
+        try:
+            response = self._peer(worker).request(request)
+        except socket.error, e:
+            logging.error("Could not forward request to worker %d: %s" % (worker, e))
+            peer = self.peers.pop(worker, None)
+            if peer:
+                peer.close()
+            response = None
+        self._forwarded(worker, response)
+    
+    def _forwarded(self, worker, response):
+        if response is None:
+            self._respond(ERR_FORWARD, worker)
+        else:
+            self._respond(response)
+    
+    def _gather(self, workers, request, responses):
+        """
+        Responds with the stats ``responses`` of this worker added up with
+        the responses of ``workers`` to the stats ``request``.
+        """
+        for worker in workers:
+            try:
+                responses.append(self._peer(worker).request(request))
+            except socket.error, e:
+                logging.error("Could not gather stats of worker %d: %s" % (worker, e))
+                peer = self.peers.pop(worker, None)
+                if peer:
+                    peer.close()
+        self._respond(merge_stats(responses))
+    
+    def _respond_stats(self, request, response):
+        """
+        Responds with the stats ``response`` of this worker, added up with
+        those of the other workers when there are several.
+        """
+        if not self.router:
+            self._respond(response)
+            return
+        workers = [worker for worker in range(self.router.workers) if worker != self.router.worker]
+        self._gather(workers, request, [response])
+    
+    def _peer(self, worker):
+        if not self.peers.has_key(worker):
+            self.peers[worker] = Peer(self.router, worker)
+        return self.peers[worker]
+    
+    def _close_peers(self):
+        for peer in self.peers.values():
+            peer.close()
+        self.peers = {}
+    
+    def _respond_items(self, key, items):
+        if items and self.binary:
+            for flags, data in items:
+                self._respond_binary(value=data, extras=pack(BINARY_FLAGS_FMT, flags))
+        elif items:
+            logging.debug("GET command respond with %d value(s)", len(items))
+            size = len(self.output)
+            for flags, data in items:
+                self._write(GET_RESPONSE_HEADER % (key, flags, len(data)))
+                self._write(data)
+                self._write(DATA_END)
+            self._write(GET_RESPONSE_EMPTY)
+            self.counters['bytes_written'] += len(self.output) - size
         else:
             logging.debug("GET command response was empty")
             self._respond(GET_RESPONSE_EMPTY)
     
     def get_stats(self):
         from __init__ import __version__
-        self._respond(STATS_RESPONSE,
+        self._respond_stats(STATS_REQUEST % '', STATS_RESPONSE % (
             os.getpid(), # pid
             time.time() - self.stats['start_time'], # uptime
             time.time(), # time
@@ -169,19 +691,126 @@ class Handler(threading.Thread):
             self.queue_collection.stats['get_misses'],
             self.stats['bytes_read'],
             self.stats['bytes_written'],
-            0,
-            self.queue_stats()    
-        )
+            self.queue_collection.get_stats('limit_maxbytes'),
+            self.queue_collection.get_stats('memory_bytes'),
+            self.queue_collection.get_stats('open_queues'),
+            self.queue_collection.max_open_queues,
+            self.queue_collection.stats['queue_hits'],
+            self.queue_collection.stats['queue_misses'],
+            self.queue_collection.stats['queue_evictions'],
+            self.replication_stats() + self.queue_stats()
+        ))
         
+    def items_stats(self):
+        """
+        Responds with the item counts only, much cheaper than every stat.
+        """
+        self._respond_stats(STATS_REQUEST % ' items', ITEMS_STATS_RESPONSE % (self.queue_collection.get_stats('current_size'),
+                            self.queue_collection.get_stats('total_items'), self.queue_collection.get_stats('current_bytes')))
+    
+    def latency_stats(self, detail = False):
+        """
+        Responds with the latency histograms, summarized by percentiles or
+        with every ``detail``-ed bucket.
+        """
+        response = []
+        for name, histogram in self.metrics.items():
+            if detail:
+                for bound, count in histogram.buckets():
+                    response.append(DETAIL_STATS_RESPONSE % (name, bound, count))
+            else:
+                response.append(LATENCY_STATS_RESPONSE % (name, histogram.count(), name, histogram.total * 1000000,
+                    name, histogram.percentile(0.5), name, histogram.percentile(0.99), name, histogram.percentile(0.999)))
+        response.append(GET_RESPONSE_EMPTY)
+        self._respond_stats(STATS_REQUEST % (detail and ' detail' or ' latency'), ''.join(response))
+    
+    def replication_stats(self):
+        replication = self.queue_collection.replication
+        if not replication:
+            return ''
+        return ''.join([REPLICATION_STATS_RESPONSE % stat for stat in replication.stats()])
+    
     def queue_stats(self):
         response = ''
-        for name in self.queue_collection.get_queues():
-            queue = self.queue_collection.get_queues(name)
-            if self.expiry_stats.has_key(name):
-                expiry_stats = self.expiry_stats[name]
-            else:
-                expiry_stats = 0
-            response += QUEUE_STATS_RESPONSE % (name, queue.qsize(), name, queue.total_items, name, queue.log_size, name, expiry_stats)
+        # listed as they are, not used
+        for name, queue in self.queue_collection.get_queues().items():
+            expiry_stats = queue.expired_items + self.queue_collection.stats[('expired_items', name)]
+            response += QUEUE_STATS_RESPONSE % (name, queue.qsize(), name, queue.total_items, name, queue.log_bytes(), name, expiry_stats,
+                                                name, queue.replay_time, name, queue.memory_bytes, name, len(queue.spilled),
+                                                name, queue.raw_bytes, name, queue.compressed_bytes, name, queue.memory_per_item())
+            for subscriber in sorted(queue.cursors):
+                response += SUBSCRIBER_STATS_RESPONSE % (name, subscriber, queue.unread(subscriber))
         return response
 
+class Handler(threading.Thread, Protocol):
+    """
+    This is an internal class used by Peafowl Server to handle the
+    MemCache protocol and act as an interface between the Server and the
+    QueueCollection, using one thread per connection.
+    """
+    # writes are synced once per batch of pipelined commands
+    sync_writes = False
+    
+    def __init__(self, socket, queue_collection, stats, router = None, counted = True):
+        threading.Thread.__init__(self)
+        Protocol.__init__(self, queue_collection, stats, router, counted)
+        self.socket = socket
+        self.counted = counted
+        self.unsynced = {}
+        self.sync_time = self.metrics.histogram('sync')
+        self.send_time = self.metrics.histogram('send')
+
+    def run(self):
+        """
+        Process incoming commands from the attached client.
+        """
+        # counters are sharded per thread, and this one was created by the server
+        if self.counted:
+            self.counters = self.stats.shard()
+        self.counters['connections'] += 1
+        self.counters['total_connections'] += 1
+        while True:
+            try:
+                if not self._recv_into(self.socket):
+                    break
+                self._process_input()
+                self._flush()
+                if self.closing:
+                    break
+            except MemoryError:
+                logging.error("Out of memory for the input of a connection")
+                break
+            except socket.timeout, (value, message):
+                logging.info("Shutdown due to timeout: %s" % message)
+                break
+            except socket.error, (value, message):
+                if value == errno.EMFILE:
+                    # we should do something less stupid
+                    logging.warning("Too many open files or sockets")
+                else:
+                    break
+        self._abort_opened()
+        self._close_peers()
+        self.socket.close()
+        self.counters['connections'] -= 1
+        self.stats.release()
+    
+    def _flush(self):
+        if self.unsynced:
+            start = time.time()
+            for name, sequence in self.unsynced.items():
+                self.queue_collection.sync(name, sequence)
+            self.unsynced = {}
+            self.sync_time.record(time.time() - start)
+        if self.output:
+            start = time.time()
+            self.socket.sendall(self.output)
+            self.output = bytearray()
+            self.send_time.record(time.time() - start)
+    
+    def _defer_sync(self, name, sequence):
+        self.unsynced[name] = sequence
     
+    def _wait(self, name, key, count, deadline, reliable = False):
+        self._flush()
+        Protocol._wait(self, name, key, count, deadline, reliable)
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+import os, re, time, mmap, bisect, shutil, thread, threading
+from utils import Metrics
+
+FSYNC = 'fsync'
+GROUP = 'group'
+BUFFERED = 'buffered'
+
+DURABILITIES = (FSYNC, GROUP, BUFFERED)
+
+DEFAULT_DURABILITY = BUFFERED
+DEFAULT_GROUP_INTERVAL = 5 # ms
+DEFAULT_GROUP_SIZE = 128 # records
+DEFAULT_SEGMENT_SIZE = 8 * (1024**2) # 8 MB
+
+SEGMENT_FORMAT = "%020d"
+SEGMENT_NAME = re.compile(r'^[0-9]{20}$')
+
+class Journal(object):
+    """
+    Append-only transaction log, kept in a directory as segment files of
+    ``segment_size`` bytes. Segments are named after the offset of their
+    first byte in the log, so that offsets stay valid once the segments
+    holding only consumed records are removed. With ``BUFFERED``
+    durability records are handed over to the OS as soon as they are
+    appended. With ``FSYNC`` or ``GROUP`` durability records are buffered
+    and written along with every other pending record with a single
+    ``write`` and ``fsync``, either by the first thread waiting for them or
+    by the ``Committer``.
+    """
+    def __init__(self, path, committer = None, metrics = None, segment_size = DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.committer = committer
+        metrics = metrics or Metrics()
+        self.write_time = metrics.histogram('log_write')
+        self.fsync_time = metrics.histogram('log_fsync')
+        self.durability = committer and committer.durability or BUFFERED
+        self.segment_size = segment_size
+        self.lock = thread.allocate_lock()
+        self.sync_lock = threading.RLock()
+        self.synced = threading.Condition(self.lock)
+        self.pending = []
+        self.sequence = 0
+        self.synced_sequence = 0
+        self.syncs = 0
+        self.reader = None
+        if os.path.exists(self._replaced_path()):
+            if os.path.exists(self.path):
+                shutil.rmtree(self._replaced_path())
+            else:
+                # interrupted while replacing the log
+                os.rename(self._replaced_path(), self.path)
+        self._open()
+
+    def append(self, data):
+        """
+        Appends ``data`` to the log and returns its sequence number.
+        """
+        self.lock.acquire()
+        try:
+            self.sequence += 1
+            self.end += len(data)
+            if self.durability == BUFFERED:
+                start = time.time()
+                self._write([data])
+                self.write_time.record(time.time() - start)
+                self.buffered = self.end
+                self.synced_sequence = self.sequence
+            else:
+                self.pending.append(data)
+                self.committer.mark(self)
+            return self.sequence
+        finally:
+            self.lock.release()
+
+    def amend(self, offset, data):
+        """
+        Overwrites the record at ``offset``, the last one appended on its
+        own, with ``data`` of the same size. Returns its new sequence number,
+        or ``None`` if it is being synced and can't be overwritten.
+        """
+        self.lock.acquire()
+        try:
+            if offset >= self.buffered:
+                self.pending[-1] = data
+                self.committer.mark(self)
+            elif self.durability == BUFFERED:
+                self._write_at(offset, data)
+            else:
+                return None
+            self.sequence += 1
+            if self.durability == BUFFERED:
+                self.synced_sequence = self.sequence
+            return self.sequence
+        finally:
+            self.lock.release()
+
+    def wait(self, sequence):
+        """
+        Blocks until the record ``sequence`` is durable.
+        """
+        if self.durability == FSYNC:
+            if self.synced_sequence < sequence:
+                self.sync()
+        elif self.durability == GROUP:
+            self.lock.acquire()
+            try:
+                while self.synced_sequence < sequence:
+                    self.synced.wait()
+            finally:
+                self.lock.release()
+
+    def sync(self):
+        """
+        Writes and fsyncs every pending record.
+        """
+        self.sync_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                pending = self.pending
+                self.pending = []
+                self.buffered = self.end
+                sequence = self.sequence
+            finally:
+                self.lock.release()
+            if pending:
+                start = time.time()
+                self._write(pending)
+                written = time.time()
+                os.fsync(self.file.fileno())
+                self.write_time.record(written - start)
+                self.fsync_time.record(time.time() - written)
+                self.syncs += 1
+            self.lock.acquire()
+            try:
+                self.synced_sequence = max(self.synced_sequence, sequence)
+                self.synced.notifyAll()
+            finally:
+                self.lock.release()
+        finally:
+            self.sync_lock.release()
+
+    def fsync(self):
+        """
+        Syncs pending records, then fsyncs every segment.
+        """
+        self.sync_lock.acquire()
+        try:
+            self.sync()
+            for base in self.segments[:-1]:
+                segment = open(self._segment_path(base), "rb")
+                try:
+                    os.fsync(segment.fileno())
+                finally:
+                    segment.close()
+            os.fsync(self.file.fileno())
+        finally:
+            self.sync_lock.release()
+
+    def read(self, offset, size):
+        """
+        Returns ``size`` bytes of the log written at ``offset``.
+        """
+        chunks = []
+        while size > 0:
+            base = self.segments[bisect.bisect_right(self.segments, offset) - 1]
+            if not self.reader or self.reader[0] != base:
+                self._close_reader()
+                self.reader = (base, open(self._segment_path(base), "rb"))
+            reader = self.reader[1]
+            reader.seek(offset - base)
+            chunk = reader.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def view(self, end = None):
+        """
+        Returns a read-only map of the log written up to ``end``.
+        """
+        if end is None:
+            end = self.written
+        return LogView(self, end)
+
+    def truncate(self, offset):
+        """
+        Drops everything logged from ``offset`` on. Callers must prevent
+        concurrent appends.
+        """
+        self.sync_lock.acquire()
+        try:
+            self.sync()
+            self.file.close()
+            self._close_reader()
+            for base in reversed(self.segments):
+                if base < offset or base == self.segments[0]:
+                    segment = open(self._segment_path(base), "rb+")
+                    try:
+                        segment.truncate(max(0, offset - base))
+                    finally:
+                        segment.close()
+                    break
+                os.remove(self._segment_path(base))
+            self._open()
+        finally:
+            self.sync_lock.release()
+
+    def remove_before(self, offset):
+        """
+        Removes the segments holding only data logged before ``offset``,
+        without rewriting the others. Returns how many were removed.
+        """
+        self.sync_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                count = max(0, bisect.bisect_right(self.segments, offset) - 1)
+                removed = self.segments[:count]
+                self.segments = self.segments[count:]
+            finally:
+                self.lock.release()
+        finally:
+            self.sync_lock.release()
+        for base in removed:
+            os.remove(self._segment_path(base))
+        return len(removed)
+
+    def replace(self, path):
+        """
+        Syncs pending records, then replaces the log with the one at
+        ``path``. Callers must prevent concurrent appends.
+        """
+        self.sync_lock.acquire()
+        try:
+            self.sync()
+            self.file.close()
+            self._close_reader()
+            os.rename(self.path, self._replaced_path())
+            os.rename(path, self.path)
+            shutil.rmtree(self._replaced_path())
+            self._open()
+        finally:
+            self.sync_lock.release()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+        self._close_reader()
+
+    def size(self):
+        """
+        Returns the size in bytes of the segments of the log.
+        """
+        return self.end - self.segments[0]
+
+    def _open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.segments = sorted([int(name) for name in os.listdir(self.path) if SEGMENT_NAME.match(name)]) or [0]
+        base = self.segments[-1]
+        self.file = os.fdopen(os.open(self._segment_path(base), os.O_RDWR|os.O_CREAT), "rb+")
+        self.file.seek(0, os.SEEK_END)
+        self.written = self.end = self.buffered = base + self.file.tell()
+
+    def _write(self, records):
+        """
+        Writes ``records`` one after the other, through the file buffer
+        rather than joined first, and flushes them.
+        """
+        for data in records:
+            while data:
+                room = self.segments[-1] + self.segment_size - self.written
+                if room <= 0:
+                    self._rotate()
+                    continue
+                chunk = data[:room]
+                self.file.write(chunk)
+                self.written += len(chunk)
+                data = data[len(chunk):]
+        self.file.flush()
+
+    def _write_at(self, offset, data):
+        while data:
+            index = bisect.bisect_right(self.segments, offset) - 1
+            base = self.segments[index]
+            if index == len(self.segments) - 1:
+                chunk = data
+                self.file.seek(offset - base)
+                self.file.write(chunk)
+                self.file.seek(0, os.SEEK_END)
+                self.file.flush()
+            else:
+                chunk = data[:self.segments[index + 1] - offset]
+                segment = open(self._segment_path(base), "rb+")
+                try:
+                    segment.seek(offset - base)
+                    segment.write(chunk)
+                finally:
+                    segment.close()
+            offset += len(chunk)
+            data = data[len(chunk):]
+
+    def _rotate(self):
+        self.file.flush()
+        if self.durability != BUFFERED:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.segments.append(self.written)
+        self.file = os.fdopen(os.open(self._segment_path(self.written), os.O_RDWR|os.O_CREAT), "rb+")
+
+    def _close_reader(self):
+        if self.reader:
+            self.reader[1].close()
+            self.reader = None
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, SEGMENT_FORMAT % base)
+
+    def _replaced_path(self):
+        return "%s.old" % self.path
+
+class LogView(object):
+    """
+    Read-only map of the segments of a ``Journal`` up to ``end``, indexed
+    and sliced by offset in the log as a single string.
+    """
+    def __init__(self, journal, end):
+        self.end = end
+        self.bases = []
+        self.maps = []
+        for base in list(journal.segments):
+            if base >= end:
+                break
+            segment = open(journal._segment_path(base), "rb")
+            try:
+                size = os.fstat(segment.fileno()).st_size
+                if size:
+                    self.bases.append(base)
+                    self.maps.append(mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ))
+            finally:
+                segment.close()
+        self.start = self.bases and self.bases[0] or end
+
+    def __len__(self):
+        return self.end
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            stop = key.stop is None and self.end or min(key.stop, self.end)
+            return self._slice(key.start or 0, stop)
+        data = self._slice(key, min(key + 1, self.end))
+        if not data:
+            raise IndexError("log offset out of range")
+        return data
+
+    def close(self):
+        for map in self.maps:
+            map.close()
+        self.maps = []
+
+    def _slice(self, start, stop):
+        chunks = []
+        while start < stop:
+            index = bisect.bisect_right(self.bases, start) - 1
+            if index < 0:
+                raise IndexError("log offset %d was removed" % start)
+            chunk = self.maps[index][start - self.bases[index]:stop - self.bases[index]]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            start += len(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunks)
+
+class Committer(threading.Thread):
+    """
+    Keeps track of journals with pending records. With ``GROUP`` durability
+    it syncs them every ``interval`` milliseconds or as soon as ``size``
+    records are pending, whichever comes first.
+    """
+    def __init__(self, durability = DEFAULT_DURABILITY, interval = DEFAULT_GROUP_INTERVAL, size = DEFAULT_GROUP_SIZE):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.durability = durability
+        self.interval = interval / 1000.0
+        self.size = size
+        self.condition = threading.Condition()
+        self.dirty = set()
+        self.pending = 0
+
+    def mark(self, journal):
+        self.condition.acquire()
+        try:
+            self.dirty.add(journal)
+            self.pending += 1
+            if self.pending == 1 or self.pending >= self.size:
+                self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def sync(self):
+        """
+        Syncs every journal with pending records.
+        """
+        self.condition.acquire()
+        try:
+            journals = self.dirty
+            self.dirty = set()
+            self.pending = 0
+        finally:
+            self.condition.release()
+        for journal in journals:
+            journal.sync()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.dirty:
+                    self.condition.wait()
+                if self.pending < self.size:
+                    self.condition.wait(self.interval)
+            finally:
+                self.condition.release()
+            self.sync()
@@ -1,36 +1,459 @@
 # -*- coding: utf-8 -*-
-import time
-try:
-    import cmemcache as memcache
-except ImportError:
-    import memcache
+import re, time, errno, bisect, random, socket, logging, threading
+from hashlib import md5
+import cPickle as pickle
+from worker import response_length
+from collection import FANOUT_SEPARATOR
 
-WAIT_TIME = 0.25
+DEFAULT_PORT = 21122
+DEFAULT_POOL_SIZE = 8
+DEFAULT_SOCKET_TIMEOUT = 3 # seconds
+BLOCKING_TIMEOUT = 1000 # ms, added to the socket timeout of blocking gets
+RECV_SIZE = 64 * 1024
+
+DEFAULT_VNODES = 160 # points of each server on the ring
+DEAD_RETRY = 30 # seconds before retrying a server that could not be reached
+
+RETRIES = 3
+BACKOFF_DELAY = 0.01 # seconds, doubled on each retry
+BACKOFF_MAX_DELAY = 1.0 # seconds
+
+# flags of python-memcached, so both clients read each other's values
+FLAG_PICKLE = 1 << 0
+FLAG_INTEGER = 1 << 1
+FLAG_LONG = 1 << 2
+
+SET_REQUEST = "set %s %d %d %d\r\n%s\r\n"
+GET_REQUEST = "get %s\r\n"
+STATS_ITEMS_REQUEST = "stats items\r\n"
+STORED_RESPONSE = "STORED\r\n"
+# options of reliable reads, tied to the connection that opened the item
+RELIABLE_OPTIONS = set(['open', 'close', 'abort'])
+CURRENT_ITEMS = re.compile(r'^STAT curr_items ([0-9]+)\r$', re.M)
 
 class PeafowlError(Exception):
     pass
-    
-class Peafowl(memcache.Client):
-    def get(self, *args, **kwargs):
-        while True:
-            response = super(Peafowl, self).get(*args, **kwargs)
-            if response:
-                return response
-            time.sleep(WAIT_TIME)
-    
-    def set(self, *args, **kwargs):
-        retries = 0
-        while retries < 3:
-            return_value = super(Peafowl, self).set(*args, **kwargs)
-            if not return_value:
-                retries += 1
-                time.sleep(WAIT_TIME)
-            else:
-                break;
+
+def backoff(attempt):
+    """
+    Returns the delay before retry ``attempt``, growing exponentially and
+    jittered so that clients failing together don't retry together.
+    """
+    return min(BACKOFF_MAX_DELAY, BACKOFF_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def encode(value):
+    """
+    Returns the flags and data a value is stored with.
+    """
+    if isinstance(value, str):
+        return 0, value
+    elif isinstance(value, bool):
+        return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    elif isinstance(value, int):
+        return FLAG_INTEGER, str(value)
+    elif isinstance(value, long):
+        return FLAG_LONG, str(value)
+    return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def decode(flags, data):
+    if flags & FLAG_PICKLE:
+        return pickle.loads(data)
+    elif flags & FLAG_INTEGER:
+        return int(data)
+    elif flags & FLAG_LONG:
+        return long(data)
+    return data
+
+def parse_values(response):
+    """
+    Returns the decoded values of a GET ``response``.
+    """
+    values = []
+    position = 0
+    while response.startswith('VALUE ', position):
+        end = response.index('\r\n', position)
+        key, flags, length = response[position + 6:end].split(' ')
+        position = end + 2 + int(length)
+        values.append(decode(int(flags), response[end + 2:position]))
+        position += 2
+    return values
+
+class Connection(object):
+    """
+    Minimal MemCache connection sending pipelined batches of commands.
+    """
+    def __init__(self, address, timeout = None):
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timeout = timeout
+        self.buffer = ''
+
+    def request(self, commands, wait = 0):
+        """
+        Sends every command at once and returns the list of responses,
+        waiting ``wait`` milliseconds longer than the socket timeout for
+        commands the server holds.
+        """
+        if wait and self.timeout is not None:
+            self.socket.settimeout(self.timeout + wait / 1000.0)
+        try:
+            self.socket.sendall(''.join(commands))
+            responses = []
+            while len(responses) < len(commands):
+                length = response_length(self.buffer)
+                if length < 0:
+                    data = self.socket.recv(RECV_SIZE)
+                    if not data:
+                        raise socket.error(errno.ECONNRESET, "Connection closed by server")
+                    self.buffer += data
+                    continue
+                responses.append(self.buffer[:length])
+                self.buffer = self.buffer[length:]
+            return responses
+        finally:
+            if wait and self.timeout is not None:
+                self.socket.settimeout(self.timeout)
+
+    def close(self):
+        self.socket.close()
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of up to ``size`` connections to the server at
+    ``address``, opened as they are needed.
+    """
+    def __init__(self, address, size = DEFAULT_POOL_SIZE, timeout = DEFAULT_SOCKET_TIMEOUT):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Returns an idle connection, waiting for one if the pool is full.
+        """
+        self.condition.acquire()
+        try:
+            while not self.idle and self.opened >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        finally:
+            self.condition.release()
+        try:
+            return Connection(self.address, self.timeout)
+        except:
+            self._forget()
+            raise
+
+    def release(self, connection, broken = False):
+        """
+        Gives back ``connection`` to the pool, or closes it if ``broken``.
+        """
+        if broken:
+            connection.close()
+            return self._forget()
+        self.condition.acquire()
+        try:
+            self.idle.append(connection)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            for connection in self.idle:
+                connection.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+        finally:
+            self.condition.release()
+
+    def _forget(self):
+        self.condition.acquire()
+        try:
+            self.opened -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+class Reader(object):
+    """
+    Reliable reader of the queue ``key``, holding one connection of the
+    pool of ``client`` until released, since the server ties open items to
+    the connection that opened them. Used as a context, the item still
+    open on exit is aborted and the connection released.
+    """
+    def __init__(self, client, key):
+        self.key = key
+        self.opened = False
+        self.pool = self.connection = None
+        for node in client._nodes(key):
+            try:
+                self.connection = client.pools[node].acquire()
+                self.pool = client.pools[node]
+                break
+            except socket.error, e:
+                logging.warning("Server %s:%d is down: %s" % (client.pools[node].address + (e,)))
         else:
-            raise PeafowlError("Can't set value")
+            raise PeafowlError("No server available for %s" % key)
 
-    def __len__(self, *args, **kwargs):
-        statistics = self.get_stats()
-        return int(statistics[0][1]['total_items'])
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def open(self, timeout = BLOCKING_TIMEOUT):
+        """
+        Waits for the next item of the queue and holds it open until closed
+        or aborted, the item open before is closed in the same request.
+        """
+        attempt = 0
+        while True:
+            request = self.opened and '%s/close/open' % self.key or '%s/open' % self.key
+            if timeout:
+                request += '/t=%d' % timeout
+            values = self._get(request, timeout)
+            self.opened = bool(values)
+            if values:
+                return values[0]
+            if not timeout:
+                time.sleep(backoff(attempt))
+                attempt = min(attempt + 1, RETRIES)
+
+    def close(self):
+        """
+        Acknowledges the item open, removing it from the queue.
+        """
+        self._get('%s/close' % self.key)
+        self.opened = False
+
+    def abort(self):
+        """
+        Puts the item open back at the head of the queue.
+        """
+        self._get('%s/abort' % self.key)
+        self.opened = False
+
+    def release(self):
+        """
+        Aborts the item still open and gives back the connection.
+        """
+        if not self.connection:
+            return
+        if self.opened:
+            self.abort()
+        self.pool.release(self.connection)
+        self.connection = None
+
+    def _get(self, request, wait = 0):
+        if not self.connection:
+            raise PeafowlError("Reader of %s is released" % self.key)
+        try:
+            return parse_values(self.connection.request([GET_REQUEST % request], wait)[0])
+        except socket.error, e:
+            # the server aborts the item open once the connection drops
+            self.pool.release(self.connection, True)
+            self.connection = None
+            self.opened = False
+            raise PeafowlError("Request to %s:%d failed: %s" % (self.pool.address + (e,)))
+
+def ring_hash(key):
+    return int(md5(key).hexdigest()[:8], 16)
+
+class Ring(object):
+    """
+    Consistent hash ring placing ``vnodes`` points of each of ``nodes``, so
+    that adding or removing one only moves the names hashed next to it.
+    """
+    def __init__(self, nodes, vnodes = DEFAULT_VNODES):
+        points = []
+        for index, node in enumerate(nodes):
+            for i in range(vnodes):
+                points.append((ring_hash('%s-%d' % (node, i)), index))
+        points.sort()
+        self.hashes = [point for point, index in points]
+        self.indexes = [index for point, index in points]
+        self.size = len(nodes)
+
+    def nodes(self, name):
+        """
+        Yields the index of each node once, clockwise from ``name``, the
+        first one owning it.
+        """
+        seen = set()
+        start = bisect.bisect(self.hashes, ring_hash(name))
+        for i in xrange(len(self.indexes)):
+            index = self.indexes[(start + i) % len(self.indexes)]
+            if index not in seen:
+                seen.add(index)
+                yield index
+                if len(seen) == self.size:
+                    return
+
+class Peafowl(object):
+    """
+    Client of Peafowl ``servers``, given as ``host:port`` strings, with a
+    pool of connections to each of them. Each queue lives on the server
+    its name is hashed to on a consistent ring, or on the next one when
+    it can't be reached, along with the subscribers of fanout queues. Consumers in ``drain`` mode take items from any
+    server, to collect those left behind by a change of servers. Reliable
+    reads go through a ``reader``, which holds one connection.
+    """
+    def __init__(self, servers, pool_size = DEFAULT_POOL_SIZE, socket_timeout = DEFAULT_SOCKET_TIMEOUT, vnodes = DEFAULT_VNODES,
+                 dead_retry = DEAD_RETRY, drain = False):
+        self.pools = []
+        for server in servers:
+            host, sep, port = server.partition(':')
+            self.pools.append(ConnectionPool((host, int(port or DEFAULT_PORT)), pool_size, socket_timeout))
+        self.ring = Ring(servers, vnodes)
+        self.dead_retry = dead_retry
+        self.dead = {}
+        self.drain = drain
+
+    def get(self, key, timeout = BLOCKING_TIMEOUT):
+        """
+        Waits for an item on the queue ``key``, the server holds each request
+        for up to ``timeout`` milliseconds.
+        """
+        attempt = 0
+        while True:
+            values = self.take_many(key, 1, timeout)
+            if values:
+                return values[0]
+            if not timeout:
+                time.sleep(backoff(attempt))
+                attempt = min(attempt + 1, RETRIES)
+
+    def take_many(self, key, count, timeout = 0):
+        """
+        Returns up to ``count`` items of the queue ``key`` in one request,
+        waiting up to ``timeout`` milliseconds for the first one.
+        """
+        if RELIABLE_OPTIONS.intersection(key.split('/')[1:]):
+            raise PeafowlError("Reliable reads of %s need a reader" % key)
+        request = "%s/n=%d" % (key, count)
+        if self.drain:
+            for node in self._nodes(key):
+                responses = self._send(node, [GET_REQUEST % request])
+                values = responses and parse_values(responses[0])
+                if values:
+                    return values
+            if not timeout:
+                return []
+        if timeout:
+            request += "/t=%d" % timeout
+        response = self._request(key, [GET_REQUEST % request], wait=timeout)[0]
+        return parse_values(response)
+
+    def reader(self, key):
+        """
+        Returns a ``Reader`` of the queue ``key``, holding open the items it
+        reads on a connection of its own.
+        """
+        return Reader(self, key)
+
+    def set(self, key, value, expiry = 0):
+        """
+        Puts ``value`` on the queue ``key``.
+        """
+        self.put_many(key, [value], expiry)
+        return True
+
+    def put_many(self, key, values, expiry = 0):
+        """
+        Puts every one of ``values`` on the queue ``key``, pipelined on a
+        single connection. Values the server did not store are sent again,
+        in order, after a backoff. Raises ``PeafowlError`` if some are still
+        not stored after all retries.
+        """
+        commands = []
+        for value in values:
+            flags, data = encode(value)
+            commands.append(SET_REQUEST % (key, flags, expiry, len(data), data))
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                time.sleep(backoff(attempt - 1))
+            try:
+                responses = self._request(key, commands, write=True)
+            except PeafowlError:
+                # some of them may have been stored already
+                continue
+            commands = [command for command, response in zip(commands, responses) if response != STORED_RESPONSE]
+            if not commands:
+                return len(values)
+        raise PeafowlError("Can't set %d of %d values" % (len(commands), len(values)))
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+    def __len__(self):
+        """
+        Returns the number of items queued on every server reached.
+        """
+        size = 0
+        for node in range(len(self.pools)):
+            responses = self._send(node, [STATS_ITEMS_REQUEST])
+            if responses:
+                size += int(CURRENT_ITEMS.search(responses[0]).group(1))
+        return size
+
+    def _nodes(self, key):
+        """
+        Yields the servers of queue ``key``, its owner first, skipping those
+        recently found down.
+        """
+        now = time.time()
+        for node in self.ring.nodes(key.split('/', 1)[0].split(FANOUT_SEPARATOR, 1)[0]):
+            if self.dead.get(node, 0) <= now:
+                yield node
+
+    def _request(self, key, commands, write = False, wait = 0):
+        for node in self._nodes(key):
+            responses = self._send(node, commands, write, wait)
+            if responses is not None:
+                return responses
+        raise PeafowlError("No server available for %s" % key)
+
+    def _send(self, node, commands, write = False, wait = 0):
+        """
+        Sends ``commands`` to server ``node``, returns ``None`` if it can't
+        be reached and marks it down for a while. A request failing on a
+        pooled connection is sent once more on a fresh one, unless it
+        ``write``s, as it may have been applied already.
+        """
+        pool = self.pools[node]
+        for retry in range(2):
+            for attempt in range(RETRIES):
+                if attempt:
+                    time.sleep(backoff(attempt - 1))
+                try:
+                    connection = pool.acquire()
+                    break
+                except socket.error, e:
+                    error = e
+            else:
+                break
+            try:
+                responses = connection.request(commands, wait)
+            except socket.error, e:
+                # the other idle connections were likely dropped as well
+                pool.release(connection, True)
+                pool.close()
+                if write:
+                    raise PeafowlError("Request to %s:%d failed: %s" % (pool.address + (e,)))
+                error = e
+                continue
+            pool.release(connection)
+            self.dead.pop(node, None)
+            return responses
+        logging.warning("Server %s:%d is down: %s" % (pool.address + (error,)))
+        self.dead[node] = time.time() + self.dead_retry
+        pool.close()
+        return None
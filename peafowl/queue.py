@@ -1,50 +1,272 @@
 # -*- coding: utf-8 -*-
-import os, time, thread, logging
+import os, re, sys, time, mmap, zlib, shutil, thread, logging
+from array import array
 from Queue import Queue
-from struct import pack, unpack
+from collections import deque
+from struct import pack, unpack, unpack_from, calcsize, error as StructError
+from journal import Journal, DEFAULT_SEGMENT_SIZE
+from utils import Metrics, timed_acquire
 
 SOFT_LOG_MAX_SIZE = 16 * (1024**2) # 16 MB
+DEFAULT_COMPACT_RATIO = 2.0
+
+ROTATED_LOG_SUFFIX = re.compile(r'^[0-9]+\.[0-9]+$')
 
 TRX_CMD_PUSH = "\x00"
 TRX_CMD_POP = "\x01"
+TRX_CMD_POP_MANY = "\x02"
+TRX_CMD_OPEN = "\x03"
+TRX_CMD_CLOSE = "\x04"
+TRX_CMD_ABORT = "\x05"
+TRX_CMD_REOPEN = "\x06"
+TRX_CMD_PUSH_COMPRESSED = "\x07"
+TRX_CMD_OPEN_COMPRESSED = "\x08"
+TRX_CMD_CURSOR = "\x09"
+TRX_CMD_UNSUBSCRIBE = "\x0a"
+TRX_COMPRESSED_CMDS = (TRX_CMD_PUSH_COMPRESSED, TRX_CMD_OPEN_COMPRESSED)
+TRX_PUSH_CMDS = (TRX_CMD_PUSH, TRX_CMD_PUSH_COMPRESSED)
+TRX_XID_CMDS = (TRX_CMD_OPEN, TRX_CMD_CLOSE, TRX_CMD_ABORT, TRX_CMD_REOPEN)
+TRX_FANOUT_CMDS = (TRX_CMD_CURSOR, TRX_CMD_UNSUBSCRIBE)
 
 TRX_PUSH = "\x00%s%s"
 TRX_POP = "\x01"
+TRX_POP_MANY = "\x02%s"
+TRX_OPEN = "\x03%s%s"
+TRX_CLOSE = "\x04%s"
+TRX_ABORT = "\x05%s"
+TRX_REOPEN = "\x06%s"
+TRX_PUSH_COMPRESSED = "\x07%s%s"
+TRX_OPEN_COMPRESSED = "\x08%s%s"
+TRX_CURSOR = "\x09%s%s"
+TRX_UNSUBSCRIBE = "\x0a%s%s"
+TRX_PUSH_OVERHEAD = 5
+TRX_OPEN_OVERHEAD = 9
+TRX_CURSOR_OVERHEAD = 7
+# bytes of each record before its data, if any
+TRX_HEADER_SIZES = {TRX_CMD_PUSH: TRX_PUSH_OVERHEAD, TRX_CMD_PUSH_COMPRESSED: TRX_PUSH_OVERHEAD, TRX_CMD_POP: 1, TRX_CMD_POP_MANY: 5,
+                    TRX_CMD_OPEN: TRX_OPEN_OVERHEAD, TRX_CMD_OPEN_COMPRESSED: TRX_OPEN_OVERHEAD, TRX_CMD_CLOSE: 5, TRX_CMD_ABORT: 5,
+                    TRX_CMD_REOPEN: 5, TRX_CMD_CURSOR: TRX_CURSOR_OVERHEAD, TRX_CMD_UNSUBSCRIBE: TRX_CURSOR_OVERHEAD}
+# records end with the CRC-32 of the rest of the record, but in legacy logs
+TRX_CRC_FMT = "<I"
+TRX_CRC_SIZE = 4
+MAX_POP_RUN = 0xffffffff
+
+CHECKPOINT_FMT = "!QQ"
+# then the items open and aborted as of the checkpoint, and the cursors of
+# the subscribers, each list preceded by its length
+CHECKPOINT_COUNT_FMT = "!I"
+CHECKPOINT_ITEM_FMT = "!IQI"
+CHECKPOINT_CURSOR_FMT = "!IH"
+COMPACT_WRITE_SIZE = 1024**2 # bytes
+
+EXPIRY_PREFIX_SIZE = 8 # bytes of an item its expiry time is read from
+EXPIRE_BATCH = 10000 # items
+
+DEFAULT_COMPRESS_LEVEL = 1
+
+# bytes of a string held in memory and its slot in the deque, but its data
+STRING_OVERHEAD = sys.getsizeof('') + calcsize('P')
+COMPACT_INDEX_SIZE = 1024 # removed items, before the index arrays are shifted
 
 class TransactionLogError(Exception):
     pass
 
+def checksummed(*parts):
+    """
+    Returns the record made of ``parts`` followed by its CRC-32, copying
+    them once.
+    """
+    crc = 0
+    for part in parts:
+        crc = zlib.crc32(part, crc)
+    return ''.join(parts + (pack(TRX_CRC_FMT, crc & 0xffffffff),))
+
+class Compressed(str):
+    """
+    Data of an item held and logged compressed, but for its expiry prefix.
+    """
+
+def to_string(value):
+    """
+    Returns the data of ``value``, copied if it is a view of a chunk.
+    """
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return value
+
+class ChunkedStore(object):
+    """
+    Items held back to back in bytearray chunks of ``chunk_size`` bytes, or
+    of the size of a bigger item, instead of one string each, indexed by
+    arrays of chunk numbers, offsets and sizes. Items are returned as
+    memoryview slices of their chunk, but compressed ones which are copied.
+    Chunks are only appended to, and dropped once their items are removed,
+    so that views handed out stay valid.
+    """
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = deque()
+        self.first = 0 # number of the first chunk
+        self.fill = 0 # bytes used in the last chunk
+        self.allocated = 0
+        self.head = 0 # index of the first item
+        self.numbers = array('I')
+        self.starts = array('I')
+        self.sizes = array('I')
+        self.compressed = array('B')
+
+    def __len__(self):
+        return len(self.sizes) - self.head
+
+    def __getitem__(self, index):
+        i = self.head + index
+        if index < 0 or i >= len(self.sizes):
+            raise IndexError("store index out of range")
+        start = self.starts[i]
+        view = memoryview(self.chunks[self.numbers[i] - self.first])[start:start + self.sizes[i]]
+        if self.compressed[i]:
+            return Compressed(view.tobytes())
+        return view
+
+    def append(self, value):
+        size = len(value)
+        if not self.chunks or self.fill + size > len(self.chunks[-1]):
+            chunk = bytearray(max(self.chunk_size, size))
+            self.chunks.append(chunk)
+            self.allocated += len(chunk)
+            self.fill = 0
+        self.chunks[-1][self.fill:self.fill + size] = value
+        self.numbers.append(self.first + len(self.chunks) - 1)
+        self.starts.append(self.fill)
+        self.sizes.append(size)
+        self.compressed.append(isinstance(value, Compressed))
+        self.fill += size
+
+    def popleft(self):
+        value = self[0]
+        self.head += 1
+        if self.head < len(self.sizes):
+            first = self.numbers[self.head]
+        else:
+            # the last chunk is kept, to be filled up
+            first = self.first + len(self.chunks) - 1
+        while self.first < first:
+            self.allocated -= len(self.chunks.popleft())
+            self.first += 1
+        if self.head >= COMPACT_INDEX_SIZE and self.head * 2 >= len(self.sizes):
+            for index in (self.numbers, self.starts, self.sizes, self.compressed):
+                del index[:self.head]
+            self.head = 0
+        return value
+
+    def footprint(self):
+        """
+        Returns the bytes of memory held by the chunks and their index.
+        """
+        return self.allocated + sum([index.itemsize * len(index) for index in
+                                     (self.numbers, self.starts, self.sizes, self.compressed)])
+
+class ZlibCodec(object):
+    def __init__(self, level = DEFAULT_COMPRESS_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class MemoryBudget(object):
+    """
+    Amount of memory shared by the items held by a set of queues, a
+    ``limit`` of 0 meaning unlimited.
+    """
+    def __init__(self, limit = 0):
+        self.limit = limit
+        self.used = 0
+
+    def fits(self, size):
+        return not self.limit or self.used + size <= self.limit
+
 class PersistentQueue(Queue):
     """
     PersistentQueue is a subclass of Python synchronized class. It adds a 
     transactional log to the in-memory Queue, which enables quickly rebuilding
     the Queue in the event of a sever outage.
     """
-    def __init__(self, persistence_path, queue_name, debug = False):
+    def __init__(self, persistence_path, queue_name, debug = False, committer = None, memory_limit = 0, budget = None, metrics = None, expiry = None,
+                 compress_threshold = 0, codec = None, segment_size = DEFAULT_SEGMENT_SIZE, chunk_size = 0):
         """
         Create a new PersistentQueue at ``persistence_path/queue_name``.
         If a queue log exists at that path, the Queue will be loaded from
-        disk before being available for use.
+        disk before being available for use. The transaction log durability
+        is set by ``committer``, writes are only buffered by the OS without it.
+        Items past ``memory_limit`` bytes, or past the shared ``budget``, are
+        only kept in the transaction log until the head of the queue drains.
+        Lock waits and log writes are timed in ``metrics``. Items are indexed
+        by the expiry time that ``expiry`` reads from their first
+        ``EXPIRY_PREFIX_SIZE`` bytes, 0 meaning they never expire. Items of
+        ``compress_threshold`` bytes or more are compressed by ``encode``
+        with ``codec``, zlib by default. The transaction log is written in
+        segments of ``segment_size`` bytes. With a ``chunk_size``, items are
+        held in memory by a ``ChunkedStore`` of chunks of that size.
         """
         self.persistence_path = persistence_path
         self.queue_name = queue_name
+        self.committer = committer
+        self.memory_limit = memory_limit
+        self.budget = budget or MemoryBudget()
+        self.metrics = metrics or Metrics()
+        self.lock_wait = self.metrics.histogram('lock_transaction')
+        self.memory_bytes = 0
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
         self.transaction_lock = thread.allocate_lock()
+        self.maintenance_lock = thread.allocate_lock()
         self.total_items = 0
+        self.expired_items = 0
+        self.live_bytes = 0
+        self.expiry = expiry
+        self.compress_threshold = compress_threshold
+        self.codec = codec or ZlibCodec()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.opened = {}
+        self.released = deque()
+        self.xid = 0
+        self.replicas = []
+        # read position of each subscriber of a fanout queue, relative to
+        # its head, items being removed once every subscriber read them
+        self.cursors = {}
+        self.fanout_lock = thread.allocate_lock()
+        # (offset, count) of the last record if it pops items, so that
+        # following pops only update it
+        self.pop_run = None
+        self.waiters = deque()
         Queue.__init__(self, 0)
         self.initial_bytes = self._replay_transaction_log(debug)
     
-    def put(self, value, log = True):
+    def put(self, value, log = True, wait = True):
         """
         Pushes ``value`` to the queue. By default, ``put`` will write to the
         transactional log. Set ``log`` to ``False`` to override this behaviour.
+        Unless ``wait`` is ``False``, ``put`` returns once the log record is
+        as durable as the transaction log allows. Returns the sequence number
+        of the log record.
         """
+        sequence, offset = None, None
         if log:
             if not self.transaction_log:
                 raise TransactionLogError("No transaction log")
-            size = pack("I", len(value))
-            self._transaction(TRX_PUSH % (size, value))
-        self.total_items += 1
-        Queue.put(self, value)
+            sequence, offset = self._transaction(self._push_record(value))
+        Queue.put(self, (value, offset))
+        self._notify()
+        while self.cursors and self.waiters:
+            # every subscriber reads the item
+            self._notify()
+        if sequence and wait:
+            self.transaction_log.wait(sequence)
+        return sequence
         
     def get(self, log = True):
         """
@@ -52,67 +274,1048 @@ class PersistentQueue(Queue):
         """
         if log and not self.transaction_log:
             raise TransactionLogError("No transaction log")
+        if self.released:
+            values = self._take_released(1, log)
+            if values:
+                return values[0]
         value = Queue.get(self, log)
         if log:
-            self._transaction("\001")
+            self._transaction(self._pop_record(1), 1)
+        return value
+    
+    def get_many(self, count, log = True):
+        """
+        Retrieves up to ``count`` items without blocking. They are removed
+        at once and logged with a single transaction record, along with
+        the items popped just before.
+        """
+        if log and not self.transaction_log:
+            raise TransactionLogError("No transaction log")
+        released = self.released and self._take_released(count, log) or []
+        self.mutex.acquire()
+        try:
+            values = [self._get() for i in xrange(min(count - len(released), self._qsize()))]
+        finally:
+            self.mutex.release()
+        if log and values:
+            self._transaction(self._pop_record(len(values)), len(values))
+        return released + values
+    
+    def qsize(self):
+        """
+        Returns the number of items in the queue, aborted ones included.
+        """
+        return Queue.qsize(self) + len(self.released)
+    
+    def open_item(self, log = True):
+        """
+        Retrieves an item without blocking and holds it open until it is
+        closed or aborted. Aborted items are retrieved first. Returns its
+        transaction id and value, or ``None`` if the queue is empty.
+        """
+        if log and not self.transaction_log:
+            raise TransactionLogError("No transaction log")
+        self.mutex.acquire()
+        try:
+            if self.released:
+                xid, value = self.released.popleft()
+                record = self._xid_record(TRX_REOPEN, xid)
+            elif self._qsize():
+                value = self._get()
+                self.xid += 1
+                xid = self.xid
+                record = self._open_record(xid, value)
+            else:
+                return None
+            self.opened[xid] = value
+        finally:
+            self.mutex.release()
+        if log:
+            self._transaction(record)
+        return xid, value
+    
+    def close_item(self, xid, log = True):
+        """
+        Removes the open item ``xid`` for good.
+        """
+        if self.opened.pop(xid, None) is not None and log:
+            self._transaction(self._xid_record(TRX_CLOSE, xid))
+    
+    def abort_item(self, xid, log = True):
+        """
+        Puts the open item ``xid`` back at the head of the queue. Returns its
+        size in bytes, or ``None`` if it was not open.
+        """
+        value = self.opened.pop(xid, None)
+        if value is None:
+            return None
+        # logged first, so that the abort precedes any later use of xid
+        if log:
+            self._transaction(self._xid_record(TRX_ABORT, xid))
+        self.mutex.acquire()
+        try:
+            self.released.appendleft((xid, value))
+        finally:
+            self.mutex.release()
+        self._notify()
+        return len(value)
+    
+    def expire(self, now, log = True, limit = EXPIRE_BATCH):
+        """
+        Removes up to ``limit`` items from the head of the queue that expired
+        before ``now``, and logs their removal with a single record. Returns
+        how many items were removed and their size in bytes.
+        """
+        try:
+            expiry = self.expiries[0][0]
+        except IndexError:
+            return 0, 0
+        if not expiry or expiry >= now:
+            return 0, 0
+        if log and not self.transaction_log:
+            raise TransactionLogError("No transaction log")
+        # subscribers' cursors move back as logged
+        self.fanout_lock.acquire()
+        try:
+            return self._expire(now, log, limit)
+        finally:
+            self.fanout_lock.release()
+    
+    def _expire(self, now, log, limit):
+        self.mutex.acquire()
+        try:
+            count = 0
+            for expiry, items in self.expiries:
+                if not expiry or expiry >= now or count >= limit:
+                    break
+                count += items
+            count = min(count, limit)
+            size = 0
+            for i in xrange(count):
+                size += self._discard()
+            self.expired_items += count
+            self._shift_cursors(count)
+            self._page_ins()
+        finally:
+            self.mutex.release()
+        if log and count:
+            self._transaction(self._pop_record(count), count)
+        return count, size
+    
+    def encode(self, value):
+        """
+        Returns ``value`` as it is to be put onto the queue, compressed if
+        it is big enough and compression saves space.
+        """
+        if not self.compress_threshold or len(value) < self.compress_threshold:
+            return value
+        data = Compressed(value[:EXPIRY_PREFIX_SIZE] + self.codec.compress(value[EXPIRY_PREFIX_SIZE:]))
+        if len(data) >= len(value):
+            return value
+        self.mutex.acquire()
+        try:
+            self.raw_bytes += len(value)
+            self.compressed_bytes += len(data)
+        finally:
+            self.mutex.release()
+        return data
+    
+    def decode(self, value):
+        """
+        Returns ``value``, as retrieved from the queue, decompressed.
+        """
+        if isinstance(value, Compressed):
+            return value[:EXPIRY_PREFIX_SIZE] + self.codec.decompress(value[EXPIRY_PREFIX_SIZE:])
         return value
     
+    def subscribe(self, subscriber, log = True):
+        """
+        Makes this a fanout queue, each item put from then on being read by
+        ``subscriber`` as well as every other subscriber. The first one
+        also reads the items already queued. Returns ``False`` if it was
+        subscribed already.
+        """
+        if self.cursors.has_key(subscriber):
+            return False
+        self.fanout_lock.acquire()
+        try:
+            self.mutex.acquire()
+            try:
+                if self.cursors.has_key(subscriber):
+                    return False
+                cursor = self.cursors and self._qsize() or 0
+                self.cursors[subscriber] = cursor
+            finally:
+                self.mutex.release()
+            if log:
+                self._transaction(self._cursor_record(subscriber, cursor))
+            return True
+        finally:
+            self.fanout_lock.release()
+    
+    def read(self, subscriber, count = 1, log = True):
+        """
+        Returns up to ``count`` items ``subscriber`` did not read yet, and
+        the size in bytes of the items removed as every subscriber read
+        them. Items are shared by the subscribers, not copied.
+        """
+        self.fanout_lock.acquire()
+        try:
+            self.mutex.acquire()
+            try:
+                cursor = self.cursors.get(subscriber)
+                if cursor is None:
+                    return [], 0
+                values = [self._peek(i) for i in xrange(cursor, min(cursor + count, self._qsize()))]
+                self.cursors[subscriber] = cursor + len(values)
+                removed = min(self.cursors.values())
+                size = 0
+                for i in xrange(removed):
+                    size += self._discard()
+                self._shift_cursors(removed)
+                self._page_ins()
+            finally:
+                self.mutex.release()
+            if log and values:
+                self._transaction(self._cursor_record(subscriber, len(values)))
+            if log and removed:
+                self._transaction(self._pop_record(removed), removed)
+            return values, size
+        finally:
+            self.fanout_lock.release()
+    
+    def unsubscribe(self, subscriber, log = True):
+        """
+        Stops ``subscriber`` reading this fanout queue, removing the items
+        every other subscriber read already. Returns their size in bytes,
+        or ``None`` if it was not subscribed.
+        """
+        self.fanout_lock.acquire()
+        try:
+            self.mutex.acquire()
+            try:
+                if self.cursors.pop(subscriber, None) is None:
+                    return None
+                removed = self.cursors and min(self.cursors.values()) or 0
+                size = 0
+                for i in xrange(removed):
+                    size += self._discard()
+                self._shift_cursors(removed)
+                self._page_ins()
+            finally:
+                self.mutex.release()
+            if log:
+                self._transaction(self._unsubscribe_record(subscriber))
+            if log and removed:
+                self._transaction(self._pop_record(removed), removed)
+            return size
+        finally:
+            self.fanout_lock.release()
+    
+    def unread(self, subscriber):
+        """
+        Returns how many items ``subscriber`` did not read yet.
+        """
+        return max(0, self._qsize() - self.cursors.get(subscriber, self._qsize()))
+    
+    def idle(self):
+        """
+        Tells if the queue holds no item, open or not, and nobody waits
+        for one.
+        """
+        return not self.qsize() and not self.opened and not self.waiters
+    
+    def memory_per_item(self):
+        """
+        Returns the bytes of memory held per item in memory, overhead
+        included.
+        """
+        if not self.queue:
+            return 0
+        if self.chunk_size:
+            return self.queue.footprint() / len(self.queue)
+        return self.memory_bytes / len(self.queue) + STRING_OVERHEAD
+    
+    def add_waiter(self, callback):
+        """
+        Registers ``callback`` to be called once, when an item is put onto
+        the queue. A callback is not guaranteed to find the item.
+        """
+        self.waiters.append(callback)
+    
+    def remove_waiter(self, callback):
+        """
+        Unregisters ``callback`` if it has not been called yet.
+        """
+        try:
+            self.waiters.remove(callback)
+        except ValueError:
+            pass
+    
     def close(self):
         """
         Safely closes the transactional queue.
         """
         self.transaction_lock.acquire()
-        not_trx = self.transaction_log
-        self.transaction_log = None
-        not_trx.close()
+        try:
+            not_trx = self.transaction_log
+            self.transaction_log = None
+            not_trx.close()
+        finally:
+            # maintenance of a removed queue fails instead of blocking
+            self.transaction_lock.release()
+        self.budget.used -= self.memory_bytes
     
-    def _rotate_log(self):
-        self.transaction_log.close()
-        os.rename(self._log_path(), "%s.%s" % (self._log_path(), time.time()))
-        self._open_log()
+    def size(self):
+        """
+        Returns the size in bytes of the items in the queue, aborted ones
+        included.
+        """
+        return self.live_bytes + sum([len(value) for xid, value in self.released])
     
-    def _log_path(self):
+    def remove(self):
+        """
+        Closes the queue and removes its transaction log.
+        """
+        self.close()
+        if os.path.exists(self._log_path()):
+            shutil.rmtree(self._log_path())
+        if os.path.exists(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+        self._remove_rotated_logs()
+    
+    def sync(self, sequence = None):
+        """
+        Makes every logged transaction durable, or waits for those up to
+        ``sequence`` to be.
+        """
+        if not self.transaction_log:
+            return
+        if sequence:
+            self.transaction_log.wait(sequence)
+        else:
+            self.transaction_log.sync()
+    
+    def needs_compaction(self, size = SOFT_LOG_MAX_SIZE, ratio = DEFAULT_COMPACT_RATIO):
+        """
+        Tells if the transaction log is bigger than ``size`` bytes and
+        ``ratio`` times bigger than the live items it holds.
+        """
+        live_size = self.live_bytes + TRX_PUSH_OVERHEAD * self.qsize()
+        log_size = self.log_bytes()
+        return log_size > size and log_size > live_size * ratio
+    
+    def log_bytes(self):
+        """
+        Returns the size in bytes of the transaction log segments.
+        """
+        log = self.transaction_log
+        return log and log.size() or 0
+    
+    def compact(self):
+        """
+        Rewrites the transaction log with only the live items while puts
+        and gets keep flowing, then atomically swaps it in.
+        """
+        self.maintenance_lock.acquire()
+        try:
+            end = self._synced_log_size()
+            logging.debug("Compacting transaction log for %s" % self.queue_name)
+            if os.path.exists(self._compact_path()):
+                shutil.rmtree(self._compact_path())
+            compacted = Journal(self._compact_path(), segment_size=self.segment_size)
+            log = self.transaction_log.view(end)
+            try:
+                offsets = self._write_records(compacted, self._compacted_records(log, self.checkpoint_head, self.checkpoint_tail, end,
+                                                                                 state=self.checkpoint_state))
+                self.transaction_lock.acquire()
+                try:
+                    self.transaction_log.sync()
+                    shift = compacted.end - end
+                    tail = self.transaction_log.view(self.log_size)
+                    try:
+                        compacted.append(tail[end:self.log_size])
+                    finally:
+                        tail.close()
+                    compacted.fsync()
+                    compacted.close()
+                    if os.path.exists(self._checkpoint_path()):
+                        os.remove(self._checkpoint_path())
+                    self.checkpoint_head, self.checkpoint_tail, self.checkpoint_state = 0, 0, ({}, [], {})
+                    self.mutex.acquire()
+                    try:
+                        self.transaction_log.replace(self._compact_path())
+                        self.spilled = deque([(offset < end and offsets[offset] or offset + shift, size) for offset, size in self.spilled])
+                    finally:
+                        self.mutex.release()
+                    self.log_size = self.transaction_log.end
+                    self.pop_run = None
+                finally:
+                    self.transaction_lock.release()
+            finally:
+                log.close()
+                compacted.close()
+            self._remove_rotated_logs()
+            logging.debug("Compacting transaction log is done.")
+        finally:
+            self.maintenance_lock.release()
+    
+    def replicate(self, replica):
+        """
+        Calls ``replica(name, records, True)`` with records rebuilding the
+        queue as it is logged, then ``replica(name, records, False)`` with
+        every record logged from then on, in the order of the log.
+        """
+        self.maintenance_lock.acquire()
+        try:
+            self.transaction_lock.acquire()
+            try:
+                if not self.transaction_log:
+                    raise TransactionLogError("No transaction log")
+                self.transaction_log.sync()
+                log = self.transaction_log.view(self.log_size)
+                try:
+                    records = [record for offset, record in self._compacted_records(log, self.checkpoint_head, self.checkpoint_tail,
+                                                                                     state=self.checkpoint_state)]
+                finally:
+                    log.close()
+                replica(self.queue_name, ''.join(records), True)
+                self.replicas.append(replica)
+            finally:
+                self.transaction_lock.release()
+        finally:
+            self.maintenance_lock.release()
+    
+    def unreplicate(self, replica):
+        """
+        Stops calling ``replica`` with the logged records.
+        """
+        self.transaction_lock.acquire()
+        try:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+        finally:
+            self.transaction_lock.release()
+    
+    def apply(self, records):
+        """
+        Logs ``records`` shipped by a replicated queue and applies them to
+        this one. Returns how many items were pushed and by how many bytes
+        the items of the queue grew.
+        """
+        stops = []
+        parsed = list(self._read_records(records, stops = stops))
+        if stops[0] < len(records):
+            logging.error("Dropping %d bytes of invalid records shipped for %s" % (len(records) - stops[0], self.queue_name))
+            records = records[:stops[0]]
+        pops = 0
+        if len(parsed) == 1 and parsed[0][1] == TRX_CMD_POP_MANY:
+            pops = parsed[0][2]
+        sequence, base = self._transaction(records, pops)
+        pushed, size = 0, 0
+        self.mutex.acquire()
+        try:
+            for offset, cmd, argument in parsed:
+                if cmd == TRX_CMD_PUSH:
+                    self._put((argument, base + offset))
+                    pushed += 1
+                    size += len(argument)
+                elif cmd == TRX_CMD_OPEN:
+                    xid, value = argument
+                    if self._qsize():
+                        size -= self._discard()
+                    self.opened[xid] = value
+                    self.xid = max(self.xid, xid)
+                elif cmd == TRX_CMD_ABORT:
+                    value = self.opened.pop(argument, None)
+                    if value is not None:
+                        self.released.appendleft((argument, value))
+                        size += len(value)
+                elif cmd == TRX_CMD_CURSOR:
+                    subscriber, count = argument
+                    self.cursors[subscriber] = self.cursors.get(subscriber, 0) + count
+                elif cmd == TRX_CMD_UNSUBSCRIBE:
+                    self.cursors.pop(argument[0], None)
+                elif cmd == TRX_CMD_REOPEN or cmd == TRX_CMD_CLOSE:
+                    for i, (xid, value) in enumerate(self.released):
+                        if xid == argument:
+                            del self.released[i]
+                            size -= len(value)
+                            if cmd == TRX_CMD_REOPEN:
+                                self.opened[xid] = value
+                            break
+                    else:
+                        if cmd == TRX_CMD_CLOSE:
+                            self.opened.pop(argument, None)
+                else:
+                    for i in xrange(min(argument, self._qsize())):
+                        size -= self._discard()
+                    self._shift_cursors(argument)
+            self._page_ins()
+        finally:
+            self.mutex.release()
+        self._notify()
+        return pushed, size
+    
+    def release_opened(self):
+        """
+        Puts every open item back at the head of the queue, as when it is
+        replayed. Returns their size in bytes.
+        """
+        size = 0
+        for xid in sorted(self.opened, reverse=True):
+            size += self.abort_item(xid) or 0
+        return size
+    
+    def checkpoint(self):
+        """
+        Records the offset of the oldest live item in the transaction log,
+        so that replaying it can skip every record before it, along with
+        the open and aborted items and the cursors of subscribers, and
+        removes the log segments before all of them.
+        """
+        self.maintenance_lock.acquire()
+        try:
+            end = self._synced_log_size()
+            if end == self.checkpoint_tail:
+                return
+            state = self._copy_state(self.checkpoint_state)
+            log = self.transaction_log.view(end)
+            try:
+                # as replayed, pops of an empty queue pop nothing
+                live, pops = 0, 0
+                for offset, cmd, argument in self._read_records(log, self.checkpoint_head, end, False):
+                    if cmd == TRX_CMD_PUSH:
+                        live += 1
+                    elif offset >= self.checkpoint_tail:
+                        popped = min(live, self._replay_record(state, offset, cmd, argument))
+                        live -= popped
+                        pops += popped
+                head = end
+                for offset, cmd, argument in self._read_records(log, self.checkpoint_head, end, False):
+                    if cmd == TRX_CMD_PUSH:
+                        if not pops:
+                            head = offset
+                            break
+                        pops -= 1
+            finally:
+                log.close()
+            self._write_checkpoint(head, end, state)
+            self.checkpoint_head, self.checkpoint_tail, self.checkpoint_state = head, end, state
+            # fully consumed segments are dropped as they are, but those
+            # holding open and aborted items
+            opened, released, cursors = state
+            items = opened.values() + [item for xid, item in released]
+            self.transaction_log.remove_before(min([head] + [offset - TRX_OPEN_OVERHEAD for offset, size in items]))
+        finally:
+            self.maintenance_lock.release()
+    
+    def _synced_log_size(self):
+        self.transaction_lock.acquire()
+        try:
+            if not self.transaction_log:
+                raise TransactionLogError("No transaction log")
+            self.transaction_log.sync()
+            # records read up to there must not change anymore
+            self.pop_run = None
+            return self.log_size
+        finally:
+            self.transaction_lock.release()
+    
+    def _legacy_log_path(self):
         return os.path.join(self.persistence_path, self.queue_name)
     
+    def _log_path(self):
+        return "%s.log" % self._legacy_log_path()
+    
+    def _compact_path(self):
+        return "%s.compact" % self._legacy_log_path()
+    
+    def _migrate_path(self):
+        return "%s.migrate" % self._legacy_log_path()
+    
+    def _checkpoint_path(self):
+        return "%s.checkpoint" % self._legacy_log_path()
+    
+    def _remove_rotated_logs(self):
+        prefix = "%s." % self.queue_name
+        for name in os.listdir(self.persistence_path):
+            if name.startswith(prefix) and ROTATED_LOG_SUFFIX.match(name[len(prefix):]):
+                os.remove(os.path.join(self.persistence_path, name))
+    
+    def _notify(self):
+        try:
+            callback = self.waiters.popleft()
+        except IndexError:
+            return
+        callback()
+    
     def _open_log(self):
-        self.transaction_log = os.fdopen(os.open(self._log_path(), os.O_RDWR|os.O_CREAT), "rb+")
-        self.log_size = os.path.getsize(self._log_path())
-        
-    def _replay_transaction_log(self, debug = False):
-        self._open_log()
-        bytes_read = 0
-        logging.debug("Reading back transaction log for %s" % self.queue_name)
+        for path in (self._compact_path(), self._migrate_path()):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        if os.path.isfile(self._legacy_log_path()):
+            self._migrate_log()
+        self.transaction_log = Journal(self._log_path(), self.committer, self.metrics, self.segment_size)
+        self.log_size = self.transaction_log.end
     
-        while True:
-            cmd = self.transaction_log.read(1)
-            if not cmd:
-                break;
-            if cmd == TRX_CMD_PUSH:
-                raw_size = self.transaction_log.read(4)
-                size = unpack("I", raw_size)
-                data = self.transaction_log.read(size[0])
-                if not data:
+    def _migrate_log(self):
+        """
+        Rewrites the items of a legacy log file, without segments nor
+        checksums, as a new transaction log and removes it.
+        """
+        logging.info("Migrating transaction log for %s" % self.queue_name)
+        migrated = Journal(self._migrate_path(), segment_size=self.segment_size)
+        source = open(self._legacy_log_path(), "rb")
+        log = self._map(source)
+        try:
+            head, tail, state = self._read_checkpoint(len(log))
+            self._write_records(migrated, self._compacted_records(log, head, tail, legacy=True, state=state))
+        finally:
+            if log:
+                log.close()
+            source.close()
+            migrated.close()
+        os.rename(self._migrate_path(), self._log_path())
+        # the checkpoint goes first, its offsets are those of the legacy log
+        if os.path.exists(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+        os.remove(self._legacy_log_path())
+    
+    def _read_checkpoint(self, log_size):
+        """
+        Returns the head and tail offsets of the checkpoint, and the open
+        and aborted items and cursors of subscribers as of its tail.
+        """
+        state = ({}, [], {})
+        try:
+            checkpoint = open(self._checkpoint_path(), "rb")
+            try:
+                data = checkpoint.read()
+            finally:
+                checkpoint.close()
+            head, tail = unpack_from(CHECKPOINT_FMT, data)
+            position = calcsize(CHECKPOINT_FMT)
+            if position < len(data):
+                opened, released, cursors = state
+                for items in (opened, released):
+                    count, = unpack_from(CHECKPOINT_COUNT_FMT, data, position)
+                    position += calcsize(CHECKPOINT_COUNT_FMT)
+                    for i in xrange(count):
+                        xid, offset, size = unpack_from(CHECKPOINT_ITEM_FMT, data, position)
+                        position += calcsize(CHECKPOINT_ITEM_FMT)
+                        if offset + size > tail:
+                            raise StructError("item past the checkpoint")
+                        if items is opened:
+                            opened[xid] = (offset, size)
+                        else:
+                            released.append((xid, (offset, size)))
+                count, = unpack_from(CHECKPOINT_COUNT_FMT, data, position)
+                position += calcsize(CHECKPOINT_COUNT_FMT)
+                for i in xrange(count):
+                    cursor, length = unpack_from(CHECKPOINT_CURSOR_FMT, data, position)
+                    position += calcsize(CHECKPOINT_CURSOR_FMT)
+                    cursors[data[position:position + length]] = cursor
+                    position += length
+        except (IOError, StructError):
+            return 0, 0, ({}, [], {})
+        if head > tail or tail > log_size:
+            logging.warning("Ignoring invalid checkpoint for %s" % self.queue_name)
+            return 0, 0, ({}, [], {})
+        return head, tail, state
+    
+    def _write_checkpoint(self, head, tail, state):
+        opened, released, cursors = state
+        data = [pack(CHECKPOINT_FMT, head, tail), pack(CHECKPOINT_COUNT_FMT, len(opened))]
+        for xid, (offset, size) in sorted(opened.items()):
+            data.append(pack(CHECKPOINT_ITEM_FMT, xid, offset, size))
+        data.append(pack(CHECKPOINT_COUNT_FMT, len(released)))
+        for xid, (offset, size) in released:
+            data.append(pack(CHECKPOINT_ITEM_FMT, xid, offset, size))
+        data.append(pack(CHECKPOINT_COUNT_FMT, len(cursors)))
+        for subscriber, cursor in sorted(cursors.items()):
+            data.append(pack(CHECKPOINT_CURSOR_FMT, cursor, len(subscriber)) + subscriber)
+        checkpoint = open(self._checkpoint_path() + ".tmp", "wb")
+        try:
+            checkpoint.write(''.join(data))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        finally:
+            checkpoint.close()
+        os.rename(self._checkpoint_path() + ".tmp", self._checkpoint_path())
+    
+    def _map(self, log):
+        size = os.fstat(log.fileno()).st_size
+        if not size:
+            return ''
+        return mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ)
+    
+    def _read_records(self, log, offset = 0, end = None, payloads = True, legacy = False, stops = None):
+        """
+        Yields ``(offset, command, argument)`` for each record of ``log``
+        between ``offset`` and ``end``, ``argument`` being the pushed data
+        (or its size unless ``payloads``), the number of popped items or
+        the subscriber and number of items its cursor moved by, 0 when it
+        unsubscribed.
+        Compressed pushes and opens are yielded as the plain commands.
+        Reading stops at the first truncated record or, but in ``legacy``
+        logs, at the first one failing its checksum. The offset it stopped
+        at is appended to ``stops``, if given.
+        """
+        if end is None:
+            end = len(log)
+        trailer = not legacy and TRX_CRC_SIZE or 0
+        try:
+            while offset < end:
+                cmd = log[offset]
+                header = TRX_HEADER_SIZES.get(cmd)
+                if header is None or (cmd == TRX_CMD_POP and not legacy):
+                    if not legacy:
+                        logging.warning("Error reading transaction log: I don't understand '%s' (stopping)." % cmd)
+                        return
+                    logging.warning("Error reading transaction log: I don't understand '%s' (skipping)." % cmd)
+                    offset += 1
                     continue
-                self.put(data, False)
-                bytes_read += len(data)
-            elif cmd == TRX_CMD_POP:
-                bytes_read -= len(self.get(False))
+                if offset + header > end:
+                    return
+                size = 0
+                if cmd == TRX_CMD_POP:
+                    argument = 1
+                elif header == TRX_OPEN_OVERHEAD:
+                    argument, size = unpack("II", log[offset + 1:offset + header])
+                elif cmd in TRX_FANOUT_CMDS:
+                    argument, size = unpack("IH", log[offset + 1:offset + header])
+                else:
+                    argument = unpack("I", log[offset + 1:offset + header])[0]
+                    if cmd in TRX_PUSH_CMDS:
+                        size = argument
+                        if legacy:
+                            size = min(size, end - offset - header)
+                length = header + size + trailer
+                if offset + length > end:
+                    return
+                if trailer and unpack(TRX_CRC_FMT, log[offset + length - trailer:offset + length])[0] != \
+                        zlib.crc32(log[offset:offset + length - trailer]) & 0xffffffff:
+                    logging.warning("Error reading transaction log: bad checksum at offset %d (stopping)." % offset)
+                    return
+                if cmd in TRX_PUSH_CMDS:
+                    if size:
+                        if payloads:
+                            yield offset, TRX_CMD_PUSH, self._item(log, offset + header, size)
+                        else:
+                            yield offset, TRX_CMD_PUSH, size
+                elif header == TRX_OPEN_OVERHEAD:
+                    if payloads:
+                        yield offset, TRX_CMD_OPEN, (argument, self._item(log, offset + header, size, header))
+                    else:
+                        yield offset, TRX_CMD_OPEN, (argument, size)
+                elif cmd in TRX_FANOUT_CMDS:
+                    yield offset, cmd, (log[offset + header:offset + header + size], argument)
+                else:
+                    yield offset, cmd, argument
+                offset += length
+        finally:
+            if stops is not None:
+                stops.append(offset)
+    
+    def _replay_records(self, log, head, tail, end = None, legacy = False, stops = None, state = None):
+        """
+        Replays the records of ``log`` from offset ``head``, skipping those
+        before ``tail`` but pushes, their effect being in the ``state`` of
+        the checkpoint. Returns the ``(offset, size)`` of the data of the
+        queued items, of the open ones by transaction id, and of the
+        aborted ones as ``(xid, (offset, size))`` head first, along with
+        the cursors of the subscribers.
+        """
+        records = deque()
+        state = self._copy_state(state or ({}, [], {}))
+        for offset, cmd, argument in self._read_records(log, head, end, False, legacy, stops):
+            if cmd == TRX_CMD_PUSH:
+                records.append((offset + TRX_PUSH_OVERHEAD, argument))
+            elif offset >= tail:
+                self._pop_records(records, cmd, self._replay_record(state, offset, cmd, argument))
+        opened, released, cursors = state
+        return records, opened, released, cursors
+    
+    def _replay_record(self, state, offset, cmd, argument):
+        """
+        Applies the record at ``offset``, but a push, to the open items, the
+        aborted ones and the cursors of ``state``. Returns how many queued
+        items it pops.
+        """
+        opened, released, cursors = state
+        if cmd == TRX_CMD_OPEN:
+            xid, size = argument
+            opened[xid] = (offset + TRX_OPEN_OVERHEAD, size)
+            return 1
+        elif cmd == TRX_CMD_ABORT:
+            if opened.has_key(argument):
+                released.insert(0, (argument, opened.pop(argument)))
+        elif cmd == TRX_CMD_CURSOR:
+            subscriber, count = argument
+            cursors[subscriber] = cursors.get(subscriber, 0) + count
+        elif cmd == TRX_CMD_UNSUBSCRIBE:
+            cursors.pop(argument[0], None)
+        elif cmd == TRX_CMD_REOPEN or cmd == TRX_CMD_CLOSE:
+            for i, (xid, item) in enumerate(released):
+                if xid == argument:
+                    del released[i]
+                    if cmd == TRX_CMD_REOPEN:
+                        opened[xid] = item
+                    break
             else:
-                logging.warning("Error reading transaction log: I don't understand '%s' (skipping)." % cmd)
-        logging.debug("Reading back transaction log is done.")
-        return bytes_read
+                if cmd == TRX_CMD_CLOSE:
+                    opened.pop(argument, None)
+        else:
+            for subscriber in cursors:
+                cursors[subscriber] = max(0, cursors[subscriber] - argument)
+            return argument
+        return 0
+    
+    def _copy_state(self, state):
+        opened, released, cursors = state
+        return dict(opened), list(released), dict(cursors)
+    
+    def _compacted_records(self, log, head, tail, end = None, legacy = False, state = None):
+        """
+        Yields the records rebuilding the queue as logged up to ``end``,
+        replayed from the checkpoint at ``head`` and ``tail`` and its
+        ``state``, with the offset of the data of pushed items.
+        """
+        live, opened, released, cursors = self._replay_records(log, head, tail, end, legacy, state=state)
+        # open and aborted items first, their OPEN records pop nothing from
+        # the then empty queue
+        for xid, (offset, size) in sorted(opened.items()) + list(reversed(released)):
+            yield None, self._open_record(xid, self._item(log, offset, size, TRX_OPEN_OVERHEAD))
+        for xid, item in reversed(released):
+            yield None, self._xid_record(TRX_ABORT, xid)
+        for offset, size in live:
+            yield offset, self._push_record(self._item(log, offset, size))
+        for subscriber, cursor in sorted(cursors.items()):
+            yield None, self._cursor_record(subscriber, cursor)
+    
+    def _item(self, log, offset, size, overhead = TRX_PUSH_OVERHEAD):
+        """
+        Returns the data at ``offset`` in ``log``, of the record starting
+        ``overhead`` bytes before.
+        """
+        data = log[offset:offset + size]
+        if log[offset - overhead] in TRX_COMPRESSED_CMDS:
+            return Compressed(data)
+        return data
+    
+    def _write_records(self, journal, records):
+        """
+        Appends ``records``, as yielded by ``_compacted_records``, to
+        ``journal`` in large writes and fsyncs it. Returns the new offset of
+        the data of each pushed item by the former one.
+        """
+        offsets = {}
+        chunk = []
+        position = journal.end
+        for offset, record in records:
+            if offset is not None:
+                offsets[offset] = position + TRX_PUSH_OVERHEAD
+            chunk.append(record)
+            position += len(record)
+            if position - journal.end >= COMPACT_WRITE_SIZE:
+                journal.append(''.join(chunk))
+                chunk = []
+        journal.append(''.join(chunk))
+        journal.fsync()
+        return offsets
+    
+    def _push_record(self, value):
+        cmd = isinstance(value, Compressed) and TRX_CMD_PUSH_COMPRESSED or TRX_CMD_PUSH
+        return checksummed(cmd + pack("I", len(value)), value)
+    
+    def _open_record(self, xid, value):
+        cmd = isinstance(value, Compressed) and TRX_CMD_OPEN_COMPRESSED or TRX_CMD_OPEN
+        return checksummed(cmd + pack("II", xid, len(value)), to_string(value))
+    
+    def _pop_record(self, count):
+        return checksummed(TRX_POP_MANY % pack("I", count))
+    
+    def _xid_record(self, record, xid):
+        return checksummed(record % pack("I", xid))
+    
+    def _cursor_record(self, subscriber, count):
+        return checksummed(TRX_CURSOR % (pack("IH", count, len(subscriber)), subscriber))
+    
+    def _unsubscribe_record(self, subscriber):
+        return checksummed(TRX_UNSUBSCRIBE % (pack("IH", 0, len(subscriber)), subscriber))
+    
+    def _pop_records(self, records, cmd, count):
+        for i in xrange(min(count, len(records))):
+            records.popleft()
+        
+    def _replay_transaction_log(self, debug = False):
+        start = time.time()
+        self._open_log()
+        head, tail, self.checkpoint_state = self._read_checkpoint(self.log_size)
+        # segments before the checkpoint may be gone
+        self.checkpoint_head = max(head, self.transaction_log.segments[0])
+        self.checkpoint_tail = max(tail, self.checkpoint_head)
+        logging.debug("Reading back transaction log for %s from offset %d" % (self.queue_name, self.checkpoint_head))
+        log = self.transaction_log.view()
+        stops = []
+        records, opened, released, self.cursors = self._replay_records(log, self.checkpoint_head, self.checkpoint_tail, stops = stops,
+                                                                       state = self.checkpoint_state)
+        valid_size = stops[0]
+        if valid_size < self.log_size:
+            # only valid records are mapped past the truncation
+            logging.warning("Truncating transaction log for %s at offset %d, dropping %d unreadable bytes" %
+                            (self.queue_name, valid_size, self.log_size - valid_size))
+            self.transaction_log.truncate(valid_size)
+            self.log_size = self.transaction_log.end
+            self.checkpoint_tail = min(self.checkpoint_tail, self.log_size)
+        # items left open by a previous run are given back
+        for xid in sorted(opened, reverse=True):
+            released.insert(0, (xid, opened[xid]))
+            self._transaction(self._xid_record(TRX_ABORT, xid))
+        for xid, (offset, size) in released:
+            self.released.append((xid, self._item(log, offset, size, TRX_OPEN_OVERHEAD)))
+            self.xid = max(self.xid, xid)
+        self.total_items += len(records)
+        self.live_bytes = sum([size for offset, size in records])
+        if self.expiry:
+            for offset, size in records:
+                self._index(self.expiry(log[offset:offset + min(size, EXPIRY_PREFIX_SIZE)]))
+        elif records:
+            self.expiries.append([0, len(records)])
+        while records and self._fits(records[0][1]):
+            offset, size = records.popleft()
+            self._hold(self._item(log, offset, size))
+        self.spilled = records
+        log.close()
+        self.replay_time = time.time() - start
+        logging.debug("Reading back transaction log is done in %0.3fs." % self.replay_time)
+        return self.size()
         
-    def _transaction(self, data):
+    def _transaction(self, data, pops = 0):
+        """
+        Logs ``data``, which pops ``pops`` items if it is a single record
+        doing so. Pops following each other are logged by updating the
+        count of the first record. Returns the sequence number and offset
+        of the record.
+        """
         if not self.transaction_log:
             raise TransactionLogError("No transaction log")
         
         try:
-            self.transaction_lock.acquire()
-            self.transaction_log.write(data)
-            self.transaction_log.flush()
-            self.log_size += len(data)
-            if self.log_size > SOFT_LOG_MAX_SIZE and self.qsize() == 0:
-                self._rotate_log()
+            timed_acquire(self.transaction_lock, self.lock_wait)
+            if not self.transaction_log:
+                raise TransactionLogError("No transaction log")
+            sequence = None
+            if pops and self.pop_run and self.pop_run[1] + pops <= MAX_POP_RUN:
+                offset, count = self.pop_run
+                sequence = self.transaction_log.amend(offset, self._pop_record(count + pops))
+                if sequence:
+                    self.pop_run = (offset, count + pops)
+            if not sequence:
+                offset = self.log_size
+                sequence = self.transaction_log.append(data)
+                self.log_size += len(data)
+                self.pop_run = pops and (offset, pops) or None
+            for replica in self.replicas:
+                replica(self.queue_name, data, False)
+            return sequence, offset
         finally:
             self.transaction_lock.release()
-
+    
+    def _take_released(self, count, log = True):
+        self.mutex.acquire()
+        try:
+            taken = [self.released.popleft() for i in xrange(min(count, len(self.released)))]
+        finally:
+            self.mutex.release()
+        if log and taken:
+            self._transaction(''.join([self._xid_record(TRX_CLOSE, xid) for xid, value in taken]))
+        return [value for xid, value in taken]
+    
+    def _init(self, maxsize):
+        if self.chunk_size:
+            self.queue = ChunkedStore(self.chunk_size)
+        else:
+            self.queue = deque()
+        self.spilled = deque()
+        # [expiry, count] of consecutive items expiring at the same second
+        self.expiries = deque()
+    
+    def _qsize(self, len = len):
+        return len(self.queue) + len(self.spilled)
+    
+    def _put(self, item):
+        value, offset = item
+        # counted here, under the queue mutex, not to lose concurrent updates
+        self.total_items += 1
+        self.live_bytes += len(value)
+        self._index(self.expiry and self.expiry(value) or 0)
+        if offset is not None and (self.spilled or not self._fits(len(value))):
+            self.spilled.append((offset + TRX_PUSH_OVERHEAD, len(value)))
+        else:
+            self._hold(value)
+    
+    def _get(self):
+        if not self.queue:
+            self._page_in()
+        value = self.queue[0]
+        self._discard()
+        self._page_ins()
+        return value
+    
+    def _discard(self):
+        head = self.expiries[0]
+        head[1] -= 1
+        if not head[1]:
+            self.expiries.popleft()
+        if self.queue:
+            size = len(self.queue.popleft())
+            self.memory_bytes -= size
+            self.budget.used -= size
+        else:
+            # spilled items are dropped without being read back
+            offset, size = self.spilled.popleft()
+        self.live_bytes -= size
+        return size
+    
+    def _index(self, expiry):
+        if self.expiries and self.expiries[-1][0] == expiry:
+            self.expiries[-1][1] += 1
+        else:
+            self.expiries.append([expiry, 1])
+    
+    def _fits(self, size):
+        if self.memory_limit and self.memory_bytes + size > self.memory_limit:
+            return False
+        return self.budget.fits(size)
+    
+    def _hold(self, value):
+        self.queue.append(value)
+        self.memory_bytes += len(value)
+        self.budget.used += len(value)
+    
+    def _page_in(self):
+        self._hold(self._read_item(*self.spilled.popleft()))
+    
+    def _read_item(self, offset, size):
+        if offset + size > self.transaction_log.written:
+            self.transaction_log.sync()
+        data = self.transaction_log.read(offset - TRX_PUSH_OVERHEAD, TRX_PUSH_OVERHEAD + size)
+        return self._item(data, TRX_PUSH_OVERHEAD, size)
+    
+    def _peek(self, index):
+        """
+        Returns the item at ``index`` from the head, spilled or not.
+        """
+        if index < len(self.queue):
+            return self.queue[index]
+        return self._read_item(*self.spilled[index - len(self.queue)])
+    
+    def _shift_cursors(self, count):
+        for subscriber in self.cursors:
+            self.cursors[subscriber] = max(0, self.cursors[subscriber] - count)
+    
+    def _page_ins(self):
+        while self.spilled and self._fits(self.spilled[0][1]):
+            self._page_in()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+import time, heapq, socket, select, errno, logging
+from collections import deque
+from handler import Protocol
+from worker import AsyncPeer
+
+POLL_TIMEOUT = 1.0
+ACCEPT_BACKOFF = 0.1 # seconds a listener isn't polled once out of file descriptors
+
+EVENT_READ = select.POLLIN | select.POLLPRI
+EVENT_WRITE = select.POLLOUT
+EVENT_ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+class Poller(object):
+    """
+    Thin wrapper around ``epoll`` (or ``poll`` when it is not available),
+    both sharing the same event flags. Timeouts are given in seconds.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def close(self):
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
+
+    def poll(self, timeout):
+        return self.poller.poll(timeout * self.scale)
+
+class Wait(object):
+    """
+    A blocking read of ``connection`` on the queue ``name``, resumed when
+    the queue wakes it or once ``deadline`` is reached. The connection
+    ignores resumptions of a wait that is over.
+    """
+    def __init__(self, connection, name, key, count, deadline, reliable):
+        self.connection = connection
+        self.name = name
+        self.key = key
+        self.count = count
+        self.deadline = deadline
+        self.reliable = reliable
+        self.registered = False # as a waiter of the queue
+        self.timer = connection.reactor.schedule(deadline, self.resume)
+
+    def wake(self):
+        self.registered = False
+        self.connection.reactor.call_soon(self.resume)
+
+    def resume(self):
+        self.connection._resume(self)
+
+class Connection(Protocol):
+    """
+    This is an internal class used by the Reactor to handle the MemCache
+    protocol for one non-blocking client socket. Responses are buffered
+    until the socket is writable.
+    """
+    # the Reactor syncs writes once per loop iteration
+    sync_writes = False
+
+    def __init__(self, socket, reactor, router = None, counted = True):
+        Protocol.__init__(self, reactor.queue_collection, reactor.stats, router, counted)
+        self.socket = socket
+        self.fd = socket.fileno()
+        self.reactor = reactor
+        self.waiting = None
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def handle_read(self):
+        try:
+            received = self._recv_into(self.socket)
+            if received:
+                self._process_input()
+        except socket.error, (value, message):
+            if value in (errno.EAGAIN, errno.EINTR):
+                return
+            return self.close()
+        except MemoryError:
+            # only this connection is dropped, not the loop
+            logging.error("Out of memory for the input of a connection")
+            return self.close()
+        if not received or self.closing:
+            return self.close()
+
+    def handle_write(self):
+        start = time.time()
+        try:
+            sent = self.socket.send(self.output)
+        except socket.error, (value, message):
+            if value in (errno.EAGAIN, errno.EINTR):
+                return
+            return self.close()
+        self.metrics.histogram('send').record(time.time() - start)
+        if sent < len(self.output):
+            del self.output[:sent]
+        else:
+            self.output = bytearray()
+            self.reactor.want_write(self, False)
+
+    def close(self):
+        if self.closing and self.output:
+            try:
+                self.socket.send(self.output)
+            except socket.error:
+                pass
+        self.closed = True
+        if self.waiting:
+            self._unpark()
+        self._abort_opened()
+        self._close_peers()
+        self.reactor.remove(self)
+        self.socket.close()
+
+    def _write(self, response):
+        if not self.output:
+            self.reactor.want_write(self, True)
+        self.output += response
+
+    def _wait(self, name, key, count, deadline, reliable = False):
+        self.parked = self.waiting = Wait(self, name, key, count, deadline, reliable)
+        self._park()
+
+    def _park(self):
+        wait = self.waiting
+        if wait.registered:
+            return
+        queue = self.queue_collection.get_queues(wait.name)
+        if queue:
+            queue.add_waiter(wait.wake)
+            wait.registered = True
+
+    def _unpark(self):
+        wait = self.waiting
+        if wait.registered:
+            queue = self.queue_collection.get_queues(wait.name)
+            if queue:
+                queue.remove_waiter(wait.wake)
+            wait.registered = False
+        self.reactor.cancel(wait.timer)
+        self.parked = self.waiting = None
+
+    def _resume(self, wait):
+        if wait is not self.waiting:
+            return
+        items = self._take(wait.name, wait.count, wait.reliable)
+        if not items and time.time() < wait.deadline:
+            self._park()
+            return
+        self._unpark()
+        self._respond_items(wait.key, items)
+        self._process_input()
+        if self.closing:
+            self.close()
+
+    def _forward(self, worker, request):
+        try:
+            peer = self._peer(worker)
+        except socket.error, e:
+            logging.error("Could not forward request to worker %d: %s" % (worker, e))
+            return self._forwarded(worker, None)
+        self.parked = True
+        peer.request(request, lambda response: self._resume_forward(worker, response))
+
+    def _resume_forward(self, worker, response):
+        if self.closed:
+            return
+        if response is None:
+            self.peers.pop(worker, None)
+        self.parked = None
+        self._forwarded(worker, response)
+        self._process_input()
+        if self.closing:
+            self.close()
+
+    def _gather(self, workers, request, responses):
+        if not workers:
+            return Protocol._gather(self, workers, request, responses)
+        try:
+            peer = self._peer(workers[0])
+        except socket.error, e:
+            logging.error("Could not gather stats of worker %d: %s" % (workers[0], e))
+            return self._gather(workers[1:], request, responses)
+        self.parked = True
+        peer.request(request, lambda response: self._resume_gather(workers, request, responses, response))
+
+    def _resume_gather(self, workers, request, responses, response):
+        if self.closed:
+            return
+        if response is None:
+            self.peers.pop(workers[0], None)
+        else:
+            responses.append(response)
+        self.parked = None
+        self._gather(workers[1:], request, responses)
+        if not self.parked:
+            self._process_input()
+            if self.closing:
+                self.close()
+
+    def _peer(self, worker):
+        if not self.peers.has_key(worker):
+            self.peers[worker] = AsyncPeer(self.router, worker, self.reactor)
+        return self.peers[worker]
+
+class Reactor(object):
+    """
+    This is an internal class used by Peafowl Server to multiplex every
+    client connection on a single thread with an event loop. Clients
+    accepted on the listening ``server`` socket are attached the ``router``,
+    those accepted on the ``local`` one are served by this process only.
+    """
+    def __init__(self, server, queue_collection, stats, router = None, local = None):
+        self.queue_collection = queue_collection
+        self.stats = stats
+        self.connections = {}
+        self.listeners = {}
+        self.timers = []
+        self.sequence = 0
+        self.ready = deque()
+        self.running = False
+        self.sync_time = queue_collection.metrics.histogram('sync')
+        self.poller = Poller()
+        self.listen(server, router)
+        if local:
+            self.listen(local, counted=False)
+
+    def run(self):
+        """
+        Process events until ``stop`` is called.
+        """
+        self.running = True
+        while self.running:
+            try:
+                events = self.poller.poll(self._timeout())
+            except (IOError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd in self.listeners:
+                    self._accept(*self.listeners[fd])
+                    continue
+                connection = self.connections.get(fd)
+                if not connection:
+                    continue
+                # responses are written before reading further commands, so
+                # that they are only sent once synced on the next iteration
+                if event & EVENT_WRITE:
+                    connection.handle_write()
+                if event & EVENT_READ and fd in self.connections:
+                    connection.handle_read()
+                if event & EVENT_ERROR and fd in self.connections:
+                    connection.close()
+            self._run_timers()
+            self._run_ready()
+            start = time.time()
+            self.queue_collection.sync()
+            self.sync_time.record(time.time() - start)
+        for connection in self.connections.values():
+            connection.close()
+        self.poller.close()
+
+    def stop(self):
+        self.running = False
+
+    def schedule(self, deadline, callback):
+        """
+        Calls ``callback`` from the loop once ``deadline`` is reached, unless
+        the timer returned is cancelled.
+        """
+        self.sequence += 1
+        timer = [deadline, self.sequence, callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def call_soon(self, callback):
+        """
+        Calls ``callback`` from the loop, once pending events are handled.
+        """
+        self.ready.append(callback)
+
+    def listen(self, server, router = None, counted = True):
+        server.setblocking(0)
+        self.listeners[server.fileno()] = (server, router, counted)
+        self.poller.register(server.fileno(), EVENT_READ)
+
+    def register(self, connection):
+        self.connections[connection.fileno()] = connection
+        self.poller.register(connection.fileno(), EVENT_READ)
+
+    def unregister(self, connection):
+        fd = connection.fileno()
+        if self.connections.pop(fd, None):
+            self.poller.unregister(fd)
+            return True
+        return False
+
+    def want_write(self, connection, enabled):
+        if enabled:
+            self.poller.modify(connection.fileno(), EVENT_READ | EVENT_WRITE)
+        else:
+            self.poller.modify(connection.fileno(), EVENT_READ)
+
+    def remove(self, connection):
+        if self.unregister(connection):
+            connection.counters['connections'] -= 1
+
+    def _timeout(self):
+        if self.ready:
+            return 0
+        while self.timers and not self.timers[0][2]:
+            heapq.heappop(self.timers)
+        if self.timers:
+            return max(0, min(POLL_TIMEOUT, self.timers[0][0] - time.time()))
+        return POLL_TIMEOUT
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, sequence, callback = heapq.heappop(self.timers)
+            if callback:
+                callback()
+
+    def _pause(self, server):
+        fd = server.fileno()
+        self.poller.unregister(fd)
+        self.schedule(time.time() + ACCEPT_BACKOFF, lambda: self.poller.register(fd, EVENT_READ))
+
+    def _run_ready(self):
+        for i in xrange(len(self.ready)):
+            self.ready.popleft()()
+
+    def _accept(self, server, router, counted):
+        while True:
+            try:
+                client, address = server.accept()
+            except socket.error, (value, message):
+                if value in (errno.EMFILE, errno.ENFILE):
+                    # the pending connection would wake the loop right away
+                    logging.warning("Too many open files or sockets")
+                    self._pause(server)
+                elif value not in (errno.EAGAIN, errno.EINTR):
+                    logging.error("Could not accept connection: %s" % message)
+                return
+            client.setblocking(0)
+            connection = Connection(client, self, router, counted)
+            self.register(connection)
+            connection.counters['connections'] += 1
+            connection.counters['total_connections'] += 1
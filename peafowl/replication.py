@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import time, errno, socket, logging, threading
+from collections import deque
+from struct import pack, unpack_from, calcsize
+
+RECV_SIZE = 64 * 1024
+HEARTBEAT_INTERVAL = 1.0 # seconds
+RECONNECT_DELAY = 1.0 # seconds
+MAX_BACKLOG = 64 * (1024**2) # bytes of records a follower may lag behind
+
+# frames are a header, the queue name and its records
+FRAME_FMT = "!cdHI" # kind, primary time, name length, records length
+FRAME_SIZE = calcsize(FRAME_FMT)
+FRAME_RECORDS = "R"
+FRAME_SNAPSHOT = "S"
+FRAME_HEARTBEAT = "H"
+# acknowledges the bytes of records applied by the follower
+ACK_FMT = "!Q"
+ACK_SIZE = calcsize(ACK_FMT)
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+class Replica(threading.Thread):
+    """
+    Streams the transaction log records of every queue of the primary to
+    one follower, starting with a snapshot of each queue. A follower lagging
+    more than ``MAX_BACKLOG`` bytes behind is dropped, it resynchronizes
+    once reconnected.
+    """
+    def __init__(self, socket, primary):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.socket = socket
+        self.primary = primary
+        self.frames = deque()
+        self.backlog = 0
+        self.shipped = 0
+        self.acked = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def ship(self, name, records, snapshot):
+        frame = pack(FRAME_FMT, snapshot and FRAME_SNAPSHOT or FRAME_RECORDS, time.time(), len(name), len(records)) + name + records
+        self.condition.acquire()
+        try:
+            if self.closed:
+                return
+            self.frames.append(frame)
+            self.shipped += len(records)
+            if not snapshot:
+                self.backlog += len(frame)
+                if self.backlog > MAX_BACKLOG:
+                    logging.warning("Dropping replication follower, %d bytes behind" % self.backlog)
+                    self.closed = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def lag(self):
+        """
+        Returns how many bytes of records the follower did not apply yet.
+        """
+        return self.shipped - self.acked
+
+    def run(self):
+        acker = threading.Thread(target=self._read_acks)
+        acker.setDaemon(True)
+        acker.start()
+        try:
+            try:
+                self.primary.queue_collection.replicate(self.ship)
+                while True:
+                    self.condition.acquire()
+                    try:
+                        if not self.frames and not self.closed:
+                            self.condition.wait(HEARTBEAT_INTERVAL)
+                        if self.closed:
+                            break
+                        frames = list(self.frames)
+                        self.frames.clear()
+                        self.backlog = 0
+                    finally:
+                        self.condition.release()
+                    if not frames:
+                        frames = [pack(FRAME_FMT, FRAME_HEARTBEAT, time.time(), 0, 0)]
+                    self.socket.sendall(''.join(frames))
+            except socket.error, e:
+                logging.info("Replication follower is gone: %s" % e)
+        finally:
+            self.close()
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self.primary.queue_collection.unreplicate(self.ship)
+        self.primary.remove(self)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+    def _read_acks(self):
+        data = ''
+        while not self.closed:
+            try:
+                chunk = self.socket.recv(RECV_SIZE)
+            except socket.error:
+                break
+            if not chunk:
+                break
+            data += chunk
+            count = len(data) / ACK_SIZE
+            if count:
+                self.acked = unpack_from(ACK_FMT, data, (count - 1) * ACK_SIZE)[0]
+                data = data[count * ACK_SIZE:]
+        self.close()
+
+class Primary(threading.Thread):
+    """
+    Accepts replication followers on ``host:port``.
+    """
+    def __init__(self, host, port, queue_collection):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue_collection = queue_collection
+        self.replicas = []
+        self.lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(socket.SOMAXCONN)
+
+    def run(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except socket.error, (value, message):
+                if value == errno.EINTR:
+                    continue
+                return
+            logging.info("Replication follower connected from %s:%d" % address)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            replica = Replica(client, self)
+            self.lock.acquire()
+            try:
+                self.replicas.append(replica)
+            finally:
+                self.lock.release()
+            replica.start()
+
+    def remove(self, replica):
+        self.lock.acquire()
+        try:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+        for replica in list(self.replicas):
+            replica.close()
+
+    def stats(self):
+        return [('role', 'primary'), ('followers', len(self.replicas)),
+                ('lag_bytes', max([replica.lag() for replica in self.replicas] or [0]))]
+
+class Follower(threading.Thread):
+    """
+    Follows the primary whose replication port is at ``address``, applying
+    the records it ships to ``queue_collection``, and reconnects to it until
+    stopped.
+    """
+    def __init__(self, address, queue_collection):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.address = parse_address(address)
+        self.queue_collection = queue_collection
+        self.socket = None
+        self.running = True
+        self.connected = False
+        self.applied = 0
+        self.timestamp = 0
+        self.received = 0
+        self.delay = 0.0
+
+    def run(self):
+        while self.running:
+            try:
+                self.socket = socket.create_connection(self.address)
+            except socket.error, e:
+                logging.debug("Could not reach replication primary: %s" % e)
+                time.sleep(RECONNECT_DELAY)
+                continue
+            self.connected = True
+            try:
+                try:
+                    self._follow()
+                except socket.error, e:
+                    logging.warning("Lost replication primary: %s" % e)
+            finally:
+                self.connected = False
+                self.socket.close()
+            if self.running:
+                time.sleep(RECONNECT_DELAY)
+
+    def stop(self):
+        """
+        Stops following the primary once the frame being applied is done.
+        """
+        self.running = False
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.isAlive() and self is not threading.currentThread():
+            self.join()
+
+    def lag(self):
+        """
+        Returns how many seconds behind the primary the follower is, growing
+        from the last frame received once the primary is silent.
+        """
+        now = time.time()
+        if self.received and now - self.received > 2 * HEARTBEAT_INTERVAL:
+            return now - self.timestamp
+        return self.delay
+
+    def stats(self):
+        return [('role', 'follower'), ('connected', int(self.connected)), ('applied_bytes', self.applied),
+                ('lag', '%0.6f' % self.lag())]
+
+    def _follow(self):
+        applied = 0
+        data = ''
+        while self.running:
+            chunk = self.socket.recv(RECV_SIZE)
+            if not chunk:
+                return
+            data += chunk
+            position = 0
+            while len(data) - position >= FRAME_SIZE:
+                kind, timestamp, name_size, size = unpack_from(FRAME_FMT, data, position)
+                start = position + FRAME_SIZE + name_size
+                if len(data) < start + size:
+                    break
+                name = data[position + FRAME_SIZE:start]
+                if kind == FRAME_SNAPSHOT:
+                    self.queue_collection.restore(name, data[start:start + size])
+                elif kind == FRAME_RECORDS:
+                    self.queue_collection.apply(name, data[start:start + size])
+                position = start + size
+                applied += size
+                self.applied += size
+                self.received = time.time()
+                self.timestamp = timestamp
+                self.delay = max(0.0, self.received - timestamp)
+            data = data[position:]
+            if position:
+                self.socket.sendall(pack(ACK_FMT, applied))
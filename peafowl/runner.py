@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 from optparse import OptionParser
-import server, os, sys, errno, signal, logging, string, traceback, time
+import server, worker, journal, os, sys, errno, signal, logging, string, traceback, time
+
+def share(limit, workers, number):
+    """
+    Returns the share of ``limit`` worker ``number`` of ``workers`` gets,
+    the shares adding up to ``limit`` and 0 staying unlimited.
+    """
+    return limit and max(1, limit // workers + (number < limit % workers))
 
 class Runner(object):
     def __init__(self):
@@ -24,6 +31,24 @@ class Runner(object):
         parser.add_option("-q", "--queue", action="store", type="string", dest="path", help="path to store Peafowl queue logs", default=server.DEFAULT_PATH)
         parser.add_option("-H", "--host", action="store", type="string", dest="host", help="interface on which to listen", default=server.DEFAULT_HOST)
         parser.add_option("-p", "--port", action="store", type="int", dest="port", help="TCP port on which to listen", default=server.DEFAULT_PORT)
+        parser.add_option("-e", "--engine", action="store", type="choice", dest="engine", choices=server.ENGINES, help="connection handling engine: %s" % ", ".join(server.ENGINES), default=server.DEFAULT_ENGINE)
+        parser.add_option("-D", "--durability", action="store", type="choice", dest="durability", choices=journal.DURABILITIES, help="transaction log durability: fsync every write, group commit, or OS buffered (default)", default=server.DEFAULT_DURABILITY)
+        parser.add_option("--group-interval", action="store", type="int", dest="group_interval", help="group commit interval in milliseconds", default=server.DEFAULT_GROUP_INTERVAL)
+        parser.add_option("--group-size", action="store", type="int", dest="group_size", help="group commit as soon as GROUP_SIZE records are pending", default=server.DEFAULT_GROUP_SIZE)
+        parser.add_option("--compact-interval", action="store", type="int", dest="compact_interval", help="seconds between transaction log compaction checks, 0 to disable", default=server.DEFAULT_COMPACT_INTERVAL)
+        parser.add_option("--compact-size", action="store", type="int", dest="compact_size", help="compact transaction logs bigger than COMPACT_SIZE bytes", default=server.SOFT_LOG_MAX_SIZE)
+        parser.add_option("--segment-size", action="store", type="int", dest="segment_size", help="bytes of each transaction log segment file", default=server.DEFAULT_SEGMENT_SIZE)
+        parser.add_option("--compact-ratio", action="store", type="float", dest="compact_ratio", help="compact transaction logs COMPACT_RATIO times bigger than their live items", default=server.DEFAULT_COMPACT_RATIO)
+        parser.add_option("-m", "--memory", action="store", type="int", dest="memory", help="MB of items to hold in memory across all queues, shared by the workers, 0 for unlimited", default=0)
+        parser.add_option("--queue-memory", action="store", type="int", dest="queue_memory", help="MB of items to hold in memory per queue, 0 for unlimited", default=0)
+        parser.add_option("--sweep-interval", action="store", type="int", dest="sweep_interval", help="seconds between sweeps of expired items, 0 to disable", default=server.DEFAULT_SWEEP_INTERVAL)
+        parser.add_option("--chunk-size", action="store", type="int", dest="chunk_size", help="hold items in memory back to back in chunks of CHUNK_SIZE bytes rather than one string each, 0 to disable", default=0)
+        parser.add_option("--max-open-queues", action="store", type="int", dest="max_open_queues", help="close idle empty queues once more than MAX_OPEN_QUEUES are open, shared by the workers, 0 for unlimited", default=0)
+        parser.add_option("-z", "--compress", action="store", type="int", dest="compress_threshold", help="compress items of COMPRESS_THRESHOLD bytes or more with zlib, 0 to disable", default=0)
+        parser.add_option("--compress-queues", action="store", type="string", dest="compress_queues", help="comma separated queues to compress, all of them by default")
+        parser.add_option("-w", "--workers", action="store", type="int", dest="workers", help="number of worker processes sharing the port, each owning a share of the queues", default=1)
+        parser.add_option("--replication-port", action="store", type="int", dest="replication_port", help="TCP port on which to stream transaction logs to followers, 0 to disable", default=0)
+        parser.add_option("--follow", action="store", type="string", dest="follow", help="replicate the primary whose replication port is at HOST:PORT, read only until promoted")
         parser.add_option("-d", action="store_true", dest="daemonize", help="run as a daemon", default=False)
         parser.add_option("-P", "--pid", action="store", type="string", dest="pid_file", help="save pid in PID_FILE when using -d option", default=server.DEFAULT_PID)
         parser.add_option("-u", "--user", action="store", type="int", dest="user", help="user to run as")
@@ -31,7 +56,10 @@ class Runner(object):
         parser.add_option("-l", "--log", action="store", type="string", dest="log_file", help="path to print debugging information")
         parser.add_option("-v", action="count", dest="verbosity", help="increase logging verbosity", default=0)
         parser.set_defaults(verbose=True)
-        return parser.parse_args()
+        options, args = parser.parse_args()
+        if options.workers > 1 and (options.replication_port or options.follow):
+            parser.error("replication requires a single worker")
+        return options, args
     
     def start(self, options):
         self.process.write_pid_file()
@@ -45,7 +73,19 @@ class Runner(object):
             self.process.daemonize()
         
         self.trap_signals()
-        self.server = server.Server.start(host=options.host, port=options.port, path=options.path, debug=options.verbosity * 10, log = options.log_file)
+        factory = lambda number: server.Server(host=options.host, port=options.port, path=options.path, debug=options.verbosity * 10, log = options.log_file, engine=options.engine,
+                                    durability=options.durability, group_interval=options.group_interval, group_size=options.group_size,
+                                    compact_interval=options.compact_interval, compact_size=options.compact_size, compact_ratio=options.compact_ratio,
+                                    memory_limit=share(options.memory * 1024**2, options.workers, number), queue_memory_limit=options.queue_memory * 1024**2, sweep_interval=options.sweep_interval,
+                                    compress_threshold=options.compress_threshold,
+                                    compress_queues=options.compress_queues and options.compress_queues.split(',') or None, segment_size=options.segment_size,
+                                    max_open_queues=share(options.max_open_queues, options.workers, number), chunk_size=options.chunk_size,
+                                    replication_port=options.replication_port, follow=options.follow, workers=options.workers, worker=number)
+        if options.workers > 1:
+            self.server = worker.Master(options.workers, factory)
+        else:
+            self.server = factory(0)
+        self.server.run()
         self.process.remove_pid_file()
     
     def shutdown(self, signal, frame):
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
-import socket, logging, sys, time
+import os, socket, logging, sys, time, threading
 from handler import Handler
-from collection import QueueCollection
+from reactor import Reactor
+from worker import Router
+from replication import Primary, Follower
+from utils import Counters
+from collection import QueueCollection, DEFAULT_COMPACT_INTERVAL, DEFAULT_SWEEP_INTERVAL
+from queue import SOFT_LOG_MAX_SIZE, DEFAULT_COMPACT_RATIO
+from journal import DEFAULT_DURABILITY, DEFAULT_GROUP_INTERVAL, DEFAULT_GROUP_SIZE, DEFAULT_SEGMENT_SIZE
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 21122
@@ -9,6 +15,9 @@ DEFAULT_PATH = '/tmp/peafowl/'
 DEFAULT_TIMEOUT = 60
 DEFAULT_PID = '/var/run/peafowl.pid'
 DEFAULT_VERBOSITY = 30
+DEFAULT_ENGINE = 'thread'
+
+ENGINES = ('thread', 'event')
 
 class Server(object):
     def __init__(self, **kwargs):
@@ -16,26 +25,51 @@ class Server(object):
         Initialize a new Peafowl server, but do not accept connections or
         process requests.
         """
-        opts = {'host':DEFAULT_HOST, 'port':DEFAULT_PORT, 'path':DEFAULT_PATH, 'timeout':DEFAULT_TIMEOUT, 'debug':DEFAULT_VERBOSITY}
+        opts = {'host':DEFAULT_HOST, 'port':DEFAULT_PORT, 'path':DEFAULT_PATH, 'timeout':DEFAULT_TIMEOUT, 'debug':DEFAULT_VERBOSITY,
+                'engine':DEFAULT_ENGINE, 'durability':DEFAULT_DURABILITY, 'group_interval':DEFAULT_GROUP_INTERVAL,
+                'group_size':DEFAULT_GROUP_SIZE, 'compact_interval':DEFAULT_COMPACT_INTERVAL, 'compact_size':SOFT_LOG_MAX_SIZE,
+                'compact_ratio':DEFAULT_COMPACT_RATIO, 'memory_limit':0, 'queue_memory_limit':0, 'sweep_interval':DEFAULT_SWEEP_INTERVAL,
+                'compress_threshold':0, 'compress_queues':None, 'segment_size':DEFAULT_SEGMENT_SIZE, 'max_open_queues':0,
+                'chunk_size':0, 'replication_port':0, 'follow':None, 'workers':1, 'worker':0}
         opts.update(kwargs)
         if opts.has_key('log'):            
             logging.basicConfig(filename=opts['log'], level=DEFAULT_VERBOSITY - opts['debug'], format='%(asctime)s %(levelname)s %(message)s')
         else:
             logging.basicConfig(level=DEFAULT_VERBOSITY - opts['debug'], format='%(asctime)s %(levelname)s %(message)s')
-        self.queue_collection = QueueCollection(opts['path'])
-        self.stats = {'bytes_read':0, 'bytes_written':0, 'start_time':time.time(), 'connections':0, 
-                      'total_connections':0, 'get_requests':0, 'set_requests':0}
-        self.stats['start_time'] = time.time()
+        self.queue_collection = QueueCollection(opts['path'], opts['durability'], opts['group_interval'], opts['group_size'],
+                                                opts['compact_interval'], opts['compact_size'], opts['compact_ratio'],
+                                                opts['memory_limit'], opts['queue_memory_limit'], opts['sweep_interval'],
+                                                opts['compress_threshold'], opts['compress_queues'], segment_size=opts['segment_size'],
+                                                max_open_queues=opts['max_open_queues'], chunk_size=opts['chunk_size'])
+        self.stats = Counters(start_time=time.time())
+        if opts['follow']:
+            self.queue_collection.following = True
+            self.queue_collection.replication = Follower(opts['follow'], self.queue_collection)
+            self.queue_collection.replication.start()
+        elif opts['replication_port']:
+            self.queue_collection.replication = Primary(opts['host'], opts['replication_port'], self.queue_collection)
+            self.queue_collection.replication.start()
+        self.engine = opts['engine']
+        self.reactor = None
+        self.router = None
+        self.local = None
+        if opts['workers'] > 1:
+            # every worker listens on the same port, each queue is owned by
+            # one of them and reached by the others through a local socket
+            self.router = Router(opts['path'], opts['worker'], opts['workers'])
+            self.local = self.router.listen()
         self._bind(opts['host'], opts['port'])
     
     def _bind(self, host, port):
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.router:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.server.bind((host, port))
-            self.server.listen(5)
+            self.server.listen(socket.SOMAXCONN)
             logging.info("Listening to %s on port %s" % (host, port))
         except socket.error, e:
             if self.server:
@@ -44,17 +78,33 @@ class Server(object):
             sys.exit(1)
     
     def run(self):
+        if self.engine == 'event':
+            self.reactor = Reactor(self.server, self.queue_collection, self.stats, self.router, self.local)
+            self.reactor.run()
+            return
+        if self.local:
+            acceptor = threading.Thread(target=self._accept, args=(self.local, None, False))
+            acceptor.setDaemon(True)
+            acceptor.start()
+        self._accept(self.server, self.router)
+    
+    def _accept(self, server, router = None, counted = True):
         while True:
             try:
-                self.stats['connections'] += 1
-                client, address = self.server.accept()
-                Handler(client, self.queue_collection, self.stats).start()
-                self.stats['connections'] -= 1
-            except socket.error, e:
+                client, address = server.accept()
+                Handler(client, self.queue_collection, self.stats, router, counted).start()
+            except socket.error:
                 sys.exit(1)
     
     def stop(self):
+        if self.reactor:
+            self.reactor.stop()
+        if self.queue_collection.replication:
+            self.queue_collection.replication.stop()
         self.queue_collection.close()
+        if self.local:
+            self.local.close()
+            os.remove(self.router.address(self.router.worker))
         if self.server:
             self.server.close()
     
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import time, heapq, thread, weakref, threading
+from collections import defaultdict
 
 
 def rusage_user():
@@ -16,3 +18,215 @@ def rusage_system():
     except:
         return 0
 
+
+
+class Waiter(object):
+    """
+    One-shot wake up signal. ``wait`` blocks until ``wake`` has been called
+    at least once, calling ``wake`` more than once is harmless.
+    """
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.lock.acquire()
+        self.guard = thread.allocate_lock()
+        self.woken = False
+
+    def wake(self):
+        self.guard.acquire()
+        try:
+            if not self.woken:
+                self.woken = True
+                self.lock.release()
+        finally:
+            self.guard.release()
+
+    def wait(self):
+        self.lock.acquire()
+
+
+class Timer(threading.Thread):
+    """
+    Calls callbacks at a given deadline from a single background thread.
+    Callbacks can't be cancelled, they must be harmless once obsolete.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.condition = threading.Condition()
+        self.deadlines = []
+        self.sequence = 0
+
+    def schedule(self, deadline, callback):
+        self.condition.acquire()
+        try:
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (deadline, self.sequence, callback))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.deadlines:
+                    self.condition.wait()
+                deadline, sequence, callback = self.deadlines[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                heapq.heappop(self.deadlines)
+            finally:
+                self.condition.release()
+            callback()
+
+
+HISTOGRAM_BUCKETS = 64 # powers of two microseconds, more than any duration
+
+
+class Histogram(object):
+    """
+    Latency histogram with one bucket per power of two microseconds, bucket
+    ``i`` counting durations below ``2 ** i`` us. Recording takes no lock, so
+    concurrent updates may rarely be lost.
+    """
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.total = 0.0
+
+    def record(self, duration):
+        self.counts[int(duration * 1000000).bit_length()] += 1
+        self.total += duration
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound in microseconds of the bucket holding the
+        ``fraction`` percentile.
+        """
+        counts = list(self.counts)
+        rank = fraction * sum(counts)
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** bucket
+        return 0
+
+    def buckets(self):
+        """
+        Returns ``(upper bound in us, count)`` for every non empty bucket.
+        """
+        return [(2 ** bucket, count) for bucket, count in enumerate(self.counts) if count]
+
+
+class Metrics(object):
+    """
+    Named latency histograms, created on first use.
+    """
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, name):
+        if not self.histograms.has_key(name):
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def items(self):
+        return sorted(self.histograms.items())
+
+
+def timed_acquire(lock, histogram):
+    """
+    Acquires ``lock``, recording how long it waited for it in ``histogram``.
+    """
+    if lock.acquire(0):
+        histogram.counts[0] += 1
+        return
+    start = time.time()
+    lock.acquire()
+    histogram.record(time.time() - start)
+
+
+class Counters(object):
+    """
+    Named counters, sharded per thread so that ``incr`` takes no lock and
+    never loses an update. Shards are summed on read. Threads fold their
+    shard into the totals with ``release`` before exiting, those that don't
+    are folded on read once gone.
+    """
+    def __init__(self, **initial):
+        self.local = threading.local()
+        self.lock = thread.allocate_lock()
+        self.totals = dict(initial)
+        self.shards = []
+
+    def incr(self, name, value = 1):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[name] += value
+
+    def decr(self, name, value = 1):
+        self.incr(name, -value)
+
+    def __getitem__(self, name):
+        self.lock.acquire()
+        try:
+            self._fold()
+            return self.totals.get(name, 0) + sum([shard.get(name, 0) for owner, shard in self.shards])
+        finally:
+            self.lock.release()
+
+    def shard(self):
+        """
+        Returns the counters of the calling thread, a dict that only this
+        thread may update.
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = self.local.shard = defaultdict(int)
+        self.lock.acquire()
+        try:
+            # the thread is not held, nor whatever it references
+            self.shards.append((weakref.ref(threading.current_thread()), shard))
+        finally:
+            self.lock.release()
+        return shard
+
+    def release(self):
+        """
+        Folds the counters of the calling thread into the totals, once it
+        won't update them anymore.
+        """
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            return
+        del self.local.shard
+        self.lock.acquire()
+        try:
+            self.shards = [(owner, other) for owner, other in self.shards if other is not shard]
+            self._add(shard)
+        finally:
+            self.lock.release()
+
+    def _fold(self):
+        shards = []
+        for reference, shard in self.shards:
+            owner = reference()
+            if owner and owner.is_alive():
+                shards.append((reference, shard))
+                continue
+            self._add(shard)
+        self.shards = shards
+
+    def _add(self, shard):
+        for name, value in shard.items():
+            self.totals[name] = self.totals.get(name, 0) + value
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import os, zlib, errno, signal, socket, logging
+from collection import FANOUT_SEPARATOR
+
+RECV_SIZE = 64 * 1024
+
+class Router(object):
+    """
+    Maps each queue name to the one worker process owning it, along with
+    the subscribers of fanout queues, and the local socket on which that
+    worker accepts forwarded requests.
+    """
+    def __init__(self, path, worker, workers):
+        self.path = path
+        self.worker = worker
+        self.workers = workers
+
+    def owner(self, name):
+        name = name.split(FANOUT_SEPARATOR, 1)[0]
+        return (zlib.crc32(name) & 0xffffffff) % self.workers
+
+    def owns(self, name):
+        return self.owner(name) == self.worker
+
+    def address(self, worker):
+        return os.path.join(self.path, '.worker-%d.sock' % worker)
+
+    def listen(self):
+        """
+        Returns the listening socket for requests forwarded to this worker.
+        """
+        address = self.address(self.worker)
+        if os.path.exists(address):
+            os.remove(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.listen(socket.SOMAXCONN)
+        return server
+
+    def connect(self, worker):
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.connect(self.address(worker))
+        return peer
+
+def response_length(data):
+    """
+    Returns the length of the first complete MemCache response in ``data``,
+    or -1 if it is not complete yet.
+    """
+    position = 0
+    while True:
+        end = data.find('\r\n', position)
+        if end < 0:
+            return -1
+        if data.startswith('STAT ', position):
+            position = end + 2
+            continue
+        if not data.startswith('VALUE ', position):
+            return end + 2
+        length = int(data[position:end].split(' ')[3])
+        position = end + 2 + length + 2
+        if position > len(data):
+            return -1
+
+class Peer(object):
+    """
+    Blocking connection forwarding requests to the worker owning a queue.
+    """
+    def __init__(self, router, worker):
+        self.socket = router.connect(worker)
+
+    def request(self, data):
+        self.socket.sendall(data)
+        response = ''
+        while True:
+            chunk = self.socket.recv(RECV_SIZE)
+            if not chunk:
+                raise socket.error(errno.ECONNRESET, "Connection closed by worker")
+            response += chunk
+            if response_length(response) == len(response):
+                return response
+
+    def close(self):
+        self.socket.close()
+
+class AsyncPeer(object):
+    """
+    Non-blocking connection, driven by the Reactor, forwarding requests to
+    the worker owning a queue. ``callback`` is called with each response,
+    or ``None`` when the connection is lost.
+    """
+    def __init__(self, router, worker, reactor):
+        self.socket = router.connect(worker)
+        self.socket.setblocking(0)
+        self.fd = self.socket.fileno()
+        self.reactor = reactor
+        self.input = ''
+        self.output = ''
+        self.callback = None
+        self.reactor.register(self)
+
+    def fileno(self):
+        return self.fd
+
+    def request(self, data, callback):
+        self.callback = callback
+        self.output += data
+        self.reactor.want_write(self, True)
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(RECV_SIZE)
+        except socket.error, (value, message):
+            if value in (errno.EAGAIN, errno.EINTR):
+                return
+            return self.close()
+        if not data:
+            return self.close()
+        self.input += data
+        length = response_length(self.input)
+        if length >= 0:
+            response, self.input = self.input[:length], self.input[length:]
+            callback, self.callback = self.callback, None
+            callback(response)
+
+    def handle_write(self):
+        try:
+            sent = self.socket.send(self.output)
+        except socket.error, (value, message):
+            if value in (errno.EAGAIN, errno.EINTR):
+                return
+            return self.close()
+        self.output = self.output[sent:]
+        if not self.output:
+            self.reactor.want_write(self, False)
+
+    def close(self):
+        self.reactor.unregister(self)
+        self.socket.close()
+        callback, self.callback = self.callback, None
+        if callback:
+            callback(None)
+
+class Master(object):
+    """
+    Pre-forks ``workers`` processes, each one running the server returned by
+    ``factory(worker)``, and restarts them if they die.
+    """
+    def __init__(self, workers, factory):
+        self.workers = workers
+        self.factory = factory
+        self.children = {}
+        self.running = False
+
+    def run(self):
+        self.running = True
+        for worker in range(self.workers):
+            self._spawn(worker)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker = self.children.pop(pid, None)
+            if worker is not None and self.running:
+                logging.warning("Worker %d (pid %d) exited with status %d, restarting" % (worker, pid, status))
+                self._spawn(worker)
+
+    def stop(self):
+        self.running = False
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _spawn(self, worker):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = worker
+            return
+        status = 0
+        try:
+            try:
+                server = self.factory(worker)
+                signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+                signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+                server.run()
+            except SystemExit, e:
+                status = e.code or 0
+            except Exception, e:
+                logging.error("Worker %d failed: %s" % (worker, e))
+                status = 1
+        finally:
+            os._exit(status)
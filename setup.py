@@ -18,6 +18,6 @@ setup(name='peafowl',
                       "Operating System :: Unix",
                       "Programming Language :: Python" ],
       packages = ['peafowl'],
-      scripts=['bin/peafowl'],
+      scripts=['bin/peafowl', 'bin/peafowl-bench'],
       test_suite='tests'
 )
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
-import unittest, random, time, hashlib, os
-from peafowl.collection import QueueCollection, QueueCollectionError
+import unittest, random, time, os, socket, threading, tempfile, shutil
+from struct import pack, unpack_from
+import peafowl.collection as collection_module
+from peafowl.collection import QueueCollection, item_expiry
+from peafowl.server import Server
+from peafowl.queue import PersistentQueue, MemoryBudget
+from peafowl.journal import Committer, FSYNC, GROUP
+from peafowl.bench import Benchmark
+from peafowl.utils import Counters
+from peafowl.peafowl import Peafowl, PeafowlError, Ring
 try:
     from cmemcache import Client
 except ImportError:
@@ -28,6 +36,14 @@ class TestPeafowl(unittest.TestCase):
         time.sleep(now + 1 - time.time())
         self.assertEqual(v, self.memcache.get('test_set_with_expiry'))
 
+    def test_expired_items_are_counted_per_queue(self):
+        now = time.time()
+        self.memcache.set('test_expired_items_are_counted', 1, now)
+        time.sleep(now + 1 - time.time())
+        self.assertEqual(None, self.memcache.get('test_expired_items_are_counted'))
+        (key, stats) = Client(['127.0.0.1:21122']).get_stats()[0]
+        self.assertEqual('1', stats['queue_test_expired_items_are_counted_expired_items'])
+
     def test_long_value(self):
         string = ''.join([random.choice("abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789") for i in range(300)])
         self.memcache.set('test_long_value', string)
@@ -49,12 +65,863 @@ class TestPeafowl(unittest.TestCase):
         response = self.memcache.add('blah', 1)
         self.assertEqual(False, response)
 
+    def test_blocking_get_times_out(self):
+        start = time.time()
+        self.assertEqual(None, self.memcache.get('test_blocking_get_times_out/t=300'))
+        self.assert_(time.time() - start >= 0.3)
+
+    def test_blocking_get_wakes_on_set(self):
+        v = random.randint(1, 32)
+        threading.Timer(0.1, Client(['127.0.0.1:21122']).set, ('test_blocking_get_wakes_on_set', v)).start()
+        start = time.time()
+        self.assertEqual(v, self.memcache.get('test_blocking_get_wakes_on_set/t=2000'))
+        self.assert_(time.time() - start < 1)
+
+    def test_get_many(self):
+        for i in range(5):
+            self.memcache.set('test_get_many', 'value%d' % i)
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        connection.sendall('get test_get_many/n=3\r\n')
+        time.sleep(0.1)
+        self.assertEqual(''.join(['VALUE test_get_many/n=3 0 6\r\nvalue%d\r\n' % i for i in range(3)]) + 'END\r\n', connection.recv(4096))
+        connection.sendall('get test_get_many/n=10\r\n')
+        time.sleep(0.1)
+        self.assertEqual(2, connection.recv(4096).count('VALUE'))
+        connection.close()
+
+    def test_pipelined_commands(self):
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        connection.sendall('set test_pipelined_commands 0 0 1\r\na\r\n' * 100 + 'get test_pipelined_commands/n=100\r\nbogus\r\n')
+        expected = 'STORED\r\n' * 100 + 'VALUE test_pipelined_commands/n=100 0 1\r\na\r\n' * 100 + 'END\r\n' + 'CLIENT_ERROR bad command line format\r\n'
+        response = ''
+        while len(response) < len(expected):
+            response += connection.recv(65536)
+        self.assertEqual(expected, response)
+        connection.close()
+
+    def test_value_bigger_than_input_buffer_sent_in_pieces(self):
+        value = ''.join([random.choice("abcdefgh") for i in range(200000)])
+        request = 'set test_big_value 0 0 %d\r\n%s\r\nget test_big_value\r\n' % (len(value), value)
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        for i in range(0, len(request), 30000):
+            connection.sendall(request[i:i + 30000])
+            time.sleep(0.01)
+        expected = 'STORED\r\nVALUE test_big_value 0 %d\r\n%s\r\nEND\r\n' % (len(value), value)
+        response = ''
+        while len(response) < len(expected):
+            response += connection.recv(65536)
+        self.assertEqual(expected, response)
+        connection.close()
+
+    def test_value_too_large_is_refused_and_connection_closed(self):
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        connection.sendall('set test_too_large 0 0 99999999999\r\nab')
+        connection.sendall('cd')
+        response = ''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            response += data
+        self.assertEqual('CLIENT_ERROR object too large for cache\r\n', response)
+        connection.close()
+        self.memcache.set('test_too_large', 1)
+        self.assertEqual(1, self.memcache.get('test_too_large'))
+
+    def test_binary_quiet_gets_drain_queue_in_one_flush(self):
+        def request(opcode, key = '', value = '', extras = '', opaque = 0):
+            return pack("!BBHBBHIIQ", 0x80, opcode, len(key), len(extras), 0, 0, len(extras) + len(key) + len(value), opaque, 0) \
+                + extras + key + value
+        (key, before) = self.memcache.get_stats()[0]
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        requests = [request(0x01, 'test_binary', 'value %d' % i, pack("!II", 3, 0)) for i in range(3)]
+        requests += [request(0x09, 'test_binary', opaque=i) for i in range(5)] + [request(0x0a, opaque=9)]
+        requests += [request(0x00, 'test_binary'), request(0x10, 'items')]
+        connection.sendall(''.join(requests))
+        data = ''
+        responses = []
+        while not responses or responses[-1][4]:
+            data += connection.recv(65536)
+            while len(data) >= 24:
+                magic, opcode, key_length, extras_length, data_type, status, size, opaque, cas = unpack_from("!BBHBBHIIQ", data)
+                if len(data) < 24 + size:
+                    break
+                body = data[24 + extras_length:24 + size]
+                responses.append((opcode, status, opaque, body[key_length:], body[:key_length]))
+                data = data[24 + size:]
+        self.assertEqual([(0x01, 0, 0, '', '')] * 3, responses[:3])
+        self.assertEqual([(0x09, 0, i, 'value %d' % i, '') for i in range(3)] + [(0x0a, 0, 9, '', ''), (0x00, 1, 0, 'Not found', '')],
+                         responses[3:8])
+        stats = dict((key, value) for opcode, status, opaque, value, key in responses[8:-1])
+        self.assertEqual(['bytes', 'curr_items', 'total_items'], sorted(stats))
+        self.assertEqual((0x10, 0, 0, '', ''), responses[-1])
+        connection.close()
+        (key, after) = self.memcache.get_stats()[0]
+        self.assertEqual(int(before['cmd_get']) + 6, int(after['cmd_get']))
+        self.assertEqual(int(before['cmd_set']) + 3, int(after['cmd_set']))
+
+    def test_latency_stats(self):
+        self.memcache.set('test_latency_stats', 1)
+        self.memcache.get('test_latency_stats')
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        for command in ('stats latency', 'stats detail'):
+            connection.sendall(command + '\r\n')
+            response = ''
+            while not response.endswith('END\r\n'):
+                response += connection.recv(65536)
+            stats = dict(line.split(' ')[1:] for line in response.split('\r\n')[:-2])
+            if command == 'stats latency':
+                self.assert_(int(stats['cmd_set_count']) > 0)
+                self.assert_(int(stats['cmd_get_p50_us']) <= int(stats['cmd_get_p99_us']))
+                self.assert_(int(stats['log_write_count']) > 0)
+                self.assert_(stats.has_key('lock_transaction_p999_us'))
+            else:
+                self.assert_([name for name in stats if name.startswith('cmd_get_us_le_')])
+        connection.close()
+
+    def test_reliable_get_is_requeued_unless_closed(self):
+        self.memcache.set('test_reliable_get', 'a')
+        self.memcache.set('test_reliable_get', 'b')
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        connection.sendall('get test_reliable_get/open\r\n')
+        time.sleep(0.1)
+        self.assertEqual('VALUE test_reliable_get/open 0 1\r\na\r\nEND\r\n', connection.recv(4096))
+        connection.sendall('get test_reliable_get/open\r\n')
+        time.sleep(0.1)
+        self.assertEqual('CLIENT_ERROR transaction already open\r\n', connection.recv(4096))
+        connection.sendall('get test_reliable_get/abort/open\r\n')
+        time.sleep(0.1)
+        self.assertEqual('VALUE test_reliable_get/abort/open 0 1\r\na\r\nEND\r\n', connection.recv(4096))
+        connection.close()
+        time.sleep(0.1)
+        connection = socket.create_connection(('127.0.0.1', 21122))
+        connection.sendall('get test_reliable_get/open\r\nget test_reliable_get/close/open\r\nget test_reliable_get/close\r\n')
+        time.sleep(0.1)
+        self.assertEqual('VALUE test_reliable_get/open 0 1\r\na\r\nEND\r\n'
+                         'VALUE test_reliable_get/close/open 0 1\r\nb\r\nEND\r\nEND\r\n', connection.recv(4096))
+        connection.close()
+        self.assertEqual(None, self.memcache.get('test_reliable_get'))
+
+    def test_fanout_delivers_to_every_subscriber(self):
+        self.assertEqual(None, self.memcache.get('test_fanout+a'))
+        self.assertEqual(None, self.memcache.get('test_fanout+b'))
+        self.assertEqual(0, self.memcache.set('test_fanout+a', 0))
+        self.memcache.set('test_fanout', 1)
+        self.memcache.set('test_fanout', 2)
+        self.assertEqual(1, self.memcache.get('test_fanout+a'))
+        self.assertEqual(1, self.memcache.get('test_fanout+b'))
+        self.assertEqual(None, self.memcache.get('test_fanout'))
+        (key, stats) = self.memcache.get_stats()[0]
+        self.assertEqual('1', stats['queue_test_fanout_items'])
+        self.assertEqual('1', stats['queue_test_fanout+b_items'])
+        self.assertEqual(2, self.memcache.get('test_fanout+b'))
+        self.assertEqual(2, self.memcache.get('test_fanout+a'))
+        self.memcache.set('test_fanout', 3)
+        self.assertEqual(None, self.memcache.get('test_fanout+b/unsubscribe'))
+        self.assertEqual(3, self.memcache.get('test_fanout+a'))
+        stats = self.memcache.get_stats()[0][1]
+        self.assertEqual('0', stats['queue_test_fanout_items'])
+        self.assert_(not stats.has_key('queue_test_fanout+b_items'))
+
     def test_that_disconnecting_and_reconnecting_works(self):
         v = random.randint(1, 32)
         self.memcache.set('test_that_disconnecting_and_reconnecting_works', v)
         self.memcache.disconnect_all()
         self.assertEqual(v, int(self.memcache.get('test_that_disconnecting_and_reconnecting_works')))
 
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.client = Peafowl(['127.0.0.1:21122'], pool_size=2)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_put_many_and_take_many(self):
+        values = ['value%d' % i for i in range(100)] + [1, 2L, {'a': 1}]
+        size = len(self.client)
+        self.assertEqual(103, self.client.put_many('test_put_many', values))
+        self.assertEqual(size + 103, len(self.client))
+        self.assertEqual(values[:60], self.client.take_many('test_put_many', 60))
+        self.assertEqual(values[60:], self.client.take_many('test_put_many', 60))
+        self.assertEqual([], self.client.take_many('test_put_many', 60))
+        self.assertEqual(None, Client(['127.0.0.1:21122']).get('test_put_many'))
+
+    def test_reader_holds_items_open_on_its_connection(self):
+        self.client.put_many('test_reader', ['a', 'b', 'c'])
+        self.assertRaises(PeafowlError, self.client.get, 'test_reader/open')
+        with self.client.reader('test_reader') as reader:
+            self.assertEqual('a', reader.open())
+            self.assertEqual(['b'], self.client.take_many('test_reader', 1))
+            reader.abort()
+            self.assertEqual('a', reader.open())
+            self.assertEqual('c', reader.open())
+        self.assertEqual(['c'], self.client.take_many('test_reader', 10))
+        self.assertEqual(0, len(self.client.pools[0].idle) - self.client.pools[0].opened)
+
+    def test_broken_pooled_connection_is_replaced(self):
+        self.client.put_many('test_broken_pooled', ['a'])
+        for connection in self.client.pools[0].idle:
+            connection.socket.close()
+        self.assertEqual(['a'], self.client.take_many('test_broken_pooled', 1))
+        self.assertEqual({}, self.client.dead)
+
+    def test_blocking_take_outlasts_socket_timeout(self):
+        client = Peafowl(['127.0.0.1:21122'], socket_timeout=0.1)
+        self.assertEqual([], client.take_many('test_blocking_take', 1, 300))
+        self.assertEqual({}, client.dead)
+        client.close()
+
+    def test_pool_is_shared_by_threads(self):
+        def produce(number):
+            for i in range(20):
+                self.client.set('test_pool_is_shared_by_threads', number * 20 + i)
+        threads = [threading.Thread(target=produce, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(2, self.client.pools[0].opened)
+        self.assertEqual(range(160), sorted(self.client.take_many('test_pool_is_shared_by_threads', 200)))
+
+    def test_adding_a_node_moves_few_queues(self):
+        names = ['queue%d' % i for i in range(1000)]
+        before = Ring(['a:1', 'b:1', 'c:1'])
+        after = Ring(['a:1', 'b:1', 'c:1', 'd:1'])
+        moved = [name for name in names if before.nodes(name).next() != after.nodes(name).next()]
+        self.assert_(150 < len(moved) < 350)
+        self.assertEqual(set([3]), set(after.nodes(name).next() for name in moved))
+
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self.paths = [tempfile.mkdtemp() for i in range(2)]
+        self.servers = [Server(port=21126 + i, path=self.paths[i], engine='event') for i in range(2)]
+        self.threads = [threading.Thread(target=server.run) for server in self.servers]
+        for thread in self.threads:
+            thread.start()
+        self.addresses = ['127.0.0.1:%d' % (21126 + i) for i in range(2)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for thread in self.threads:
+            thread.join()
+        for path in self.paths:
+            shutil.rmtree(path)
+
+    def test_failover_to_next_node(self):
+        client = Peafowl([self.addresses[0], '127.0.0.1:21129'])
+        names = ['test_failover_%d' % i for i in range(20)]
+        for name in names:
+            client.set(name, name)
+        self.assertEqual(set([1]), set(client.dead))
+        self.assertEqual(sorted(names), sorted(self.servers[0].queue_collection.get_queues()))
+        self.assertEqual(names, [client.get(name) for name in names])
+        client.close()
+
+    def test_drain_from_any_node(self):
+        client = Peafowl(self.addresses, drain=True)
+        names = ['test_drain_%d' % i for i in range(10)]
+        owners = [client.ring.nodes(name).next() for name in names]
+        self.assertEqual(set([0, 1]), set(owners))
+        for name, owner in zip(names, owners):
+            single = Peafowl([self.addresses[1 - owner]])
+            single.set(name, name)
+            single.close()
+        self.assertEqual(names, [client.get(name, 0) for name in names])
+        client.close()
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        self.paths = [tempfile.mkdtemp() for i in range(2)]
+        self.servers = [Server(port=21140, path=self.paths[0], engine='event', replication_port=21141)]
+        self.threads = []
+        self.start(self.servers[0])
+
+    def start(self, server):
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        self.threads.append(thread)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for thread in self.threads:
+            thread.join()
+        for path in self.paths:
+            shutil.rmtree(path)
+
+    def request(self, port, command):
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.sendall(command)
+        response = connection.recv(65536)
+        connection.close()
+        return response
+
+    def test_promoted_follower_has_the_queues(self):
+        primary = Client(['127.0.0.1:21140'])
+        for value in ('a', 'b', 'c'):
+            primary.set('test_replication', value)
+        self.servers.append(Server(port=21142, path=self.paths[1], engine='event', follow='127.0.0.1:21141'))
+        self.start(self.servers[1])
+        for value in ('d', 'e'):
+            primary.set('test_replication', value)
+        self.assertEqual('a', primary.get('test_replication'))
+        connection = socket.create_connection(('127.0.0.1', 21140))
+        connection.sendall('get test_replication/open\r\n')
+        self.assert_(connection.recv(4096).startswith('VALUE'))
+        collection = self.servers[1].queue_collection
+        deadline = time.time() + 5
+        while time.time() < deadline and 'STAT replication_followers 1\r\nSTAT replication_lag_bytes 0\r' not in self.request(21140, 'stats\r\n'):
+            time.sleep(0.05)
+        self.assertEqual(3, collection.get_queues('test_replication').qsize())
+        stats = self.request(21140, 'stats\r\n')
+        self.assert_('STAT replication_role primary\r' in stats)
+        self.assert_('STAT replication_followers 1\r' in stats)
+        self.assert_('STAT replication_role follower\r\nSTAT replication_connected 1\r' in self.request(21142, 'stats\r\n'))
+        self.assertEqual('SERVER_ERROR read only follower\r\n', self.request(21142, 'get test_replication\r\n'))
+        self.assertEqual('CLIENT_ERROR not a follower\r\n', self.request(21140, 'promote\r\n'))
+        self.assertEqual('OK\r\n', self.request(21142, 'promote\r\n'))
+        follower = Client(['127.0.0.1:21142'])
+        self.assertEqual(['b', 'c', 'd', 'e'], [follower.get('test_replication') for i in range(4)])
+        self.assertEqual(None, follower.get('test_replication'))
+        connection.close()
+        primary.disconnect_all()
+        follower.disconnect_all()
+
+class TestPersistentQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = PersistentQueue(self.path, 'test')
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.path)
+
+    def reopen(self):
+        self.queue.close()
+        self.queue = PersistentQueue(self.path, 'test')
+
+    def test_get_many_is_logged_once(self):
+        for i in range(5):
+            self.queue.put('value%d' % i)
+        log_size = self.queue.log_size
+        self.assertEqual(['value0', 'value1', 'value2'], self.queue.get_many(3))
+        self.assertEqual(log_size + 9, self.queue.log_size)
+        self.reopen()
+        self.assertEqual(['value3', 'value4'], self.queue.get_many(10))
+
+    def test_consecutive_pops_are_logged_once(self):
+        for i in range(5):
+            self.queue.put('value%d' % i)
+        log_size = self.queue.log_size
+        self.assertEqual('value0', self.queue.get())
+        self.assertEqual(['value1', 'value2'], self.queue.get_many(2))
+        self.assertEqual('value3', self.queue.get())
+        self.assertEqual(log_size + 9, self.queue.log_size)
+        self.reopen()
+        self.assertEqual(['value4'], self.queue.get_many(10))
+
+    def test_replay_stops_at_last_valid_record(self):
+        for i in range(3):
+            self.queue.put('value%d' % i)
+        self.queue.close()
+        segment = open(os.path.join(self.path, 'test.log', '%020d' % 0), 'rb+')
+        segment.seek(2 * 15 + 7)
+        segment.write('X')
+        segment.seek(0, os.SEEK_END)
+        segment.write('\x00\x10')
+        segment.close()
+        self.queue = PersistentQueue(self.path, 'test')
+        self.assertEqual(2 * 15, self.queue.log_size)
+        self.queue.put('value3')
+        self.reopen()
+        self.assertEqual(['value0', 'value1', 'value3'], self.queue.get_many(10))
+
+    def test_legacy_log_is_migrated(self):
+        self.queue.remove()
+        legacy = open(os.path.join(self.path, 'test'), 'wb')
+        for i in range(4):
+            legacy.write('\x00' + pack('I', 6) + 'value%d' % i)
+        legacy.write('\x01')
+        legacy.close()
+        self.queue = PersistentQueue(self.path, 'test')
+        self.assertEqual(['test.log'], os.listdir(self.path))
+        self.assertEqual('value1', self.queue.get())
+        self.reopen()
+        self.assertEqual(['value2', 'value3'], self.queue.get_many(10))
+
+    def test_consumed_segments_are_removed(self):
+        self.reopen_with(segment_size=100)
+        for i in range(20):
+            self.queue.put('value%03d' % i)
+        self.queue.get_many(15)
+        self.assertEqual(4, len(os.listdir(os.path.join(self.path, 'test.log'))))
+        self.queue.checkpoint()
+        self.assertEqual(['%020d' % 200, '%020d' % 300], sorted(os.listdir(os.path.join(self.path, 'test.log'))))
+        self.assertEqual(self.queue.log_size - 200, self.queue.log_bytes())
+        self.reopen_with(segment_size=100)
+        self.assertEqual(['value%03d' % i for i in range(15, 20)], self.queue.get_many(10))
+
+    def test_fanout_items_are_shared_until_every_subscriber_read_them(self):
+        self.queue.put('value0')
+        self.queue.subscribe('a')
+        self.queue.subscribe('b')
+        for i in range(1, 4):
+            self.queue.put('value%d' % i)
+        self.assertEqual((['value0', 'value1'], 6), self.queue.read('a', 2))
+        self.assertEqual((['value1'], 6), self.queue.read('b', 1))
+        self.assert_(self.queue.read('a', 1)[0][0] is self.queue.read('b', 1)[0][0])
+        self.assertEqual(1, self.queue.qsize())
+        self.reopen()
+        self.assertEqual({'a': 0, 'b': 0}, self.queue.cursors)
+        self.assertEqual((['value3'], 0), self.queue.read('a'))
+        self.queue.compact()
+        self.reopen()
+        self.assertEqual((['value3'], 6), self.queue.read('b', 10))
+        self.assertEqual(([], 0), self.queue.read('a'))
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_unsubscribed_cursor_stops_holding_items(self):
+        self.queue.subscribe('a')
+        self.queue.subscribe('b')
+        for i in range(3):
+            self.queue.put('value%d' % i)
+        self.assertEqual((['value0', 'value1'], 0), self.queue.read('a', 2))
+        self.assertEqual(12, self.queue.unsubscribe('b'))
+        self.assertEqual(None, self.queue.unsubscribe('b'))
+        self.assertEqual(1, self.queue.qsize())
+        self.reopen()
+        self.assertEqual({'a': 0}, self.queue.cursors)
+        self.queue.compact()
+        self.reopen()
+        self.assertEqual({'a': 0}, self.queue.cursors)
+        self.queue.subscribe('c')
+        self.queue.put('value3')
+        self.assertEqual((['value2'], 6), self.queue.read('a'))
+        self.assertEqual((['value3'], 0), self.queue.read('c'))
+        self.queue.checkpoint()
+        self.assertEqual(self.queue.log_size, self.queue.checkpoint_tail)
+        self.reopen()
+        self.assertEqual({'a': 0, 'c': 1}, self.queue.cursors)
+        self.assertEqual((['value3'], 6), self.queue.read('a'))
+
+    def test_open_items_are_closed_or_requeued(self):
+        for i in range(4):
+            self.queue.put('value%d' % i)
+        first, value = self.queue.open_item()
+        self.assertEqual('value0', value)
+        second, value = self.queue.open_item()
+        self.assertEqual('value1', value)
+        self.queue.close_item(first)
+        self.assertEqual(len('value1'), self.queue.abort_item(second))
+        self.assertEqual(3, self.queue.qsize())
+        third, value = self.queue.open_item()
+        self.assertEqual('value1', value)
+        self.reopen()
+        self.assertEqual(['value1', 'value2', 'value3'], self.queue.get_many(10))
+
+    def test_open_items_survive_compaction(self):
+        for i in range(4):
+            self.queue.put('value%d' % i)
+        self.queue.open_item()
+        xid, value = self.queue.open_item()
+        self.queue.abort_item(xid)
+        self.queue.get()
+        self.queue.compact()
+        self.queue.checkpoint()
+        self.reopen()
+        self.assertEqual(['value0', 'value2', 'value3'], self.queue.get_many(10))
+
+    def test_replicated_records_rebuild_the_queue(self):
+        path = tempfile.mkdtemp()
+        replica = PersistentQueue(path, 'test', memory_limit=20)
+        try:
+            for i in range(5):
+                self.queue.put('value%d' % i)
+            self.queue.get()
+            xid, value = self.queue.open_item()
+            self.queue.replicate(lambda name, records, snapshot: replica.apply(records))
+            self.queue.abort_item(xid)
+            self.queue.open_item()
+            for i in range(5, 10):
+                self.queue.put('value%d' % i)
+            self.queue.get_many(2)
+            self.assertEqual(self.queue.qsize(), replica.qsize())
+            self.assertEqual(self.queue.size(), replica.size())
+            replica.close()
+            replica = PersistentQueue(path, 'test')
+            self.assertEqual(['value1'] + ['value%d' % i for i in range(4, 10)], replica.get_many(10))
+        finally:
+            replica.close()
+            shutil.rmtree(path)
+
+    def test_fsync_put_is_durable_on_return(self):
+        self.reopen_with(Committer(FSYNC))
+        self.queue.put('value')
+        self.assertEqual(14, os.path.getsize(os.path.join(self.path, 'test.log', '%020d' % 0)))
+
+    def test_group_commit_coalesces_writes(self):
+        committer = Committer(GROUP, 5, 1000)
+        committer.start()
+        self.reopen_with(committer)
+        def produce():
+            for i in range(50):
+                self.queue.put('value')
+        threads = [threading.Thread(target=produce) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assert_(self.queue.transaction_log.syncs < 400)
+        self.reopen()
+        self.assertEqual(400, self.queue.qsize())
+
+    def test_compact_keeps_live_items_only(self):
+        open(os.path.join(self.path, 'test.1234567890.12'), 'w').close()
+        for i in range(100):
+            self.queue.put('value%d' % i)
+        self.queue.get_many(90)
+        log_size = self.queue.log_size
+        self.assert_(self.queue.needs_compaction(0))
+        self.queue.compact()
+        self.assert_(self.queue.log_size < log_size / 5)
+        self.assertEqual(['test.log'], os.listdir(self.path))
+        self.queue.put('value100')
+        self.assertEqual('value90', self.queue.get())
+        self.reopen()
+        self.assertEqual(['value%d' % i for i in range(91, 101)], self.queue.get_many(100))
+
+    def test_compact_while_queue_is_used(self):
+        for i in range(1000):
+            self.queue.put('value%d' % i)
+        def use():
+            for i in range(1000, 2000):
+                self.queue.put('value%d' % i)
+                self.queue.get()
+        thread = threading.Thread(target=use)
+        thread.start()
+        while thread.isAlive():
+            self.queue.compact()
+        self.reopen()
+        self.assertEqual(['value%d' % i for i in range(1000, 2000)], self.queue.get_many(2000))
+
+    def test_checkpoint_skips_consumed_records(self):
+        for i in range(100):
+            self.queue.put('value%03d' % i)
+        for i in range(10):
+            self.queue.get()
+        self.queue.get_many(50)
+        self.queue.checkpoint()
+        self.assertEqual(60 * 17, self.queue.checkpoint_head)
+        for i in range(100, 110):
+            self.queue.put('value%03d' % i)
+        self.queue.get_many(5)
+        self.queue.checkpoint()
+        self.queue.get()
+        self.reopen()
+        self.assertEqual(65 * 17, self.queue.checkpoint_head)
+        self.assertEqual(['value%03d' % i for i in range(66, 110)], self.queue.get_many(100))
+        self.queue.compact()
+        self.reopen()
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_checkpoint_keeps_open_and_aborted_items(self):
+        self.reopen_with(segment_size=100)
+        for i in range(10):
+            self.queue.put('value%03d' % i)
+        first, value = self.queue.open_item()
+        second, value = self.queue.open_item()
+        self.queue.abort_item(second)
+        for i in range(10, 20):
+            self.queue.put('value%03d' % i)
+        self.assertEqual(['value%03d' % i for i in range(1, 6)], self.queue.get_many(5))
+        third, value = self.queue.open_item()
+        self.queue.abort_item(third)
+        self.queue.checkpoint()
+        self.assertEqual(7 * 17, self.queue.checkpoint_head)
+        self.assertEqual('%020d' % 100, sorted(os.listdir(os.path.join(self.path, 'test.log')))[0])
+        self.reopen_with(segment_size=100)
+        self.assertEqual(['value000', 'value006'] + ['value%03d' % i for i in range(7, 20)], self.queue.get_many(100))
+
+    def test_items_past_memory_limit_are_spilled(self):
+        self.reopen_with(memory_limit=50)
+        for i in range(20):
+            self.queue.put('value%05d' % i)
+        self.assertEqual(50, self.queue.memory_bytes)
+        self.assertEqual(15, len(self.queue.spilled))
+        self.assertEqual(20, self.queue.qsize())
+        self.assertEqual(['value%05d' % i for i in range(3)], self.queue.get_many(3))
+        self.assertEqual(12, len(self.queue.spilled))
+        self.queue.compact()
+        self.reopen_with(memory_limit=50)
+        self.assertEqual(12, len(self.queue.spilled))
+        self.assertEqual(['value%05d' % i for i in range(3, 20)], self.queue.get_many(20))
+        self.assertEqual(0, self.queue.memory_bytes)
+
+    def test_compressed_items_are_logged_and_held_compressed(self):
+        self.reopen_with(compress_threshold=100, memory_limit=200)
+        values = [pack("!II", 0, 0) + '{"message": %d}' % i * 20 for i in range(10)] + ['short']
+        for value in values:
+            self.queue.put(self.queue.encode(value))
+        self.assert_(self.queue.log_size < sum(map(len, values)) / 2)
+        self.assert_(self.queue.compressed_bytes < self.queue.raw_bytes / 4)
+        self.assert_(self.queue.spilled)
+        xid, value = self.queue.open_item()
+        self.assertEqual(values[0], self.queue.decode(value))
+        self.queue.abort_item(xid)
+        self.queue.get()
+        self.queue.compact()
+        self.reopen_with(memory_limit=200)
+        self.assertEqual(values[1:], map(self.queue.decode, self.queue.get_many(20)))
+
+    def test_chunked_store_holds_items_back_to_back(self):
+        values = [pack("!II", 0, 0) + 'value%03d' % i for i in range(100)]
+        for value in values:
+            self.queue.put(value)
+        string_per_item = self.queue.memory_per_item()
+        self.reopen_with(chunk_size=170, compress_threshold=100)
+        self.queue.put(self.queue.encode(pack("!II", 0, 0) + 'x' * 200))
+        self.assert_(self.queue.memory_per_item() < string_per_item)
+        self.assertEqual(11, len(self.queue.queue.chunks))
+        xid, value = self.queue.open_item()
+        self.assert_(isinstance(value, memoryview))
+        self.assertEqual(values[0], value.tobytes())
+        self.assertEqual(values[1:50], [item.tobytes() for item in self.queue.get_many(49)])
+        self.assertEqual(6, len(self.queue.queue.chunks))
+        self.queue.abort_item(xid)
+        self.reopen()
+        self.assertEqual(values[:1] + values[50:], self.queue.get_many(51))
+        self.assertEqual(pack("!II", 0, 0) + 'x' * 200, self.queue.decode(self.queue.get()))
+
+    def test_spilled_items_are_paged_in_from_pending_records(self):
+        committer = Committer(GROUP, 60000, 1000)
+        budget = MemoryBudget(10)
+        self.reopen_with(committer, budget=budget)
+        self.queue.put('value0000', wait=False)
+        self.queue.put('value0001', wait=False)
+        self.assertEqual(9, budget.used)
+        self.assertEqual(['value0000', 'value0001'], self.queue.get_many(2))
+        self.assertEqual(0, budget.used)
+
+    def test_expired_items_are_removed_from_head_at_once(self):
+        self.reopen_with(expiry=item_expiry)
+        item = lambda expiry, data: pack('!II5s', 0, expiry, data)
+        for expiry, data in ((100, 'old00'), (100, 'old01'), (200, 'old02'), (0, 'keep0'), (100, 'old03')):
+            self.queue.put(item(expiry, data))
+        log_size = self.queue.log_size
+        self.assertEqual((3, 39), self.queue.expire(time.time()))
+        self.assertEqual(log_size + 9, self.queue.log_size)
+        self.assertEqual((0, 0), self.queue.expire(time.time()))
+        self.assertEqual(item(0, 'keep0'), self.queue.get())
+        self.reopen_with(expiry=item_expiry)
+        self.assertEqual((1, 13), self.queue.expire(time.time()))
+        self.assertEqual(1, self.queue.expired_items)
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_spilled_expired_items_are_dropped_after_replay(self):
+        for i in range(5):
+            self.queue.put(pack('!II5s', 0, 100 + i, 'old%02d' % i))
+        self.queue.put(pack('!II5s', 0, 0, 'keep0'))
+        budget = MemoryBudget(26)
+        self.reopen_with(budget=budget, expiry=item_expiry)
+        self.assertEqual(4, len(self.queue.spilled))
+        self.assertEqual((5, 65), self.queue.expire(time.time()))
+        self.assertEqual(13, budget.used)
+        self.assertEqual(pack('!II5s', 0, 0, 'keep0'), self.queue.get())
+
+    def test_sweeper_reclaims_expired_items(self):
+        collection = QueueCollection(os.path.join(self.path, 'collection'), sweep_interval=0.05)
+        collection.put('swept', pack('!II5s', 0, 100, 'old00'))
+        collection.put('swept', pack('!II5s', 0, 0, 'keep0'))
+        time.sleep(0.2)
+        self.assertEqual(1, collection.get_queues('swept').qsize())
+        self.assertEqual(1, collection.get_queues('swept').expired_items)
+        self.assertEqual(13, collection.get_stats('current_bytes'))
+        collection.close()
+
+    def test_idle_queues_are_closed_past_open_queues_limit(self):
+        evict_idle_time = collection_module.EVICT_IDLE_TIME
+        collection_module.EVICT_IDLE_TIME = 0
+        collection = QueueCollection(os.path.join(self.path, 'collection'), max_open_queues=1, sweep_interval=0)
+        try:
+            collection.put('empty', pack('!II5s', 0, 0, 'value'))
+            self.assertEqual(pack('!II5s', 0, 0, 'value'), collection.take('empty'))
+            collection.put('full', pack('!II5s', 0, 0, 'value'))
+            self.assertEqual(['full'], collection.get_queues().keys())
+            collection.expire('empty')
+            self.assertEqual(['full'], collection.get_queues().keys())
+            collection.get_queues('empty')
+            self.assertEqual(2, collection.get_stats('open_queues'))
+            self.assertEqual(1, collection.get_stats('queue_evictions'))
+            self.assertEqual(3, collection.get_stats('queue_misses'))
+            self.assertEqual(pack('!II5s', 0, 0, 'value'), collection.take('full'))
+        finally:
+            collection_module.EVICT_IDLE_TIME = evict_idle_time
+            collection.close()
+
+    def test_queue_opened_by_concurrent_puts_stores_them_all(self):
+        collection = QueueCollection(os.path.join(self.path, 'collection'), sweep_interval=0)
+        sequences = []
+        def put(key):
+            sequences.append(collection.put(key, pack('!II5s', 0, 0, 'value')))
+        threads = [threading.Thread(target=put, args=('queue%d' % (i % 4),)) for i in range(32)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(32, len(filter(None, sequences)))
+        self.assertEqual(4, collection.get_stats('queue_misses'))
+        self.assertEqual(8, len(collection.take_many('queue0', 10)))
+        collection.close()
+
+    def reopen_with(self, committer = None, **kwargs):
+        self.queue.close()
+        self.queue = PersistentQueue(self.path, 'test', committer=committer, **kwargs)
+
+class TestEventEngine(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = Server(port=21123, path=self.path, engine='event', compress_threshold=64)
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.start()
+        self.memcache = Client(['127.0.0.1:21123'])
+
+    def tearDown(self):
+        self.memcache.disconnect_all()
+        self.server.stop()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def test_set_and_get_one_entry(self):
+        v = random.randint(1, 32)
+        self.assertEqual(None, self.memcache.get('test_set_and_get_one_entry'))
+        self.memcache.set('test_set_and_get_one_entry', v)
+        self.assertEqual(v, self.memcache.get('test_set_and_get_one_entry'))
+
+    def test_blocking_get_wakes_on_set(self):
+        v = random.randint(1, 32)
+        threading.Timer(0.1, Client(['127.0.0.1:21123']).set, ('test_blocking_get_wakes_on_set', v)).start()
+        start = time.time()
+        self.assertEqual(v, self.memcache.get('test_blocking_get_wakes_on_set/t=2000'))
+        self.assert_(time.time() - start < 1)
+
+    def test_finished_blocking_gets_leave_no_waiter(self):
+        client = Client(['127.0.0.1:21123'])
+        for v in (1, 2):
+            threading.Timer(0.05, client.set, ('test_finished_blocking_gets', v)).start()
+            self.assertEqual(v, self.memcache.get('test_finished_blocking_gets/t=300'))
+        # the deadlines of the past gets are reached while this one waits
+        threading.Timer(0.6, client.set, ('test_finished_blocking_gets', 3)).start()
+        start = time.time()
+        self.assertEqual(3, self.memcache.get('test_finished_blocking_gets/t=2000'))
+        self.assert_(time.time() - start < 1)
+        time.sleep(0.1)
+        self.assert_(self.server.queue_collection.get_queues('test_finished_blocking_gets').idle())
+
+    def test_compressed_items(self):
+        value = 'compressible ' * 100
+        self.memcache.set('test_compressed_items', value)
+        self.memcache.set('test_compressed_items', 'short')
+        (key, stats) = self.memcache.get_stats()[0]
+        self.assertEqual(len(value) + 8, int(stats['queue_test_compressed_items_raw_bytes']))
+        self.assert_(int(stats['queue_test_compressed_items_compressed_bytes']) < 100)
+        self.assert_(int(stats['bytes']) < 110)
+        self.assertEqual(value, self.memcache.get('test_compressed_items'))
+        self.assertEqual('short', self.memcache.get('test_compressed_items'))
+
+    def test_many_idle_connections(self):
+        sockets = [socket.create_connection(('127.0.0.1', 21123)) for i in range(200)]
+        sockets[-1].sendall('set test_many_idle_connections 0 0 5\r\nhel')
+        sockets[0].sendall('stats\r\n')
+        self.assert_('STAT curr_connections 200' in sockets[0].recv(4096))
+        sockets[-1].sendall('lo\r\nget test_many_idle_connections\r\n')
+        time.sleep(0.1)
+        self.assertEqual('STORED\r\nVALUE test_many_idle_connections 0 5\r\nhello\r\nEND\r\n', sockets[-1].recv(4096))
+        for s in sockets:
+            s.close()
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.servers = [Server(port=21124 + i, path=self.path, engine='event', workers=2, worker=i) for i in range(2)]
+        self.threads = [threading.Thread(target=server.run) for server in self.servers]
+        for thread in self.threads:
+            thread.start()
+        self.clients = [Client(['127.0.0.1:%d' % (21124 + i)]) for i in range(2)]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect_all()
+        for server in self.servers:
+            server.stop()
+        for thread in self.threads:
+            thread.join()
+        shutil.rmtree(self.path)
+
+    def test_requests_are_forwarded_to_owner(self):
+        router = self.servers[0].router
+        keys = ['test_forwarded_%d' % i for i in range(8)]
+        self.assertEqual(set([0, 1]), set(router.owner(key) for key in keys))
+        for i, key in enumerate(keys):
+            self.clients[i % 2].set(key, i)
+        for i, key in enumerate(keys):
+            self.assertEqual(i, self.clients[(i + 1) % 2].get(key))
+        for i, server in enumerate(self.servers):
+            self.assertEqual(sorted(key for key in keys if router.owner(key) == i), sorted(server.queue_collection.get_queues()))
+
+    def test_stats_add_up_every_worker(self):
+        keys = ['test_stats_%d' % i for i in range(8)]
+        for i, key in enumerate(keys):
+            self.clients[0].set(key, i)
+        (server, stats) = self.clients[1].get_stats()[0]
+        self.assertEqual('8', stats['curr_items'])
+        self.assertEqual('8', stats['cmd_set'])
+        self.assertEqual(['1'] * 8, [stats['queue_%s_items' % key] for key in keys])
+        self.assertEqual(8, len(Peafowl(['127.0.0.1:21125'])))
+
+    def test_forwarded_blocking_get(self):
+        key = [k for k in ('a', 'b', 'c', 'd') if self.servers[0].router.owner(k) == 1][0]
+        threading.Timer(0.1, Client(['127.0.0.1:21125']).set, (key, 'v')).start()
+        self.assertEqual('v', self.clients[0].get(key + '/t=2000'))
+
+class TestCounters(unittest.TestCase):
+    def test_concurrent_increments_are_exact(self):
+        counters = Counters(items=5)
+        def work():
+            for i in xrange(10000):
+                counters.incr('items')
+                counters.shard()['bytes'] += 2
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(80005, counters['items'])
+        self.assertEqual(160000, counters['bytes'])
+        self.assertEqual([], counters.shards)
+
+    def test_released_shards_are_folded_at_once(self):
+        counters = Counters()
+        def work():
+            counters.incr('connections')
+            counters.release()
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], counters.shards)
+        self.assertEqual(8, counters.totals['connections'])
+
+class TestBenchmark(unittest.TestCase):
+    def test_report(self):
+        report = Benchmark(engine='event', producers=2, consumers=2, messages=200, queues=3, depth=4).run()
+        self.assertEqual(None, report.get('errors'))
+        self.assertEqual(400, report['set']['ops'])
+        self.assertEqual(400, report['get']['ops'])
+        self.assert_(report['get']['p50_ms'] <= report['get']['p99_ms'] <= report['get']['p999_ms'])
+        self.assert_(report['cpu']['us_per_op'] > 0)
+
 if __name__ == '__main__':
     unittest.main()
 